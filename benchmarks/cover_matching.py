@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Compares the full resolution RMS from utils.compare_images with the decisions of CoverMatcher, which rejects on
+# thumbnails and confirms close candidates at full resolution, both for speed and to make sure the match decision
+# at the given threshold does not change. Besides clearly different covers and re-encoded copies, the candidates
+# include copies with added noise, blur and brightness changes whose full resolution RMS is close to the threshold.
+# The NumPy and ImageStat implementations of the thumbnail metric are checked against each other too.
+# Run from the repository root: python3 -m benchmarks.cover_matching
+
+import argparse, os, random, tempfile, time
+
+import numpy as np
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from orpheus.artwork import CoverMatcher, load_cover_thumbnail, thumbnail_rms
+from utils.utils import compare_images
+
+
+def imagestat_rms(thumbnail_1, thumbnail_2):
+    # The fallback path of thumbnail_rms, used when NumPy isn't installed
+    return ImageStat.Stat(ImageChops.difference(thumbnail_1, thumbnail_2).convert('L')).rms[0]
+
+
+def generate_cover(location, seed, size):
+    rng = random.Random(seed)
+    im = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(im)
+    for _ in range(40):
+        x, y = rng.randrange(size), rng.randrange(size)
+        r = rng.randrange(size // 20, size // 3)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    im.save(location, 'jpeg', quality=90)
+
+
+def generate_variant(source, location, size, quality, blur):
+    # Re-encoded, rescaled and slightly blurred copies, as different services would serve them
+    with Image.open(source) as im:
+        im = im.resize((size, size), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(blur))
+        im.save(location, 'jpeg', quality=quality)
+
+
+def generate_near_variant(source, location, kind, amount, seed):
+    # Copies that differ from the source by about as much as cover_variance_threshold allows
+    with Image.open(source) as im:
+        if kind == 'noise':
+            pixels = np.asarray(im.convert('RGB'), dtype=np.float64)
+            pixels += np.random.default_rng(seed).normal(0, amount, pixels.shape)
+            im = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        elif kind == 'blur':
+            im = im.filter(ImageFilter.GaussianBlur(amount))
+        else:
+            im = im.point(lambda value: min(value + round(amount), 255))
+        im.save(location, 'jpeg', quality=95)
+
+
+# (kind, amounts), the amounts put the full resolution RMS of a 1400px cover on both sides of the default threshold
+near_variants = [('noise', (8, 10, 11, 12, 13, 16)), ('blur', (8, 10, 12, 14)), ('brightness', (6, 7, 8, 9, 10))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cover matching benchmark')
+    parser.add_argument('-s', '--size', type=int, default=1400, help='Resolution of the generated covers')
+    parser.add_argument('-c', '--candidates', type=int, default=20, help='Number of candidate covers')
+    parser.add_argument('-t', '--threshold', type=float, default=8, help='cover_variance_threshold')
+    parser.add_argument('-to', '--tolerance', type=float, default=0.5, help='Largest allowed difference between the NumPy and ImageStat RMS')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        reference = os.path.join(directory, 'reference.jpg')
+        generate_cover(reference, 0, args.size)
+
+        candidates = []
+        for i in range(args.candidates):
+            location = os.path.join(directory, f'candidate_{i}.jpg')
+            if i % 2:
+                generate_variant(reference, location, args.size, quality=60 + i, blur=i / 10)
+            else:
+                generate_cover(location, i + 1, args.size)
+            candidates.append(location)
+        for kind, amounts in near_variants:
+            for amount in amounts:
+                location = os.path.join(directory, f'{kind}_{amount}.jpg')
+                generate_near_variant(reference, location, kind, amount, len(candidates))
+                candidates.append(location)
+
+        start = time.perf_counter()
+        full_rms = [compare_images(reference, c) for c in candidates]
+        full_time = time.perf_counter() - start
+
+        # What CoverMatcher decides on, the thumbnail RMS unless the candidate is close enough to need compare_images
+        matcher = CoverMatcher(args.threshold)
+        start = time.perf_counter()
+        reference_thumbnail = load_cover_thumbnail(reference)
+        thumbnails = [load_cover_thumbnail(c) for c in candidates]
+        thumbnail_rms_list = [thumbnail_rms(reference_thumbnail, t) for t in thumbnails]
+        matcher_rms = [compare_images(reference, c) if matcher.needs_full_comparison(rms) else rms for c, rms in zip(candidates, thumbnail_rms_list)]
+        thumbnail_time = time.perf_counter() - start
+        full_comparisons = sum(matcher.needs_full_comparison(rms) for rms in thumbnail_rms_list)
+        imagestat_rms_list = [imagestat_rms(reference_thumbnail, t) for t in thumbnails]
+
+    # Solid covers with the largest possible differences per channel, where an overflow would show up
+    extremes = [((0, 0, 0), (0, 108, 0)), ((0, 0, 0), (255, 255, 255)), ((255, 0, 255), (0, 255, 0)), ((12, 200, 40), (250, 3, 199))]
+    for colour_1, colour_2 in extremes:
+        thumbnail_1, thumbnail_2 = Image.new('RGB', (64, 64), colour_1), Image.new('RGB', (64, 64), colour_2)
+        thumbnail_rms_list.append(thumbnail_rms(thumbnail_1, thumbnail_2))
+        imagestat_rms_list.append(imagestat_rms(thumbnail_1, thumbnail_2))
+
+    mismatches = 0
+    for i, (full, thumb, decided) in enumerate(zip(full_rms, thumbnail_rms_list, matcher_rms), start=1):
+        same_decision = (full < args.threshold) == (decided < args.threshold)
+        mismatches += not same_decision
+        print(f'Candidate {i}: full RMS {full:.3f}, thumbnail RMS {thumb:.3f}' + (', compared at full resolution' if decided is not thumb else '')
+              + ('' if same_decision else ' DECISION CHANGED'))
+
+    disagreements = 0
+    for i, (thumb, stat) in enumerate(zip(thumbnail_rms_list, imagestat_rms_list), start=1):
+        if abs(thumb - stat) > args.tolerance:
+            disagreements += 1
+            print(f'Comparison {i}: thumbnail_rms {thumb:.3f} but ImageStat {stat:.3f}')
+
+    print(f'\nFull resolution: {full_time:.3f}s ({full_time / len(candidates) * 1000:.1f}ms per cover)')
+    print(f'CoverMatcher:    {thumbnail_time:.3f}s ({thumbnail_time / len(candidates) * 1000:.1f}ms per cover, {full_comparisons} at full resolution)')
+    print(f'Speedup: {full_time / thumbnail_time:.1f}x, decisions changed: {mismatches}, RMS disagreements: {disagreements}')
+    if mismatches or disagreements: exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Runs whole downloads offline against the synthetic module (benchmarks/synthetic) and a local HTTP server serving
+# generated payloads and covers, reporting tracks/s, MB/s, peak RSS and CPU per scenario. Every scenario runs in a
+# fresh process with its own temporary config and download folder, which is deleted afterwards. Needs ffmpeg.
+# Run from the repository root: python3 -m benchmarks.end_to_end -s album playlist
+
+import argparse, io, multiprocessing, os, resource, shutil, sys, tempfile, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ffmpeg
+from PIL import Image
+
+from orpheus.core import Orpheus, orpheus_core_download
+from utils.metrics import tracks_total, transfer_bytes_total
+from utils.models import DownloadTypeEnum, MediaIdentification, ModuleModes
+
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+payload_codecs = {'flac': ('flac', 'flac'), 'aac': ('m4a', 'aac'), 'mp3': ('mp3', 'libmp3lame')}  # {codec: (container, encoder)}
+
+# The separate download scenario needs a second module, this one serves the same catalogue under another name
+mirror_interface = '''from dataclasses import replace
+from modules.synthetic.interface import *
+
+module_information = replace(module_information, service_name='Synthetic mirror', netlocation_constant='synthetic-mirror')
+'''
+
+# {name: (media type, media id, separate download module, global setting overrides, payload codec)}, the {} in
+# media ids are filled in from the arguments
+scenarios = {
+    'album': (DownloadTypeEnum.album, 'a0', 'default', {}, None),
+    'playlist': (DownloadTypeEnum.playlist, 'p{playlist_size}', 'default', {}, None),
+    'artist': (DownloadTypeEnum.artist, 'r0', 'default', {}, None),
+    'separate-download': (DownloadTypeEnum.playlist, 'p{separate_playlist_size}', 'synthetic_mirror', {}, None),
+    'conversions': (DownloadTypeEnum.album, 'a0', 'default', {'advanced': {'codec_conversions': {'flac': 'mp3'}}}, 'flac'),
+    'conversions-file': (DownloadTypeEnum.album, 'a0', 'default',
+                         {'advanced': {'codec_conversions': {'flac': 'mp3'}, 'streaming_conversions': False}}, 'flac')
+}
+
+
+def create_payload(codec, duration):
+    # Low level noise compresses about as well as music does, a sine or silence would make every payload tiny.
+    # Written to a file, as the MP4 muxer can't write to a pipe
+    container, encoder = payload_codecs[codec]
+    with tempfile.TemporaryDirectory() as directory:
+        location = os.path.join(directory, f'payload.{container}')
+        ffmpeg.input(f'anoisesrc=a=0.1:r=44100:d={duration}', f='lavfi').output(location, ac=2, acodec=encoder, loglevel='error').run()
+        with open(location, 'rb') as f:
+            return f.read()
+
+
+def create_cover(resolution):
+    cover = io.BytesIO()
+    Image.effect_noise((resolution, resolution), 48).convert('RGB').save(cover, 'jpeg', quality=90)
+    return cover.getvalue()
+
+
+def create_server(payloads: dict, cover: bytes):
+    class CatalogueHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path.startswith('/audio/') and path[len('/audio/'):] in payloads:
+                body = payloads[path[len('/audio/'):]]
+            elif path.startswith('/cover/'):
+                body = cover
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CatalogueHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _merge(settings, overrides):
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(settings.get(k), dict) and k != 'codec_conversions':
+            _merge(settings[k], v)
+        else:
+            settings[k] = v
+
+
+def run_scenario(name, media_id, module_settings, verbose):
+    # Runs in its own process: Orpheus reads config/ and modules/ from the working directory, so both are
+    # created in a temporary directory holding only the synthetic modules
+    media_type, _, separate_download_module, overrides, payload_codec = scenarios[name]
+    directory = tempfile.mkdtemp(prefix='orpheus_benchmark_')
+    try:
+        os.chdir(directory)
+        os.makedirs('modules/synthetic_mirror')
+        open('modules/__init__.py', 'w').close()
+        open('modules/synthetic_mirror/__init__.py', 'w').close()
+        with open('modules/synthetic_mirror/interface.py', 'w') as f: f.write(mirror_interface)
+        os.symlink(os.path.join(repository, 'benchmarks', 'synthetic'), 'modules/synthetic')
+        sys.path.insert(0, directory)
+
+        if not verbose: sys.stdout = sys.stderr = open(os.devnull, 'w')
+        try:
+            Orpheus()  # The first start only writes the default settings and exits
+        except SystemExit:
+            pass
+        orpheus = Orpheus()
+        orpheus.settings['global']['retry']['max_attempts'] = 1  # Retries would sleep through their backoff, injected errors are only counted
+        _merge(orpheus.settings['global'], overrides)
+        module_settings = {**module_settings, 'codec': payload_codec or module_settings['codec']}
+        orpheus.settings['modules'] = {'synthetic': module_settings, 'synthetic_mirror': module_settings}
+
+        media = {'synthetic': [MediaIdentification(media_type=media_type, media_id=media_id)]}
+        third_party_modules = {ModuleModes.covers: '', ModuleModes.lyrics: '', ModuleModes.credits: ''}
+
+        before_self, before_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        orpheus_core_download(orpheus, media, third_party_modules, separate_download_module, os.path.join(directory, 'downloads'))
+        seconds = time.perf_counter() - start
+        after_self, after_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        os.chdir(repository)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    outcomes = {k[0]: v for k, v in tracks_total.values.items()}
+    return {
+        'seconds': seconds,
+        'downloaded': outcomes.get('downloaded', 0),
+        'skipped': outcomes.get('skipped', 0),
+        'failed': outcomes.get('failed', 0),
+        'bytes': sum(transfer_bytes_total.values.values()),
+        'cpu': after_self.ru_utime + after_self.ru_stime - before_self.ru_utime - before_self.ru_stime,
+        'children_cpu': after_children.ru_utime + after_children.ru_stime - before_children.ru_utime - before_children.ru_stime,
+        'peak_rss': after_self.ru_maxrss * 1024  # Reported in KiB on Linux
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end download benchmark')
+    parser.add_argument('-s', '--scenarios', nargs='*', choices=list(scenarios), default=list(scenarios))
+    parser.add_argument('-c', '--codec', choices=list(payload_codecs), default='flac', help='Codec of the served payloads')
+    parser.add_argument('-d', '--duration', type=float, default=5, help='Payload duration in seconds')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='Mean seconds every module API call takes')
+    parser.add_argument('-j', '--jitter', type=float, default=0, help='Standard deviation of the API latency')
+    parser.add_argument('-e', '--error_rate', type=float, default=0, help='Fraction of track downloads that fail')
+    parser.add_argument('--catalogue_size', type=int, default=100000)
+    parser.add_argument('--album_size', type=int, default=12)
+    parser.add_argument('--artist_albums', type=int, default=5)
+    parser.add_argument('--playlist_size', type=int, default=5000)
+    parser.add_argument('--separate_playlist_size', type=int, default=500)
+    parser.add_argument('--cover_resolution', type=int, default=1400)
+    parser.add_argument('-v', '--verbose', action='store_true', help="Show Orpheus' own output")
+    args = parser.parse_args()
+
+    codecs = {args.codec} | {scenarios[i][4] for i in args.scenarios if scenarios[i][4]}
+    server = create_server({codec: create_payload(codec, args.duration) for codec in codecs}, create_cover(args.cover_resolution))
+    module_settings = {
+        'server_url': f'http://127.0.0.1:{server.server_address[1]}', 'codec': args.codec, 'latency': args.latency, 'jitter': args.jitter,
+        'error_rate': args.error_rate, 'catalogue_size': args.catalogue_size, 'album_size': args.album_size, 'artist_albums': args.artist_albums
+    }
+
+    print(f'{"Scenario":<20}{"Tracks":>8}{"Failed":>8}{"Time":>9}{"Tracks/s":>10}{"MB/s":>9}{"Peak RSS":>11}{"CPU":>9}{"ffmpeg CPU":>12}')
+    for name in args.scenarios:
+        # A new process per scenario, so peak RSS and the counters aren't carried over from the last one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_scenario, name, scenarios[name][1].format(**vars(args)), module_settings, args.verbose).result()
+        tracks = result['downloaded'] + result['failed']
+        print(f'{name:<20}{tracks:>8}{result["failed"]:>8}{result["seconds"]:>8.1f}s{tracks / result["seconds"]:>10.2f}'
+              f'{result["bytes"] / 1024**2 / result["seconds"]:>9.1f}{result["peak_rss"] / 1024**2:>8.0f} MB'
+              f'{result["cpu"]:>8.1f}s{result["children_cpu"]:>11.1f}s')
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import random, time
+
+from utils.models import *
+
+
+module_information = ModuleInformation( # Only service_name and module_supported_modes are mandatory
+    service_name = 'Synthetic',
+    module_supported_modes = ModuleModes.download | ModuleModes.lyrics | ModuleModes.covers | ModuleModes.credits,
+    flags = ModuleFlags.hidden,
+    # No global_settings on purpose, so the module doesn't add itself to settings.json. The benchmarks pass their
+    # configuration as module_settings instead, anything missing falls back to default_settings
+    global_settings = {},
+    netlocation_constant = 'synthetic',
+    test_url = 'https://synthetic/track/0',
+    login_behaviour = ManualEnum.manual
+)
+
+default_settings = {
+    'server_url': 'http://127.0.0.1:8000',  # Local server serving /audio/<codec> and /cover/<album>.jpg
+    'codec': 'flac',  # Codec of the served payloads: flac, aac or mp3
+    'latency': 0.0,  # Mean seconds every API call takes
+    'jitter': 0.0,  # Standard deviation of the latency
+    'error_rate': 0.0,  # Fraction of get_track_download calls that fail
+    'catalogue_size': 100000,  # Number of tracks, ids are 0 to catalogue_size - 1
+    'album_size': 12,
+    'artist_albums': 5,
+    'seed': 0
+}
+
+
+class ModuleInterface:
+    # Deterministic fake service for offline benchmarks. Ids: tracks are numbers, albums "a<n>" hold album_size
+    # consecutive tracks, artists "r<n>" have artist_albums consecutive albums and playlists "p<size>" hold size
+    # tracks picked from the whole catalogue
+    def __init__(self, module_controller: ModuleController):
+        self.settings = {**default_settings, **module_controller.module_settings}
+        self.module_controller = module_controller
+        self.random = random.Random(self.settings['seed'])
+        self.codec = CodecEnum[self.settings['codec'].upper()]
+
+    def _wait(self):
+        # Stands in for the service's API round trip
+        delay = self.random.gauss(self.settings['latency'], self.settings['jitter']) if self.settings['jitter'] else self.settings['latency']
+        if delay > 0: time.sleep(delay)
+
+    def _number(self, media_id, prefix=''):
+        media_id = str(media_id)
+        if not media_id.startswith(prefix) or not media_id[len(prefix):].isdigit():
+            raise Exception(f'Synthetic: invalid id "{media_id}"')
+        return int(media_id[len(prefix):])
+
+    def _track(self, track_id):
+        number = self._number(track_id)
+        if number >= self.settings['catalogue_size']: raise Exception(f'Synthetic: track {track_id} is not in the catalogue')
+        album = number // self.settings['album_size']
+        return number, album, album // self.settings['artist_albums']
+
+    def get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions, data={}) -> TrackInfo:
+        self._wait()
+        number, album, artist = self._track(track_id)
+
+        tags = Tags(
+            album_artist = f'Synthetic Artist {artist}',
+            track_number = number % self.settings['album_size'] + 1,
+            total_tracks = self.settings['album_size'],
+            copyright = '(C) Synthetic',
+            isrc = f'QZSYN{number:07d}',
+            upc = f'{album:012d}',
+            disc_number = 1,
+            total_discs = 1,
+            replay_gain = -7.5,
+            replay_peak = 0.98,
+            genres = ['Electronic'],
+            release_date = '2021-06-01'
+        )
+
+        return TrackInfo(
+            name = f'Synthetic Track {number}',
+            album_id = f'a{album}',
+            album = f'Synthetic Album {album}',
+            artists = [f'Synthetic Artist {artist}'],
+            tags = tags,
+            codec = self.codec,
+            cover_url = f'{self.settings["server_url"]}/cover/a{album}.jpg',
+            release_year = 2021,
+            duration = 30,
+            explicit = False,
+            artist_id = f'r{artist}',
+            download_extra_kwargs = {'track_id': str(number)}
+        )
+
+    def get_track_download(self, track_id):
+        self._wait()
+        if self.random.random() < self.settings['error_rate']:
+            raise Exception(f'Synthetic: injected error for track {track_id}')
+        return TrackDownloadInfo(
+            download_type = DownloadEnum.URL,
+            file_url = f'{self.settings["server_url"]}/audio/{self.codec.name.lower()}?track={track_id}'
+        )
+
+    def get_album_info(self, album_id: str, data={}) -> Optional[AlbumInfo]:
+        self._wait()
+        number, size = self._number(album_id, 'a'), self.settings['album_size']
+        artist = number // self.settings['artist_albums']
+        return AlbumInfo(
+            name = f'Synthetic Album {number}',
+            artist = f'Synthetic Artist {artist}',
+            tracks = [str(i) for i in range(number * size, min((number + 1) * size, self.settings['catalogue_size']))],
+            release_year = 2021,
+            artist_id = f'r{artist}',
+            upc = f'{number:012d}',
+            cover_url = f'{self.settings["server_url"]}/cover/a{number}.jpg',
+            all_track_cover_jpg_url = f'{self.settings["server_url"]}/cover/a{number}.jpg'
+        )
+
+    def get_playlist_info(self, playlist_id: str, data={}) -> PlaylistInfo:
+        self._wait()
+        size = self._number(playlist_id, 'p')
+        tracks = random.Random(f'{self.settings["seed"]}-{size}').sample(range(self.settings['catalogue_size']), size)
+        return PlaylistInfo(
+            name = f'Synthetic Playlist {size}',
+            creator = 'Synthetic',
+            tracks = [str(i) for i in tracks],
+            release_year = 2021,
+            cover_url = f'{self.settings["server_url"]}/cover/{playlist_id}.jpg'
+        )
+
+    def get_artist_info(self, artist_id: str, get_credited_albums: bool) -> ArtistInfo:
+        self._wait()
+        number, albums = self._number(artist_id, 'r'), self.settings['artist_albums']
+        return ArtistInfo(
+            name = f'Synthetic Artist {number}',
+            albums = [f'a{i}' for i in range(number * albums, (number + 1) * albums)]
+        )
+
+    def get_track_credits(self, track_id: str, data={}):
+        self._wait()
+        return [CreditsInfo('Producer', ['Synthetic Producer']), CreditsInfo('Mixer', ['Synthetic Mixer'])]
+
+    def get_track_cover(self, track_id: str, cover_options: CoverOptions, data={}) -> CoverInfo:
+        self._wait()
+        _, album, _ = self._track(track_id)
+        return CoverInfo(url=f'{self.settings["server_url"]}/cover/a{album}.jpg', file_type=ImageFileTypeEnum.jpg)
+
+    def get_track_lyrics(self, track_id: str, data={}) -> LyricsInfo:
+        self._wait()
+        lines = [f'Line {i} of track {track_id}' for i in range(40)]
+        return LyricsInfo(embedded='\n'.join(lines), synced='\n'.join(f'[00:{i * 0.75:05.2f}]{line}' for i, line in enumerate(lines)))
+
+    def search(self, query_type: DownloadTypeEnum, query: str, track_info: TrackInfo = None, limit: int = 10):
+        # Tracks are found again by their ISRC, so another module can look up this module's tracks
+        self._wait()
+        if track_info and track_info.tags.isrc and track_info.tags.isrc.startswith('QZSYN'):
+            numbers = [int(track_info.tags.isrc[5:])]
+        else:
+            numbers = [int(i) for i in query.split() if i.isdigit()][:limit]
+        return [SearchResult(
+            result_id = str(i),
+            name = f'Synthetic Track {i}',
+            artists = [f'Synthetic Artist {i // self.settings["album_size"] // self.settings["artist_albums"]}']
+        ) for i in numbers if i < self.settings['catalogue_size']]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Times orpheus.tagging.tag_file per container on short generated fixtures, serially and from a thread pool, against
+# the previous implementation in benchmarks/tagging_legacy.py, and checks that the written tags read back as expected.
+# Needs ffmpeg to generate the fixtures. Run from the repository root: python3 -m benchmarks.tagging
+
+import argparse, os, shutil, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+from mutagen.mp3 import MP3
+from PIL import Image
+
+from benchmarks import tagging_legacy
+from orpheus.tagging import CoverPayloadCache, tag_file
+from utils.models import ContainerEnum, CreditsInfo, CodecEnum, Tags, TrackInfo
+
+
+fixture_codecs = {
+    ContainerEnum.flac: {'acodec': 'flac'},
+    ContainerEnum.m4a: {'acodec': 'aac'},
+    ContainerEnum.mp3: {'acodec': 'libmp3lame'},
+    ContainerEnum.opus: {'acodec': 'libopus'}
+}
+
+
+def create_fixture(location, codec_kwargs, duration):
+    ffmpeg.input('anullsrc=r=48000:cl=stereo', f='lavfi', t=duration).output(location, **codec_kwargs, loglevel='error').run(overwrite_output=True)
+
+
+def create_track_info(index):
+    tags = Tags(album_artist='Benchmark Artist', composer='Composer', track_number=index, total_tracks=12, copyright='(C) Orpheus',
+                isrc='QZ0000000000', upc='000000000000', disc_number=1, total_discs=1, replay_gain=-7.5, replay_peak=0.98,
+                genres=['Electronic', 'Ambient'], release_date='2021-06-01', description='Description', comment='Comment',
+                label='Label', extra_tags={'MOOD': 'calm'})
+    return TrackInfo(name=f'Track {index}', album='Benchmark Album', album_id='1', artists=['Benchmark Artist', 'Featured'],
+                     tags=tags, codec=CodecEnum.FLAC, cover_url='', release_year=2021, explicit=False)
+
+
+def check_round_trip(location, container):
+    # Returns the problems found reading the tags of a tagged file back
+    problems = []
+    if container is ContainerEnum.mp3:
+        tags = MP3(location).tags
+        # Saved as ID3v2.3, mutagen merges TYER and TDAT back into TDRC on load
+        date = str(tags['TDRC']) if 'TDRC' in tags else None
+        if date != '2021-06-01': problems.append(f'date reads back as {date}')
+        if 'RVA2:track' not in tags: problems.append('RVA2:track frame missing')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tagging benchmark')
+    parser.add_argument('-n', '--files', type=int, default=50, help='Files tagged per container')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Threads used for the concurrent run')
+    parser.add_argument('-d', '--duration', type=float, default=5, help='Fixture duration in seconds')
+    args = parser.parse_args()
+
+    credits_list = [CreditsInfo('Producer', ['Someone']), CreditsInfo('Mixer', ['Someone Else'])]
+    lyrics = '\n'.join(f'Line {i}' for i in range(40))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        cover = os.path.join(directory, 'cover.jpg')
+        Image.new('RGB', (1400, 1400), (40, 80, 120)).save(cover, 'jpeg', quality=70)
+
+        for container, codec_kwargs in fixture_codecs.items():
+            fixture = os.path.join(directory, f'fixture.{container.name}')
+            try:
+                create_fixture(fixture, codec_kwargs, args.duration)
+            except ffmpeg.Error:
+                print(f'{container.name}: could not create fixture, skipping')
+                continue
+
+            files = [os.path.join(directory, f'{i}.{container.name}') for i in range(args.files)]
+            cover_cache = CoverPayloadCache()
+
+            def tag(i, tagger=tag_file):
+                tagger(files[i], cover_cache.get(cover), create_track_info(i + 1), credits_list, lyrics, container)
+
+            def tag_serially(tagger=tag_file):
+                for i in range(args.files): tag(i, tagger)
+
+            def tag_threaded():
+                with ThreadPoolExecutor(args.workers) as executor:
+                    list(executor.map(tag, range(args.files)))
+
+            results, timings = [], {}
+            for run_name, run in (('legacy serial', lambda: tag_serially(tagging_legacy.tag_file)), ('serial', tag_serially),
+                                  (f'{args.workers} threads', tag_threaded)):
+                for f in files: shutil.copyfile(fixture, f)
+                start = time.perf_counter()
+                run()
+                timings[run_name] = (time.perf_counter() - start) / args.files
+                results.append(f'{run_name} {timings[run_name] * 1000:.2f}ms/file')
+            results.append(f"serial speedup over legacy {timings['legacy serial'] / timings['serial']:.2f}x")
+            print(f'{container.name}: ' + ', '.join(results))
+
+            for problem in check_round_trip(files[0], container):
+                print(f'{container.name}: {problem}')
+                failed = True
+
+    if failed: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Compares download_file with the old 1 KiB iter_content loop against a local HTTP server, reporting MB/s and
+# CPU seconds per GB. Run from the repository root: python3 -m benchmarks.transfer
+
+import argparse, os, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.utils import download_file, r_session, set_transfer_settings
+
+
+def create_server(payload: bytes):
+    class PayloadHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            view = memoryview(payload)
+            for offset in range(0, len(payload), 1024 * 1024):
+                self.wfile.write(view[offset:offset + 1024 * 1024])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PayloadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_download_file(url, file_location):
+    # The transfer loop download_file used before the reusable buffer
+    r = r_session.get(url, stream=True, verify=False)
+    with open(file_location, 'wb') as f:
+        [f.write(chunk) for chunk in r.iter_content(chunk_size=1024) if chunk]
+
+
+def measure(name, function, url, directory, size, runs):
+    wall, cpu = 0, 0
+    for i in range(runs):
+        location = os.path.join(directory, f'{name}_{i}')
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        function(url, location)
+        wall += time.perf_counter() - wall_start
+        cpu += time.process_time() - cpu_start
+        os.remove(location)
+    gigabytes = size * runs / 1024**3
+    print(f'{name:<24} {size * runs / 1024**2 / wall:8.1f} MB/s {cpu / gigabytes:8.2f} CPU s/GB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transfer benchmark')
+    parser.add_argument('-s', '--size', type=int, default=256, help='Payload size in MiB')
+    parser.add_argument('-r', '--runs', type=int, default=3)
+    parser.add_argument('-b', '--buffer_sizes', type=int, nargs='*', default=[64 * 1024, 1024 * 1024, 4 * 1024 * 1024])
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size * 1024 * 1024)
+    server = create_server(payload)
+    url = f'http://127.0.0.1:{server.server_address[1]}/payload'
+
+    with tempfile.TemporaryDirectory() as directory:
+        measure('legacy 1KiB loop', legacy_download_file, url, directory, len(payload), args.runs)
+        for buffer_size in args.buffer_sizes:
+            set_transfer_settings(buffer_size=buffer_size)
+            measure(f'readinto {buffer_size // 1024}KiB', download_file, url, directory, len(payload), args.runs)
+        set_transfer_settings(fsync='file')
+        measure('readinto + fsync', download_file, url, directory, len(payload), args.runs)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -32,7 +32,7 @@ module_information = ModuleInformation( # Only service_name and module_supported
 class ModuleInterface:
     def __init__(self, module_controller: ModuleController):
         settings = module_controller.module_settings
-        self.session = (settings['app_id'], settings['app_secret']) # API class goes here
+        self.session = (settings['app_id'], settings['app_secret']) # API class goes here, use module_controller.http_transport.create_session() for HTTP
         self.session.auth_token = module_controller.temporary_settings_controller.read('access_token')
         self.module_controller = module_controller
 
@@ -138,7 +138,8 @@ class ModuleInterface:
             cover_type = ImageFileTypeEnum.jpg, # optional
             animated_cover_url = '', # optional
             description = '', # optional
-            track_extra_kwargs = {'data': ''} # optional, whatever you want
+            track_extra_kwargs = {'data': ''}, # optional, whatever you want
+            snapshot_id = '' # optional, anything that changes when the tracks change, lets --sync skip unchanged playlists
         )
 
     def get_artist_info(self, artist_id: str, get_credited_albums: bool) -> ArtistInfo: # Mandatory if ModuleModes.download
@@ -150,7 +151,8 @@ class ModuleInterface:
             albums = [], # optional
             album_extra_kwargs = {'data': ''}, # optional, whatever you want
             tracks = [], # optional
-            track_extra_kwargs = {'data': ''} # optional, whatever you want
+            track_extra_kwargs = {'data': ''}, # optional, whatever you want
+            snapshot_id = '' # optional, anything that changes when the albums or tracks change
         )
 
     def get_track_credits(self, track_id: str, data={}): # Mandatory if ModuleModes.credits
@@ -1,45 +1,149 @@
 #!/usr/bin/env python3
 
-import argparse, cProfile, pstats
+import argparse, cProfile, os, pstats, re, threading, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
 from orpheus.core import Orpheus
+from utils.cassette import use_cassette
+from utils.perf import percentile
+from utils.sampling import SamplingProfiler
+
+
+class EndpointStats:
+    # Counts the HTTP requests made through requests' adapters per endpoint, with numeric and hex ids in the path
+    # collapsed so /track/123 and /track/456 count as the same endpoint
+    id_pattern = re.compile(r'/(\d+|[0-9a-fA-F-]{16,})(?=/|$)')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # {endpoint: ([durations], errors)}
+        self.original_send = None
+
+    def install(self):
+        stats, self.original_send = self, HTTPAdapter.send
+
+        def send(adapter, request, *args, **kwargs):
+            url = urlsplit(request.url)
+            endpoint = f'{request.method} {url.netloc}{stats.id_pattern.sub("/{id}", url.path)}'
+            start, failed = time.perf_counter(), True
+            try:
+                response = stats.original_send(adapter, request, *args, **kwargs)
+                failed = response.status_code >= 400
+                return response
+            finally:
+                with stats.lock:
+                    durations, errors = stats.requests.get(endpoint, ([], 0))
+                    durations.append(time.perf_counter() - start)
+                    stats.requests[endpoint] = (durations, errors + failed)
+
+        HTTPAdapter.send = send
+        return self
+
+    def report(self):
+        lines = [f'{"Requests":>9}{"Errors":>8}{"p50":>9}{"p95":>9}{"Total":>9}  Endpoint']
+        with self.lock:
+            items = sorted(self.requests.items(), key=lambda i: -sum(i[1][0]))
+        for endpoint, (durations, errors) in items:
+            durations = sorted(durations)
+            lines.append(f'{len(durations):>9}{errors:>8}{percentile(durations, 0.5):>8.3f}s{percentile(durations, 0.95):>8.3f}s{sum(durations):>8.2f}s  {endpoint}')
+        return '\n'.join(lines)
+
+
+def parse_arguments(arguments):
+    args, kwargs = [], {}
+    for i in arguments:
+        if '=' in i:
+            item, value = i.split('=')
+            kwargs[item] = value
+        else:
+            args.append(i)
+    return args, kwargs
+
 
 def main():
     parser = argparse.ArgumentParser(description='Orpheus Module Testing Tool')
     parser.add_argument('-pr', '--private', action='store_true', help='Enable private modules')
     parser.add_argument('-sp', '--save_profile', action='store_true', help='Save profiling for use with SnakeViz')
     parser.add_argument('-pp', '--print_profile', action='store_true', help='Print profiling (long output)')
+    parser.add_argument('-rc', '--record', help='Record every HTTP request and response into this cassette directory')
+    parser.add_argument('-rp', '--replay', help='Serve HTTP responses from this cassette directory instead of the network')
+    parser.add_argument('-rt', '--replay_timing', type=float, default=1.0, help='Multiplier for the recorded timings when replaying, 0 replays without delays')
+    parser.add_argument('-n', '--runs', type=int, default=1, help='Number of times the function is called (per id with --ids)')
+    parser.add_argument('-i', '--ids', help='Comma separated ids, or a file with one id per line, each passed as the first argument')
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help='Number of calls made at the same time')
+    parser.add_argument('-sm', '--sample', help='Run a sampling profiler and save collapsed stacks to this file, for flamegraph.pl or speedscope')
+    parser.add_argument('-si', '--sample_interval', type=float, default=0.005, help='Seconds between samples')
     parser.add_argument('module')
     parser.add_argument('function')
     parser.add_argument('arguments', nargs='*')
     parsed_args = parser.parse_args()
+    use_cassette(parsed_args.record, parsed_args.replay, parsed_args.replay_timing)
+
+    orpheus = Orpheus(parsed_args.private)
+    if parsed_args.module.lower() not in orpheus.module_list:
+        raise Exception(f'Module {parsed_args.module} either does not exist or mismatches private mode')
+    module_instance = orpheus.load_module(parsed_args.module.lower())
+    requested_function = getattr(module_instance, parsed_args.function.lower(), None)
+    if not requested_function:
+        raise Exception(f'Function {parsed_args.function} does not exist')
 
+    args, kwargs = parse_arguments(parsed_args.arguments)
+    if parsed_args.ids:
+        ids = [i.strip() for i in open(parsed_args.ids, 'r')] if os.path.isfile(parsed_args.ids) else parsed_args.ids.split(',')
+        calls = [[i] + args for i in ids if i] * parsed_args.runs
+    else:
+        calls = [args] * parsed_args.runs
+
+    durations, errors = [], []
+    def timed_call(call_args):
+        start = time.perf_counter()
+        try:
+            requested_function(*call_args, **kwargs)
+        except Exception:
+            errors.append((", ".join(call_args), traceback.format_exc()))
+        durations.append(time.perf_counter() - start)
+
+    endpoint_stats = EndpointStats().install()
+    sampler = SamplingProfiler(parsed_args.sample_interval).start() if parsed_args.sample else None
+    profile = cProfile.Profile() if parsed_args.save_profile or parsed_args.print_profile else None
+    start = time.perf_counter()
     try:
-        with cProfile.Profile() as pr:
-            orpheus = Orpheus(parsed_args.private)
-            if parsed_args.module.lower() not in orpheus.module_list:
-                raise Exception(f'Module {parsed_args.module} either does not exist or mismatches private mode')
-            module_instance = orpheus.load_module(parsed_args.module.lower())
-            requested_function = getattr(module_instance, parsed_args.function.lower(), None)
-            if not requested_function:
-                raise Exception(f'Function {parsed_args.function} does not exist')
-
-            args, kwargs = [], {}
-            for i in parsed_args.arguments:
-                if '=' in i:
-                    item, value = i.split('=')
-                    kwargs[item] = value
-                else:
-                    args.append(i)
-            requested_function(*args, **kwargs)
+        if profile: profile.enable()  # Only sees the main thread, use --sample with --concurrency
+        if parsed_args.concurrency > 1:
+            with ThreadPoolExecutor(parsed_args.concurrency) as executor:
+                list(executor.map(timed_call, calls))
+        else:
+            for i in calls: timed_call(i)
     finally:
-        stats = pstats.Stats(pr)
-        stats.sort_stats(pstats.SortKey.TIME)
-        stats.dump_stats(filename='orpheus_profiling.prof') if parsed_args.save_profile else None
-        stats.print_stats() if parsed_args.print_profile else None
+        if profile: profile.disable()
+        if sampler: sampler.stop()
+        wall_time = time.perf_counter() - start
+
+        durations.sort()
+        print(f'\n{len(durations)} calls, {len(errors)} failed, {wall_time:.2f}s, {len(durations) / wall_time:.2f} calls/s')
+        if durations:
+            print('Latency: ' + ', '.join(f'{name} {percentile(durations, fraction):.3f}s' for name, fraction in
+                                          (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99), ('max', 1))))
+        for call_args, error in errors[:5]:
+            print(f'\nFailed: {call_args}\n{error}', end='')
+        print('\n' + endpoint_stats.report())
+
+        if sampler:
+            sampler.write(parsed_args.sample)
+            print(f'\n{sampler.samples} samples saved to {parsed_args.sample}, most frequent functions:')
+            for frame, share in sampler.top(): print(f'{share:>7.1%}  {frame}')
+        if profile:
+            stats = pstats.Stats(profile)
+            stats.sort_stats(pstats.SortKey.TIME)
+            stats.dump_stats(filename='orpheus_profiling.prof') if parsed_args.save_profile else None
+            stats.print_stats() if parsed_args.print_profile else None
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
         print('\n\t^C pressed - abort')
-        exit()
\ No newline at end of file
+        exit()
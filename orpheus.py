@@ -5,7 +5,49 @@ import re
 from urllib.parse import urlparse
 
 from orpheus.core import *
+from orpheus.library import LibraryIndex
 from orpheus.music_downloader import beauty_format_seconds
+from orpheus.verify import verify_library
+from utils.cassette import use_cassette
+
+
+def parse_link(orpheus: Orpheus, link: str):
+    if link.startswith('http'):
+        url = urlparse(link)
+        components = url.path.split('/')
+
+        service_name = None
+        for i in orpheus.module_netloc_constants:
+            if re.findall(i, url.netloc): service_name = orpheus.module_netloc_constants[i]
+        if not service_name:
+            raise Exception(f'URL location "{url.netloc}" is not found in modules!')
+
+        if orpheus.module_settings[service_name].url_decoding is ManualEnum.manual:
+            module = orpheus.load_module(service_name)
+            return service_name, module.custom_url_parse(link)
+        else:
+            if not components or len(components) <= 2:
+                print(f'\tInvalid URL: "{link}"')
+                exit() # TODO: replace with InvalidInput
+
+            url_constants = orpheus.module_settings[service_name].url_constants
+            if not url_constants:
+                url_constants = {
+                    'track': DownloadTypeEnum.track,
+                    'album': DownloadTypeEnum.album,
+                    'playlist': DownloadTypeEnum.playlist,
+                    'artist': DownloadTypeEnum.artist
+                }
+
+            type_matches = [media_type for url_check, media_type in url_constants.items() if url_check in components]
+
+            if not type_matches:
+                print(f'Invalid URL: "{link}"')
+                exit()
+
+            return service_name, MediaIdentification(media_type=type_matches[-1], media_id=components[-1])
+    else:
+        raise Exception(f'Invalid argument: "{link}"')
 
 
 def main():
@@ -23,7 +65,7 @@ def main():
     
     help_ = 'Use "settings [option]" for orpheus controls (coreupdate, fullupdate, modinstall), "settings [module]' \
            '[option]" for module specific options (update, test, setup), searching by "[search/luckysearch] [module]' \
-           '[track/artist/playlist/album] [query]", or just putting in urls. (you may need to wrap the URLs in double' \
+           '[track/artist/playlist/album] [query]", following playlists and artists with "watch [follow list]", taking jobs from a shared queue with "worker [queue]", checking downloaded files with "verify [path]", indexing existing files with "library scan [path]", or just putting in urls. (you may need to wrap the URLs in double' \
            'quotes if you have issues downloading)'
     parser = argparse.ArgumentParser(description='Orpheus: modular music archival')
     parser.add_argument('-p', '--private', action='store_true', help=argparse.SUPPRESS)
@@ -31,11 +73,21 @@ def main():
     parser.add_argument('-lr', '--lyrics', default='default', help='Set module to get lyrics from')
     parser.add_argument('-cv', '--covers', default='default', help='Override module to get covers from')
     parser.add_argument('-cr', '--credits', default='default', help='Override module to get credits from')
+    parser.add_argument('-s', '--sync', action='store_true', help='Only download what was added to playlists and artists since their last sync')
     parser.add_argument('-sd', '--separatedownload', default='default', help='Select a different module that will download the playlist instead of the main module. Only for playlists.')
+    parser.add_argument('-w', '--workers', type=int, help='Split the downloads across this many worker processes, overrides the sharding settings')
+    parser.add_argument('-eq', '--enqueue', action='store_true', help='Only add the downloads to the queue, for "worker" processes to take')
+    parser.add_argument('-of', '--output_format', choices=['pretty', 'quiet', 'jsonl'], help='Override the output format from the settings')
+    parser.add_argument('-rc', '--record', help='Record every HTTP request and response into this cassette directory')
+    parser.add_argument('-rp', '--replay', help='Serve HTTP responses from this cassette directory instead of the network')
+    parser.add_argument('-rt', '--replay_timing', type=float, default=1.0, help='Multiplier for the recorded timings when replaying, 0 replays without delays')
     parser.add_argument('arguments', nargs='*', help=help_)
     args = parser.parse_args()
 
+    use_cassette(args.record, args.replay, args.replay_timing)
     orpheus = Orpheus(args.private)
+    if args.output_format:
+        oprinter.set_backend(create_output_backend(args.output_format, orpheus.settings['global']['general']['output_file']))
     if not args.arguments:
         parser.print_help()
         exit()
@@ -93,6 +145,20 @@ def main():
                 raise Exception(f'Unknown option {option}, choose add/delete/list/test')
         else:
             raise Exception(f'Unknown module {module}') # TODO: replace with InvalidModuleError
+    elif orpheus_mode == 'verify':
+        paths = args.arguments[1:] or [args.output if args.output else orpheus.settings['global']['general']['download_path']]
+        if verify_library(paths): exit(1)
+    elif orpheus_mode == 'library':
+        library_settings = orpheus.settings['global']['library']
+        if len(args.arguments) < 2 or args.arguments[1].lower() != 'scan':
+            print('Library commands must be done as orpheus.py library scan [path]')
+            exit()
+        path = args.arguments[2] if len(args.arguments) > 2 else (args.output if args.output else orpheus.settings['global']['general']['download_path'])
+        library = LibraryIndex(library_settings['database'])
+        read, unchanged, removed, unreadable = library.scan(path, workers=library_settings['scan_workers'] or None)
+        library.close()
+        for file_location in unreadable: print(f'Could not read {file_location}')
+        print(f'Indexed {read} files, {unchanged} unchanged, {removed} removed, {len(unreadable)} unreadable')
     else:
         path = args.output if args.output else orpheus.settings['global']['general']['download_path']
         if path[-1] == '/': path = path[:-1]  # removes '/' from end if it exists
@@ -161,47 +227,27 @@ def main():
             else:
                 print(f'Download must be done as orpheus.py [download] [module] [{media_types}] [media ID 1] [media ID 2] ...')
                 exit() # TODO: replace with InvalidInput
+        elif orpheus_mode == 'watch':
+            watch_settings = orpheus.settings['global']['watch']
+            follow_list_location = args.arguments[1] if len(args.arguments) > 1 else watch_settings['follow_list']
+            if not os.path.isfile(follow_list_location):
+                print(f'Follow list "{follow_list_location}" not found, it must be a JSON list of URLs or {{"url": ..., "interval": seconds}}')
+                exit() # TODO: replace with InvalidInput
+            with open(follow_list_location, 'r', encoding='utf-8') as f:
+                follow_list = json.load(f)
+            watch_sources = []
+            for followed in follow_list:
+                followed = followed if isinstance(followed, dict) else {'url': followed}
+                service_name, media = parse_link(orpheus, followed['url'])
+                watch_sources.append(WatchedSource(followed['url'], service_name, media, followed.get('interval', watch_settings['interval'])))
+        elif orpheus_mode == 'worker':
+            queue_location = args.arguments[1] if len(args.arguments) > 1 else orpheus.settings['global']['sharding']['queue']
         else:  # if no specific modes are detected, parse as urls, but first try loading as a list of URLs
             arguments = tuple(open(args.arguments[0], 'r')) if len(args.arguments) == 1 and os.path.exists(args.arguments[0]) else args.arguments
             media_to_download = {}
             for link in arguments:
-                if link.startswith('http'):
-                    url = urlparse(link)
-                    components = url.path.split('/')
-
-                    service_name = None
-                    for i in orpheus.module_netloc_constants:
-                        if re.findall(i, url.netloc): service_name = orpheus.module_netloc_constants[i]
-                    if not service_name:
-                        raise Exception(f'URL location "{url.netloc}" is not found in modules!')
-                    if service_name not in media_to_download: media_to_download[service_name] = []
-
-                    if orpheus.module_settings[service_name].url_decoding is ManualEnum.manual:
-                        module = orpheus.load_module(service_name)
-                        media_to_download[service_name].append(module.custom_url_parse(link))
-                    else:
-                        if not components or len(components) <= 2:
-                            print(f'\tInvalid URL: "{link}"')
-                            exit() # TODO: replace with InvalidInput
-                        
-                        url_constants = orpheus.module_settings[service_name].url_constants
-                        if not url_constants:
-                            url_constants = {
-                                'track': DownloadTypeEnum.track,
-                                'album': DownloadTypeEnum.album,
-                                'playlist': DownloadTypeEnum.playlist,
-                                'artist': DownloadTypeEnum.artist
-                            }
-
-                        type_matches = [media_type for url_check, media_type in url_constants.items() if url_check in components]
-
-                        if not type_matches:
-                            print(f'Invalid URL: "{link}"')
-                            exit()
-
-                        media_to_download[service_name].append(MediaIdentification(media_type=type_matches[-1], media_id=components[-1]))
-                else:
-                    raise Exception(f'Invalid argument: "{link}"')
+                service_name, media = parse_link(orpheus, link)
+                media_to_download.setdefault(service_name, []).append(media)
 
         # Prepare the third-party modules similar to above
         tpm = {ModuleModes.covers: '', ModuleModes.lyrics: '', ModuleModes.credits: ''}
@@ -214,10 +260,24 @@ def main():
             tpm[i] = moduleselected
         sdm = args.separatedownload.lower()
 
+        if orpheus_mode == 'watch':
+            orpheus_core_watch(orpheus, watch_sources, tpm, sdm, path)
+            return
+        if orpheus_mode == 'worker':
+            sharding_settings = orpheus.settings['global']['sharding']
+            queue = JobQueue(queue_location, sharding_settings['lease_seconds'], sharding_settings['max_attempts'])
+            orpheus_core_worker(orpheus, queue, tpm, sdm, path, sync=args.sync)
+            queue.close()
+            return
+
         if not media_to_download:
             print('No links given')
 
-        orpheus_core_download(orpheus, media_to_download, tpm, sdm, path)
+        workers = args.workers if args.workers is not None else orpheus.settings['global']['sharding']['workers']
+        if args.enqueue or workers > 1:
+            orpheus_core_shard(orpheus, media_to_download, tpm, sdm, path, 0 if args.enqueue else workers, sync=args.sync, private_mode=args.private)
+        else:
+            orpheus_core_download(orpheus, media_to_download, tpm, sdm, path, sync=args.sync)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Lock
+
+from PIL import Image, ImageChops, ImageStat
+
+from utils.utils import compare_images, download_to_temp, silentremove
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, Pillow's ImageStat is used as a fallback
+    np = None
+
+
+# Covers are compared at this size, large enough to keep the RMS decision stable while being cheap to decode
+cover_matching_size = 256
+
+
+def load_cover_thumbnail(image_location, size=cover_matching_size):
+    with Image.open(image_location) as im:
+        # draft() lets the JPEG decoder skip most of the work by decoding at a reduced scale directly
+        im.draft('RGB', (size, size))
+        return im.convert('RGB').resize((size, size), Image.Resampling.BILINEAR)
+
+
+def thumbnail_rms(thumbnail_1: Image.Image, thumbnail_2: Image.Image) -> float:
+    # Same metric as utils.compare_images: RMS of the greyscale absolute difference
+    if np is not None:
+        # int32, as the luma weights below would overflow int16 for large differences
+        difference = np.abs(np.asarray(thumbnail_1, dtype=np.int32) - np.asarray(thumbnail_2, dtype=np.int32))
+        # ITU-R 601-2 luma transform, identical to Pillow's convert('L')
+        grey = (difference[..., 0] * 299 + difference[..., 1] * 587 + difference[..., 2] * 114 + 500) // 1000
+        return math.sqrt(np.mean(np.square(grey, dtype=np.float64)))
+    return ImageStat.Stat(ImageChops.difference(thumbnail_1, thumbnail_2).convert('L')).rms[0]
+
+
+# Thumbnails average out fine detail, so their RMS is at most the full resolution one (up to resampling error).
+# Candidates above the threshold by this factor on the thumbnail are rejected right away, the others are decided
+# by compare_images at full resolution, so the decision is always the one compare_images would make
+thumbnail_rms_margin = 1.1
+
+
+class CoverMatcher:
+    def __init__(self, rms_threshold: float, workers: int = 4, thumbnail_size: int = cover_matching_size):
+        self.rms_threshold = rms_threshold
+        self.workers = max(1, workers)
+        self.thumbnail_size = thumbnail_size
+
+    def needs_full_comparison(self, rms: float) -> bool:
+        return rms < self.rms_threshold * thumbnail_rms_margin
+
+    def _compare(self, reference, reference_location, candidate, url, get_full_cover_url):
+        test_temp = download_to_temp(url)
+        try:
+            rms = thumbnail_rms(reference, load_cover_thumbnail(test_temp, self.thumbnail_size))
+        finally:
+            silentremove(test_temp)
+        if not self.needs_full_comparison(rms): return rms
+
+        full_url = get_full_cover_url(candidate)
+        if not full_url: return None
+        full_temp = download_to_temp(full_url)
+        try:
+            return compare_images(reference_location, full_temp)
+        finally:
+            silentremove(full_temp)
+
+    def _test_candidate(self, reference, reference_location, candidate, get_cover_url, get_full_cover_url, comparisons, lock):
+        # Returns (url, future of its RMS). Candidates sharing a cover URL share one comparison, whichever gets to it first
+        url = get_cover_url(candidate)
+        if not url: return None, None
+        with lock:
+            if url in comparisons: return url, comparisons[url]
+            comparisons[url] = comparison = Future()
+        try:
+            comparison.set_result(self._compare(reference, reference_location, candidate, url, get_full_cover_url))
+        except Exception:
+            comparison.set_result(None)  # A cover that can't be downloaded or decoded is skipped
+        except BaseException as e:
+            comparison.set_exception(e)
+        return url, comparison
+
+    def match(self, reference_location, candidates: list, get_cover_url, get_full_cover_url):
+        # Yields (index, candidate, rms) in the original order, stopping at the first match below the threshold.
+        # get_cover_url returns a candidate's thumbnail URL, get_full_cover_url its URL at the reference's resolution.
+        # Candidates are fetched and compared concurrently, the remaining ones are cancelled on a match. Like the
+        # serial loop, a URL only counts for the first candidate in search order that has it
+        reference = load_cover_thumbnail(reference_location, self.thumbnail_size)
+        comparisons, tested_urls, lock = {}, set(), Lock()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._test_candidate, reference, reference_location, c, get_cover_url, get_full_cover_url,
+                                       comparisons, lock) for c in candidates]
+            try:
+                for index, (candidate, future) in enumerate(zip(candidates, futures), start=1):
+                    url, comparison = future.result()
+                    if url is None or url in tested_urls: continue
+                    tested_urls.add(url)
+                    rms = comparison.result()
+                    if rms is None: continue
+                    yield index, candidate, rms
+                    if rms < self.rms_threshold: break
+            finally:
+                for future in futures: future.cancel()
+
+
+artwork_compression_quality = {'low': 90, 'high': 70}
+
+
+@dataclass
+class ArtworkVariant:
+    location: str
+    resolution: int
+    file_format: str = 'jpeg'
+    compression: str = 'low'
+
+
+def process_artwork(source_location, variants: list) -> dict:
+    # Decodes the source once and writes every requested variant, returns {location: (width, height)}
+    sizes = {}
+    with Image.open(source_location) as im:
+        im.load()  # Fully decoded here, so a variant is allowed to overwrite the source file
+        for variant in variants:
+            file_format = 'jpeg' if variant.file_format == 'jpg' else variant.file_format
+            quality = None if file_format == 'png' else artwork_compression_quality.get(variant.compression, 90)
+
+            output = im
+            if im.size != (variant.resolution, variant.resolution):
+                output = im.resize((variant.resolution, variant.resolution), Image.Resampling.BICUBIC)
+            if file_format == 'jpeg' and output.mode not in {'RGB', 'L'}:
+                output = output.convert('RGB')
+
+            output.save(variant.location, file_format, quality=quality)
+            sizes[variant.location] = output.size
+    return sizes
+
+
+class ArtworkProcessor:
+    def __init__(self, workers: int = 2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='artwork')
+
+    def submit(self, source_location, variants: list):
+        return self.executor.submit(process_artwork, source_location, variants)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -1,8 +1,16 @@
-import importlib, json, logging, os, pickle, requests, urllib3, base64, shutil
+import heapq, importlib, json, logging, multiprocessing, os, pickle, random, socket, sys, threading, time, urllib3, base64, shutil
+from dataclasses import dataclass
 from datetime import datetime
 
 from orpheus.music_downloader import Downloader
+from orpheus.sharding import JobQueue
+from orpheus.sync import SyncStore
+from utils.metrics import metrics, observe_count, observe_span
 from utils.models import *
+from utils.output import QuietBackend, PrettyBackend, create_output_backend
+from utils.perf import perf
+from utils.progress import progress
+from utils.transport import http_transport
 from utils.utils import *
 from utils.exceptions import *
 
@@ -22,6 +30,12 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # Make SSL
 timestamp_correction_term = 0
 # Use the same Oprinter instance wherever it's needed
 oprinter = Oprinter()
+perf.listeners.append(observe_span)
+perf.count_listeners.append(observe_count)
+perf.start_listeners.append(oprinter.stage_started)
+perf.listeners.append(oprinter.stage_finished)
+perf.count_listeners.append(oprinter.counted)
+perf.count_listeners.append(lambda name, amount: progress.track_finished(amount) if name.startswith('tracks_') else None)
 
 
 def true_current_utc_timestamp():
@@ -36,7 +50,9 @@ class Orpheus:
             "general": {
                 "download_path": "./downloads/",
                 "download_quality": "hifi",
-                "search_limit": 10
+                "search_limit": 10,
+                "output_format": "pretty",
+                "output_file": ""
             },
             "artist_downloading":{
                 "return_credited_albums": True,
@@ -74,6 +90,61 @@ class Orpheus:
                 "external_resolution": 3000,
                 "save_animated_cover": True
             },
+            "transfer": {
+                "buffer_size": 1048576,
+                "preallocate": True,
+                "fsync": "never",
+                "segment_workers": 8,
+                "segment_retries": 5,
+                "hash_algorithm": "sha256",
+                "integrity_sidecar": True
+            },
+            "http": {
+                "pool_connections": 10,
+                "pool_maxsize": 32,
+                "host_pool_sizes": {},
+                "retries": 10,
+                "retry_backoff": 0.4,
+                "keep_alive": True
+            },
+            "library": {
+                "enabled": True,
+                "database": "./config/library.db",
+                "scan_workers": 0,
+                "link_mode": "hardlink"
+            },
+            "watch": {
+                "follow_list": "./config/follow.json",
+                "interval": 3600,
+                "jitter": 0.1
+            },
+            "metrics": {
+                "prometheus_port": 0,
+                "prometheus_address": "127.0.0.1",
+                "textfile": ""
+            },
+            "circuit_breakers": {
+                "failure_threshold": 3,
+                "slow_seconds": 15.0,
+                "cooldown": 300
+            },
+            "retry": {
+                "database": "./config/retry.db",
+                "max_attempts": 4,
+                "backoff": 10,
+                "max_backoff": 3600,
+                "max_wait": 300
+            },
+            "sharding": {
+                "workers": 0,
+                "queue": "./config/queue.db",
+                "lease_seconds": 300,
+                "max_attempts": 3
+            },
+            "sync": {
+                "database": "./config/sync.db",
+                "remove_deleted_tracks": False
+            },
             "playlist": {
                 "save_m3u": True,
                 "paths_m3u": "absolute",
@@ -91,8 +162,13 @@ class Orpheus:
                     }
                 },
                 "conversion_keep_original": False,
+                "streaming_conversions": True,
                 "cover_variance_threshold": 8,
+                "cover_matching_resolution": 300,
+                "cover_matching_workers": 4,
                 "debug_mode": False,
+                "performance_report": False,
+                "performance_report_json": "",
                 "disable_subscription_checks": False,
                 "enable_undesirable_conversions": False,
                 "ignore_existing_files": False,
@@ -161,6 +237,11 @@ class Orpheus:
         if duplicates: raise Exception('Multiple modules installed that connect to the same service names: ' + ', '.join(' and '.join(duplicates)))
 
         self.update_module_storage()
+        general_settings = self.settings['global']['general']
+        if general_settings['output_format'] != 'pretty':
+            oprinter.set_backend(create_output_backend(general_settings['output_format'], general_settings['output_file']))
+        set_transfer_settings(**self.settings['global']['transfer'])
+        http_transport.configure(**self.settings['global']['http'])
 
         for i in self.extension_list:
             extension_settings: ExtensionInformation = getattr(importlib.import_module(f'extensions.{i}.interface'), 'extension_settings', None)
@@ -195,6 +276,7 @@ class Orpheus:
                     module_error = ModuleError, # DEPRECATED
                     get_current_timestamp = true_current_utc_timestamp,
                     printer_controller = oprinter,
+                    http_transport = http_transport,
                     orpheus_options = OrpheusOptions(
                         debug_mode = self.settings['global']['advanced']['debug_mode'],
                         quality_tier = QualityEnum[self.settings['global']['general']['download_quality'].upper()],
@@ -355,9 +437,14 @@ class Orpheus:
             exit()
 
 
-def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path):
-    downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
-    os.makedirs('temp', exist_ok=True)
+def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path, sync=False, downloader=None, retry=True):
+    # retry runs the pass over failed tracks that are due at the end, callers that download in many small calls
+    # (watch, workers) turn it off and run it on their own schedule
+    own_downloader = not downloader  # Downloaders passed in are reused, so their artwork workers are kept running
+    if own_downloader:
+        downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
+        if sync: downloader.sync_store = SyncStore(orpheus_session.settings['global']['sync']['database'])
+    os.makedirs(transfer_settings.temp_folder, exist_ok=True)
 
     for mainmodule, items in media_to_download.items():
         for media in items:
@@ -396,6 +483,7 @@ def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_par
                 if mediatype is DownloadTypeEnum.album:
                     downloader.download_album(media_id, extra_kwargs=media.extra_kwargs)
                 elif mediatype is DownloadTypeEnum.track:
+                    progress.add_tracks(1)
                     downloader.download_track(media_id, extra_kwargs=media.extra_kwargs)
                 elif mediatype is DownloadTypeEnum.playlist:
                     downloader.download_playlist(media_id, extra_kwargs=media.extra_kwargs)
@@ -404,4 +492,155 @@ def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_par
                 else:
                     raise Exception(f'\tUnknown media type "{mediatype}"')
 
-    if os.path.exists('temp'): shutil.rmtree('temp')
\ No newline at end of file
+    if retry: downloader.retry_failed_tracks(orpheus_session.settings['global']['retry']['max_wait'])
+    downloader.report_failed_tracks()
+    if own_downloader: downloader.artwork_processor.shutdown()
+
+    if os.path.exists(transfer_settings.temp_folder): shutil.rmtree(transfer_settings.temp_folder)
+    progress.close()
+
+    for host, (hits, misses) in http_transport.stats().items():
+        logging.debug(f'Orpheus: connection pool for {host}: {hits} reused, {misses} new connections')
+
+    advanced_settings = orpheus_session.settings['global']['advanced']
+    if advanced_settings['performance_report']:
+        oprinter.blank()
+        for line in perf.report().splitlines(): oprinter.oprint(line, drop_level=1)
+    if advanced_settings['performance_report_json']:
+        perf.write_json(advanced_settings['performance_report_json'])
+    perf.reset()
+    if orpheus_session.settings['global']['metrics']['textfile']:
+        metrics.write_textfile(orpheus_session.settings['global']['metrics']['textfile'])
+
+
+@dataclass
+class WatchedSource:
+    url: str
+    service_name: str
+    media: MediaIdentification
+    interval: int  # Seconds between checks
+
+
+def orpheus_core_watch(orpheus_session: Orpheus, sources: list, third_party_modules, separate_download_module, output_path):
+    # Runs forever, modules stay loaded and logged in between checks. Every check is a sync, so a source that didn't
+    # change costs one metadata request and only new tracks or albums are downloaded
+    jitter = orpheus_session.settings['global']['watch']['jitter']
+    downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
+    downloader.sync_store = SyncStore(orpheus_session.settings['global']['sync']['database'])
+
+    # The first checks are spread out too, so every source of a big follow list isn't checked at the same moment
+    schedule = [(time.time() + random.uniform(0, jitter * source.interval), index) for index, source in enumerate(sources)]
+    heapq.heapify(schedule)
+    oprinter.oprint(f'Watching {len(sources)} sources', drop_level=1)
+
+    metrics_settings = orpheus_session.settings['global']['metrics']
+    if metrics_settings['prometheus_port']:
+        metrics.serve(metrics_settings['prometheus_port'], metrics_settings['prometheus_address'])
+        oprinter.oprint(f'Serving metrics on http://{metrics_settings["prometheus_address"]}:{metrics_settings["prometheus_port"]}/metrics', drop_level=1)
+
+    while schedule:
+        due, index = heapq.heappop(schedule)
+        time.sleep(max(due - time.time(), 0))
+        source: WatchedSource = sources[index]
+
+        oprinter.blank()
+        oprinter.oprint(f'{datetime.now():%Y-%m-%d %H:%M:%S} Checking {source.url}', drop_level=1)
+        try:
+            orpheus_core_download(orpheus_session, {source.service_name: [source.media]}, third_party_modules, separate_download_module,
+                                  output_path, downloader=downloader, retry=False)
+            # Failed tracks are retried between checks, once their delay has passed
+            next_retry = downloader.retry_queue.next_due()
+            if next_retry is not None and next_retry <= time.time():
+                orpheus_core_download(orpheus_session, {}, third_party_modules, separate_download_module, output_path, downloader=downloader)
+        except Exception:
+            if orpheus_session.settings['global']['advanced']['debug_mode']: raise
+            oprinter.oprint(f'Warning: checking {source.url} failed: {sys.exc_info()[1]!s}', drop_level=1)
+
+        heapq.heappush(schedule, (time.time() + source.interval * random.uniform(1 - jitter, 1 + jitter), index))
+
+
+def orpheus_core_worker(orpheus_session: Orpheus, queue: JobQueue, third_party_modules, separate_download_module, output_path, sync=False):
+    # Takes jobs from the queue until none are left, with the session's modules staying loaded and logged in
+    # between jobs. Returns once nothing is pending and no other worker holds a lease that could still expire
+    owner = f'{socket.gethostname()}-{os.getpid()}'
+    set_transfer_settings(temp_folder=os.path.join('temp', owner))  # orpheus_core_download removes it after every job
+    downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
+    if sync: downloader.sync_store = SyncStore(orpheus_session.settings['global']['sync']['database'])
+
+    while True:
+        job = queue.claim(owner)
+        if not job:
+            if not queue.counts()['leased']:
+                # One retry pass per worker once the queue is done, the retry queue hands every failed track to one worker only
+                orpheus_core_download(orpheus_session, {}, third_party_modules, separate_download_module, output_path, downloader=downloader)
+                break
+            time.sleep(min(queue.lease_seconds / 10, 5))
+            continue
+
+        # The lease is renewed in the background, a single album can take longer than the lease
+        finished = threading.Event()
+        def renew_lease(job=job):
+            while not finished.wait(queue.lease_seconds / 3) and queue.renew(job, owner): pass
+        threading.Thread(target=renew_lease, name='JobLease', daemon=True).start()
+
+        try:
+            orpheus_core_download(orpheus_session, {job.service: [job.media]}, third_party_modules, separate_download_module,
+                                  output_path, downloader=downloader, retry=False)
+        except Exception:
+            if orpheus_session.settings['global']['advanced']['debug_mode']: raise
+            queue.fail(job, owner, str(sys.exc_info()[1]))
+            print(f'Warning: {job.service} {job.media.media_type.name} {job.media.media_id} failed: {sys.exc_info()[1]!s}', file=sys.stderr)
+        else:
+            queue.complete(job, owner)
+        finally:
+            finished.set()
+    downloader.artwork_processor.shutdown()
+
+
+def _worker_process(private_mode, queue_location, third_party_modules, separate_download_module, output_path, sync, ready):
+    orpheus_session = Orpheus(private_mode)
+    # Workers share the terminal, so only errors are printed unless another output format was set
+    if type(oprinter.backend) is PrettyBackend: oprinter.set_backend(QuietBackend())
+    sharding_settings = orpheus_session.settings['global']['sharding']
+    queue = JobQueue(queue_location, sharding_settings['lease_seconds'], sharding_settings['max_attempts'])
+    ready.set()
+    orpheus_core_worker(orpheus_session, queue, third_party_modules, separate_download_module, output_path, sync)
+    queue.close()
+
+
+def orpheus_core_shard(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path, workers,
+                       sync=False, private_mode=False):
+    # Queues the media and splits it across worker processes, each with its own Orpheus session and loaded modules.
+    # With no workers the media is only queued, for "orpheus.py worker" processes on this or other hosts
+    sharding_settings = orpheus_session.settings['global']['sharding']
+    queue = JobQueue(sharding_settings['queue'], sharding_settings['lease_seconds'], sharding_settings['max_attempts'])
+    for service, items in media_to_download.items():
+        for media in items: queue.add(service, media)
+    print(f'Queued {sum(len(i) for i in media_to_download.values())} items in {sharding_settings["queue"]}')
+    if not workers: return
+
+    context = multiprocessing.get_context('spawn')  # Forking would copy this process' threads and connections
+    processes = []
+    for index in range(workers):
+        ready = context.Event()
+        process = context.Process(target=_worker_process, name=f'OrpheusWorker-{index}', args=(private_mode, sharding_settings['queue'],
+                                  third_party_modules, separate_download_module, output_path, sync, ready))
+        process.start()
+        # Workers are started one at a time, as each one rewrites settings.json and loginstorage.bin and may log in
+        while process.is_alive() and not ready.wait(0.5): pass
+        processes.append(process)
+
+    last_counts = None
+    while any(process.is_alive() for process in processes):
+        counts = queue.counts()
+        if counts != last_counts:
+            oprinter.oprint(f'{counts["done"]} done, {counts["leased"]} downloading, {counts["pending"]} waiting, {counts["failed"]} failed')
+            last_counts = counts
+        time.sleep(2)
+    for process in processes: process.join()
+
+    failed = queue.failed()
+    if failed:
+        print(f'\n{len(failed)} items failed:')
+        for service, media_type, media_id, error in failed: print(f'\t{service} {media_type} {media_id}: {error}')
+    queue.close()
@@ -0,0 +1,159 @@
+import os, sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from mutagen import File, MutagenError
+from mutagen.id3 import ID3
+from mutagen.mp4 import MP4Tags
+
+from utils.models import CodecEnum, ContainerEnum, TrackInfo, codec_data
+
+
+audio_extensions = {'.' + i.name for i in ContainerEnum}
+
+# Tag keys per tag format, in the order they are tried
+id3_library_keys = {'isrc': 'TSRC', 'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'track_number': 'TRCK', 'disc_number': 'TPOS'}
+mp4_library_keys = {'isrc': '----:com.apple.itunes:isrc', 'title': '©nam', 'artist': '©art', 'album': '©alb', 'track_number': 'trkn', 'disc_number': 'disk'}
+vorbis_library_keys = {'isrc': 'isrc', 'title': 'title', 'artist': 'artist', 'album': 'album', 'track_number': 'tracknumber', 'disc_number': 'discnumber'}
+
+
+def _first(value):
+    if isinstance(value, list): value = value[0] if value else None
+    if hasattr(value, 'text'): value = value.text[0] if value.text else None  # ID3 frames
+    if isinstance(value, tuple): value = value[0]  # MP4 trkn and disk pairs
+    if isinstance(value, bytes): value = value.decode('utf-8', 'ignore')  # MP4 freeform atoms
+    return str(value) if value is not None else None
+
+
+def _number(value):
+    try:
+        return int(value.split('/')[0]) if value else None
+    except ValueError:
+        return None
+
+
+def read_library_tags(file_location):
+    # Runs in the scan's worker processes, returns None for files that can't be read
+    try:
+        audio = File(file_location)
+    except (MutagenError, OSError):
+        return None
+    if audio is None:
+        return None
+
+    tags = audio.tags
+    if isinstance(tags, ID3):
+        fields = {k: _first(tags.get(v)) for k, v in id3_library_keys.items()}
+    elif isinstance(tags, MP4Tags):
+        # Freeform atom names are case sensitive in the file but not in practice, so they are matched case insensitively
+        lowered = {k.lower(): v for k, v in tags.items()}
+        fields = {k: _first(lowered.get(v)) for k, v in mp4_library_keys.items()}
+    elif tags is not None:
+        fields = {k: _first(tags.get(v)) for k, v in vorbis_library_keys.items()}
+    else:
+        fields = dict.fromkeys(vorbis_library_keys)
+
+    fields['track_number'], fields['disc_number'] = _number(fields['track_number']), _number(fields['disc_number'])
+    fields['isrc'] = fields['isrc'].upper() if fields['isrc'] else None
+    return fields
+
+
+def _read_library_tags(file_location):
+    # A malformed tag is a problem of that file only, it must not abort the whole scan
+    try:
+        return read_library_tags(file_location)
+    except Exception:
+        return None
+
+
+class LibraryIndex:
+    # SQLite index of every audio file in the library, filled by "library scan" and by the downloader itself.
+    # Rows are keyed by absolute path, the service columns are only known for files Orpheus downloaded
+    def __init__(self, database_location):
+        os.makedirs(os.path.dirname(os.path.abspath(database_location)), exist_ok=True)
+        self.connection = sqlite3.connect(database_location, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, isrc TEXT, title TEXT, artist TEXT, album TEXT,
+                track_number INTEGER, disc_number INTEGER, service TEXT, track_id TEXT, codec TEXT)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS files_isrc ON files (isrc)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS files_track ON files (service, track_id, codec)')
+
+    def _existing(self, rows):
+        # Rows whose file has since disappeared are dropped instead of being returned
+        for path, in rows:
+            if os.path.isfile(path): return path
+            with self.lock, self.connection:
+                self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+        return None
+
+    def find(self, service: str, track_id: str, isrc: str = None, codec: CodecEnum = None):
+        # Returns the path of a file holding this track, by service id first and ISRC second, whatever its path.
+        # ISRCs are only matched in the given codec, as the same recording from any service or in any format shares
+        # its ISRC. Scanned files have no codec, those match by their container's extension
+        codec_filter, codec_value = (' AND codec = ?', (codec.name,)) if codec else ('', ())
+        with self.lock:
+            rows = self.connection.execute(f'SELECT path FROM files WHERE service = ? AND track_id = ?{codec_filter}',
+                                           (service, str(track_id), *codec_value)).fetchall()
+            if isrc and codec:
+                rows += self.connection.execute('SELECT path FROM files WHERE isrc = ? AND (codec = ? OR (codec IS NULL AND path LIKE ?))',
+                                                (isrc.upper(), codec.name, '%.' + codec_data[codec].container.name)).fetchall()
+        return self._existing(rows)
+
+    def record(self, file_location, service: str, track_id: str, codec: CodecEnum, track_info: TrackInfo):
+        stat = os.stat(file_location)
+        tags = track_info.tags
+        with self.lock, self.connection:
+            self.connection.execute('''INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+                os.path.abspath(file_location), stat.st_mtime_ns, stat.st_size, tags.isrc.upper() if tags.isrc else None,
+                track_info.name, track_info.artists[0] if track_info.artists else None, track_info.album,
+                tags.track_number, tags.disc_number, service, str(track_id), codec.name))
+
+    def scan(self, root, workers=None):
+        # Only files that are new or whose mtime changed are read again, returns (read, unchanged, removed, unreadable)
+        # where unreadable are the paths of files that couldn't be read, which are left out of the index
+        root = os.path.abspath(root)
+        found, unreadable = {}, []
+        for directory, _, files in os.walk(root):
+            for file in files:
+                if os.path.splitext(file)[1].lower() in audio_extensions:
+                    path = os.path.join(directory, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:  # Broken symlinks
+                        unreadable.append(path)
+                        continue
+                    found[path] = (stat.st_mtime_ns, stat.st_size)
+
+        # Everything below root as a range instead of LIKE, where _ and % in the path would be wildcards
+        prefix = root.rstrip(os.sep) + os.sep
+        with self.lock:
+            indexed = dict(self.connection.execute('SELECT path, mtime_ns FROM files WHERE path >= ? AND path < ?',
+                                                   (prefix, prefix[:-1] + chr(ord(os.sep) + 1))))
+        changed = [path for path, (mtime_ns, _) in found.items() if indexed.get(path) != mtime_ns]
+        removed = [(path,) for path in indexed if path not in found]
+
+        rows = []
+        if changed:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for path, fields in zip(changed, executor.map(_read_library_tags, changed, chunksize=32)):
+                    if fields is None:
+                        unreadable.append(path)
+                        continue
+                    rows.append((path, *found[path], fields['isrc'], fields['title'], fields['artist'], fields['album'],
+                                 fields['track_number'], fields['disc_number']))
+
+        with self.lock, self.connection:
+            # The service columns of rows written by the downloader are kept, tags can't tell where a file came from
+            self.connection.executemany('''INSERT INTO files (path, mtime_ns, size, isrc, title, artist, album, track_number, disc_number)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size,
+                isrc = excluded.isrc, title = excluded.title, artist = excluded.artist, album = excluded.album,
+                track_number = excluded.track_number, disc_number = excluded.disc_number''', rows)
+            self.connection.executemany('DELETE FROM files WHERE path = ?', removed)
+        return len(rows), len(found) - len(changed), len(removed), unreadable
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
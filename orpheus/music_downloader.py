@@ -1,17 +1,33 @@
-import logging, os, ffmpeg, sys
+import logging, os, ffmpeg, sys, time
 import shutil
 import unicodedata
 from dataclasses import asdict
+from threading import Lock
 from time import strftime, gmtime
 
 from ffmpeg import Error
-
-from orpheus.tagging import tag_file
+from mutagen.flac import Picture
+
+from orpheus.artwork import ArtworkProcessor, ArtworkVariant, CoverMatcher
+from orpheus.library import LibraryIndex
+from orpheus.retry import RetryQueue, TrackFailure, is_transient
+from orpheus.sync import M3UPlaylist
+from orpheus.tagging import CoverPayloadCache, estimate_tag_size, tag_file
+from utils.circuitbreaker import CircuitBreakers
+from utils.metrics import in_flight, module_calls_total
 from utils.models import *
+from utils.perf import perf
+from utils.progress import progress
+from utils.segments import download_segmented
+from utils.singleflight import SingleFlight
 from utils.utils import *
 from utils.exceptions import *
 
 
+# Containers ffmpeg can decode from a pipe, MP4 needs seeking as the moov atom may be at the end
+streamable_containers = {ContainerEnum.flac, ContainerEnum.wav, ContainerEnum.mp3, ContainerEnum.ogg, ContainerEnum.opus}
+
+
 def beauty_format_seconds(seconds: int) -> str:
     time_data = gmtime(seconds)
 
@@ -37,38 +53,70 @@ class Downloader:
         self.loaded_modules = module_controls['loaded_modules']
         self.load_module = module_controls['module_loader']
         self.global_settings = settings
+        self.artwork_processor = ArtworkProcessor()
+        self.cover_cache = CoverPayloadCache()
+        self.module_flights = SingleFlight()
+        self.library = LibraryIndex(settings['library']['database']) if settings['library']['enabled'] else None
+        self.sync_store = None  # Set to a SyncStore in sync mode
+        retry_settings = settings['retry']
+        self.retry_queue = RetryQueue(retry_settings['database'], retry_settings['max_attempts'], retry_settings['backoff'], retry_settings['max_backoff'])
+        self.failed_tracks = []  # Permanent failures of this run, for the report at the end
+        breaker_settings = settings['circuit_breakers']
+        self.circuit_breakers = CircuitBreakers(breaker_settings['failure_threshold'], breaker_settings['slow_seconds'], breaker_settings['cooldown'])
 
         self.oprinter = oprinter
         self.print = self.oprinter.oprint
         self.set_indent_number = self.oprinter.set_indent_number
 
-    def search_by_tags(self, module_name, track_info: TrackInfo):
-        return self.loaded_modules[module_name].search(DownloadTypeEnum.track, f'{track_info.name} {" ".join(track_info.artists)}', track_info=track_info)
-
-    def _add_track_m3u_playlist(self, m3u_playlist: str, track_info: TrackInfo, track_location: str):
-        if self.global_settings['playlist']['extended_m3u']:
-            with open(m3u_playlist, 'a', encoding='utf-8') as f:
-                # if no duration exists default to -1
-                duration = track_info.duration if track_info.duration else -1
-                # write the extended track header
-                f.write(f'#EXTINF:{duration}, {track_info.artists[0]} - {track_info.name}\n')
-
-        with open(m3u_playlist, 'a', encoding='utf-8') as f:
-            if self.global_settings['playlist']['paths_m3u'] == "absolute":
-                # add the absolute paths to the playlist
-                f.write(f'{os.path.abspath(track_location)}\n')
-            else:
-                # add the relative paths to the playlist by subtracting the track_location with the m3u_path
-                f.write(f'{os.path.relpath(track_location, os.path.dirname(m3u_playlist))}\n')
-
-            # add an extra new line to the extended format
-            f.write('\n') if self.global_settings['playlist']['extended_m3u'] else None
+    def call_module(self, module_name, function_name, *args, **kwargs):
+        # Identical module calls made at the same time (album info, searches, lyrics) share one request
+        key = (module_name, function_name, repr(args), repr(sorted(kwargs.items())))
+        module_calls_total.inc(module=module_name, function=function_name)
+        with in_flight.track(kind='module_call'):
+            return self.module_flights.do(key, getattr(self.loaded_modules[module_name], function_name), *args, **kwargs)
+
+    def call_auxiliary(self, module_name, mode: ModuleModes, function_name, *args, **kwargs):
+        # Lyrics, credits and cover lookups go through a circuit breaker per module and mode, so a provider that keeps
+        # failing or is too slow is skipped for a while instead of holding up every track. Raises CircuitOpenError then
+        breaker = self.circuit_breakers.get(module_name, mode.name)
+        if not breaker.allow():
+            raise CircuitOpenError(f'{module_name} is skipped for {mode.name} for another {beauty_format_seconds(breaker.remaining())}')
+        start, failed = time.perf_counter(), True
+        try:
+            result = self.call_module(module_name, function_name, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            if breaker.record(time.perf_counter() - start, failed):
+                self.print(f'Warning: {mode.name} lookups with {module_name} failed or were too slow {breaker.failures} times in a row, '
+                           f'skipping them for {beauty_format_seconds(breaker.cooldown)}')
+
+    def search_by_tags(self, module_name, track_info: TrackInfo, mode: ModuleModes = None):
+        query = f'{track_info.name} {" ".join(track_info.artists)}'
+        if mode: return self.call_auxiliary(module_name, mode, 'search', DownloadTypeEnum.track, query, track_info=track_info)
+        return self.call_module(module_name, 'search', DownloadTypeEnum.track, query, track_info=track_info)
+
+    def _print_progress(self, item, index, total):
+        self.oprinter.blank()
+        self.print(f'{item} {index}/{total}', drop_level=1)
+        self.oprinter.event('progress', item=item.lower(), index=index, total=total)
+
+    def _add_track_m3u_playlist(self, m3u_playlist: M3UPlaylist, track_index: int, track_info: TrackInfo, track_location: str):
+        m3u_playlist.add(track_index, track_location, track_info.duration, f'{track_info.artists[0]} - {track_info.name}')
 
     def download_playlist(self, playlist_id, custom_module=None, extra_kwargs={}):
         self.set_indent_number(1)
 
         playlist_info: PlaylistInfo = self.service.get_playlist_info(playlist_id, **extra_kwargs)
         self.print(f'=== Downloading playlist {playlist_info.name} ({playlist_id}) ===', drop_level=1)
+
+        # Playlists downloaded through another module are synced separately, their tracks come from a different service
+        sync_service = self.service_name + (f'>{custom_module}' if custom_module else '')
+        synced_snapshot, synced_items = self.sync_store.get(sync_service, 'playlist', playlist_id) if self.sync_store else (None, None)
+        if synced_items is not None and self._playlist_unchanged(playlist_info, synced_snapshot, synced_items):
+            self.print('Playlist unchanged since the last sync')
+            self.print(f'=== Playlist {playlist_info.name} skipped ===', drop_level=1)
+            return
         self.print(f'Playlist creator: {playlist_info.creator}' + (f' ({playlist_info.creator_id})' if playlist_info.creator_id else ''))
         if playlist_info.release_year: self.print(f'Playlist creation year: {playlist_info.release_year}')
         if playlist_info.duration: self.print(f'Duration: {beauty_format_seconds(playlist_info.duration)}')
@@ -83,33 +131,37 @@ class Downloader:
         playlist_path = fix_byte_limit(playlist_path) + '/'
         os.makedirs(playlist_path, exist_ok=True)
         
+        cover_future = None
         if playlist_info.cover_url:
             self.print('Downloading playlist cover')
-            download_file(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+            cover_future = self._download_artwork(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}')
         
         if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated playlist cover')
-            download_file(playlist_info.animated_cover_url, playlist_path + 'cover.mp4', enable_progress_bar=True)
+            self._download_optional('animated playlist cover', playlist_info.animated_cover_url, playlist_path + 'cover.mp4', enable_progress_bar=self.oprinter.progress_bars)
         
         if playlist_info.description:
             with open(playlist_path + 'description.txt', 'w', encoding='utf-8') as f: f.write(playlist_info.description)
 
-        m3u_playlist_path = None
-        if self.global_settings['playlist']['save_m3u']:
-            if self.global_settings['playlist']['paths_m3u'] not in {"absolute", "relative"}:
-                raise ValueError(f'Invalid value for paths_m3u: "{self.global_settings["playlist"]["paths_m3u"]}",'
-                                 f' must be either "absolute" or "relative"')
-
-            m3u_playlist_path = playlist_path + f'{playlist_tags["name"]}.m3u'
-
-            # create empty file
-            with open(m3u_playlist_path, 'w', encoding='utf-8') as f:
-                f.write('')
-
-            # if extended format add the header
-            if self.global_settings['playlist']['extended_m3u']:
-                with open(m3u_playlist_path, 'a', encoding='utf-8') as f:
-                    f.write('#EXTM3U\n\n')
+        if self.global_settings['playlist']['save_m3u'] and self.global_settings['playlist']['paths_m3u'] not in {"absolute", "relative"}:
+            raise ValueError(f'Invalid value for paths_m3u: "{self.global_settings["playlist"]["paths_m3u"]}",'
+                             f' must be either "absolute" or "relative"')
+        # Always collected, as sync mode needs to know which tracks ended up where even without an m3u file
+        m3u_playlist = M3UPlaylist(playlist_path + f'{playlist_tags["name"]}.m3u', self.global_settings['playlist']['extended_m3u'],
+                                   self.global_settings['playlist']['paths_m3u'] == 'absolute')
+
+        # In sync mode tracks from the last sync are only added to the m3u, everything else is downloaded
+        tracks_to_download = list(enumerate(playlist_info.tracks, start=1))
+        if synced_items is not None:
+            synced_tracks = {str(track_id): entry for track_id, *entry in synced_items}
+            tracks_to_download = []
+            for index, track_id in enumerate(playlist_info.tracks, start=1):
+                if str(track_id) in synced_tracks and os.path.isfile(synced_tracks[str(track_id)][0]):
+                    m3u_playlist.add(index, *synced_tracks[str(track_id)])
+                else:
+                    tracks_to_download.append((index, track_id))
+            self.print(f'Tracks added since the last sync: {len(tracks_to_download)!s}')
+        progress.add_tracks(len(tracks_to_download))
 
         tracks_errored = set()
         if custom_module:
@@ -119,45 +171,79 @@ class Downloader:
             self.print(f'Service used for downloading: {self.module_settings[custom_module].service_name}')
             original_service = str(self.service_name)
             self.load_module(custom_module)
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
+            for index, track_id in tracks_to_download:
                 self.set_indent_number(2)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
+                self._print_progress('Track', index, number_of_tracks)
                 quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
                 codec_options = CodecOptions(
                     spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
                     proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
                 )
-                track_info: TrackInfo = self.loaded_modules[original_service].get_track_info(track_id, quality_tier, codec_options, **playlist_info.track_extra_kwargs)
-                
+                try:
+                    track_info: TrackInfo = self.loaded_modules[original_service].get_track_info(track_id, quality_tier, codec_options, **playlist_info.track_extra_kwargs)
+                    results = self.search_by_tags(custom_module, track_info)
+                except Exception as e:
+                    # Nothing to retry with yet, as it isn't known which service the track would be downloaded from
+                    if self.global_settings['advanced']['debug_mode']: raise
+                    self.print(f'Warning: Track info failed: {e!s}')
+                    self.print(f'=== Track {track_id} failed ===', drop_level=1)
+                    self.failed_tracks.append(TrackFailure(original_service, str(track_id), 'metadata', type(e).__name__, str(e), 1, time.time(), True))
+                    perf.count('tracks_failed')
+                    continue
+
                 self.service = self.loaded_modules[custom_module]
                 self.service_name = custom_module
-                results = self.search_by_tags(custom_module, track_info)
                 track_id_new = results[0].result_id if len(results) else None
                 
                 if track_id_new:
-                    self.download_track(track_id_new, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=results[0].extra_kwargs)
+                    self.download_track(track_id_new, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist, extra_kwargs=results[0].extra_kwargs)
                 else:
                     tracks_errored.add(f'{track_info.name} - {track_info.artists[0]}')
                     if ModuleModes.download in self.module_settings[original_service].module_supported_modes:
                         self.service = self.loaded_modules[original_service]
                         self.service_name = original_service
                         self.print(f'Track {track_info.name} not found, using the original service as a fallback', drop_level=1)
-                        self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs)
+                        self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist, extra_kwargs=playlist_info.track_extra_kwargs)
                     else:
                         self.print(f'Track {track_info.name} not found, skipping')
         else:
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
+            for index, track_id in tracks_to_download:
                 self.set_indent_number(2)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs)
+                self._print_progress('Track', index, number_of_tracks)
+                self.download_track(track_id, album_location=playlist_path, track_index=index, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist, extra_kwargs=playlist_info.track_extra_kwargs)
+
+        if self.global_settings['playlist']['save_m3u']:
+            m3u_playlist.write()
+        if self.sync_store:
+            self._sync_playlist(sync_service, playlist_id, playlist_info, synced_items, m3u_playlist, playlist_path)
 
         self.set_indent_number(1)
+        self._wait_for_artwork([cover_future])
         self.print(f'=== Playlist {playlist_info.name} downloaded ===', drop_level=1)
+        self.cover_cache.clear()
 
         if tracks_errored: logging.debug('Failed tracks: ' + ', '.join(tracks_errored))
 
+    @staticmethod
+    def _playlist_unchanged(playlist_info: PlaylistInfo, synced_snapshot, synced_items):
+        if playlist_info.snapshot_id:
+            return playlist_info.snapshot_id == synced_snapshot
+        # Without a snapshot id the track list is compared instead, failed or deleted tracks count as changes
+        return [str(i) for i in playlist_info.tracks] == [str(i[0]) for i in synced_items] and all(os.path.isfile(i[1]) for i in synced_items)
+
+    def _sync_playlist(self, service_name, playlist_id, playlist_info: PlaylistInfo, synced_items, m3u_playlist: M3UPlaylist, playlist_path):
+        items = [[playlist_info.tracks[index - 1], *entry] for index, entry in sorted(m3u_playlist.entries.items())]
+        if synced_items and self.global_settings['sync']['remove_deleted_tracks']:
+            # Only files inside the playlist's own folder are deleted, tracks stored elsewhere may belong to albums
+            current_tracks = {str(i) for i in playlist_info.tracks}
+            playlist_folder = os.path.abspath(playlist_path)
+            for track_id, location, *_ in synced_items:
+                if str(track_id) not in current_tracks and os.path.commonpath([playlist_folder, location]) == playlist_folder:
+                    self.print(f'Removing track {track_id}, it was removed from the playlist')
+                    silentremove(location)
+                    silentremove(integrity_sidecar_location(location))
+        self.sync_store.put(service_name, 'playlist', playlist_id, playlist_info.snapshot_id, items)
+
     @staticmethod
     def _get_artist_initials_from_name(album_info: AlbumInfo) -> str:
         # Remove "the" from the inital string
@@ -189,17 +275,20 @@ class Downloader:
         return album_path
 
     def _download_album_files(self, album_path: str, album_info: AlbumInfo):
+        # Returns the future of the album cover's resize job, if there is one
+        cover_future = None
         if album_info.cover_url:
             self.print('Downloading album cover')
-            download_file(album_info.cover_url, f'{album_path}cover.{album_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+            cover_future = self._download_artwork(album_info.cover_url, f'{album_path}cover.{album_info.cover_type.name}')
 
         if album_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated album cover')
-            download_file(album_info.animated_cover_url, album_path + 'cover.mp4', enable_progress_bar=True)
+            self._download_optional('animated album cover', album_info.animated_cover_url, album_path + 'cover.mp4', enable_progress_bar=self.oprinter.progress_bars)
 
         if album_info.description:
             with open(album_path + 'description.txt', 'w', encoding='utf-8') as f:
                 f.write(album_info.description)  # Also add support for this with singles maybe?
+        return cover_future
 
     def download_album(self, album_id, artist_name='', path=None, indent_level=1, extra_kwargs={}):
         self.set_indent_number(indent_level)
@@ -228,23 +317,27 @@ class Downloader:
 
             if album_info.booklet_url and not os.path.exists(album_path + 'Booklet.pdf'):
                 self.print('Downloading booklet')
-                download_file(album_info.booklet_url, album_path + 'Booklet.pdf')
+                self._download_optional('booklet', album_info.booklet_url, album_path + 'Booklet.pdf')
             
-            cover_temp_location = download_to_temp(album_info.all_track_cover_jpg_url) if album_info.all_track_cover_jpg_url else ''
+            # Without it every track downloads its own cover
+            cover_temp_location = (self._download_optional('album cover', album_info.all_track_cover_jpg_url) or '') if album_info.all_track_cover_jpg_url else ''
 
             # Download booklet, animated album cover and album cover if present
-            self._download_album_files(album_path, album_info)
+            cover_future = self._download_album_files(album_path, album_info)
 
+            progress.add_tracks(number_of_tracks)
             for index, track_id in enumerate(album_info.tracks, start=1):
                 self.set_indent_number(indent_level + 1)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
+                self._print_progress('Track', index, number_of_tracks)
                 self.download_track(track_id, album_location=album_path, track_index=index, number_of_tracks=number_of_tracks, main_artist=artist_name, cover_temp_location=cover_temp_location, indent_level=indent_level+1, extra_kwargs=album_info.track_extra_kwargs)
 
             self.set_indent_number(indent_level)
+            self._wait_for_artwork([cover_future])
             self.print(f'=== Album {album_info.name} downloaded ===', drop_level=1)
             if cover_temp_location: silentremove(cover_temp_location)
+            self.cover_cache.clear()
         elif number_of_tracks == 1:
+            progress.add_tracks(1)
             self.download_track(album_info.tracks[0], album_location=path, number_of_tracks=1, main_artist=artist_name, indent_level=indent_level, extra_kwargs=album_info.track_extra_kwargs)
 
         return album_info.tracks
@@ -255,46 +348,77 @@ class Downloader:
 
         self.set_indent_number(1)
 
-        number_of_albums = len(artist_info.albums)
+        # In sync mode only albums and tracks released (or credited) since the last sync are downloaded
+        synced_snapshot, synced_items = self.sync_store.get(self.service_name, 'artist', artist_id) if self.sync_store else (None, None)
+        synced_albums, synced_tracks = set(synced_items['albums']) if synced_items else set(), set(synced_items['tracks']) if synced_items else set()
+        # Without a snapshot id the album and track lists are compared instead
+        if synced_items is not None and (artist_info.snapshot_id == synced_snapshot if artist_info.snapshot_id else
+                                         synced_albums.issuperset(artist_info.albums) and synced_tracks.issuperset(artist_info.tracks)):
+            self.print(f'=== Artist {artist_name} unchanged since the last sync ===', drop_level=1)
+            return
+        albums_to_download = [i for i in artist_info.albums if i not in synced_albums]
+
+        number_of_albums = len(albums_to_download)
         number_of_tracks = len(artist_info.tracks)
 
         self.print(f'=== Downloading artist {artist_name} ({artist_id}) ===', drop_level=1)
+        if synced_items is not None: self.print(f'Albums already synced: {len(artist_info.albums) - number_of_albums!s}')
         if number_of_albums: self.print(f'Number of albums: {number_of_albums!s}')
         if number_of_tracks: self.print(f'Number of tracks: {number_of_tracks!s}')
         self.print(f'Service: {self.module_settings[self.service_name].service_name}')
         artist_path = self.path + sanitise_name(artist_name) + '/'
 
         self.set_indent_number(2)
-        tracks_downloaded = []
-        for index, album_id in enumerate(artist_info.albums, start=1):
-            print()
-            self.print(f'Album {index}/{number_of_albums}', drop_level=1)
+        tracks_downloaded = list(synced_tracks)
+        for index, album_id in enumerate(albums_to_download, start=1):
+            self._print_progress('Album', index, number_of_albums)
             tracks_downloaded += self.download_album(album_id, artist_name=artist_name, path=artist_path, indent_level=2, extra_kwargs=artist_info.album_extra_kwargs)
+            synced_albums.add(album_id)
 
         self.set_indent_number(2)
         skip_tracks = self.global_settings['artist_downloading']['separate_tracks_skip_downloaded']
         tracks_to_download = [i for i in artist_info.tracks if (i not in tracks_downloaded and skip_tracks) or not skip_tracks]
+        if synced_items is not None: tracks_to_download = [i for i in tracks_to_download if i not in synced_tracks]
         number_of_tracks_new = len(tracks_to_download)
+        progress.add_tracks(number_of_tracks_new)
         for index, track_id in enumerate(tracks_to_download, start=1):
-            print()
-            self.print(f'Track {index}/{number_of_tracks_new}', drop_level=1)
+            self._print_progress('Track', index, number_of_tracks_new)
             self.download_track(track_id, album_location=artist_path, main_artist=artist_name, number_of_tracks=1, indent_level=2, extra_kwargs=artist_info.track_extra_kwargs)
 
+        if self.sync_store:
+            self.sync_store.put(self.service_name, 'artist', artist_id, artist_info.snapshot_id,
+                                {'albums': list(synced_albums), 'tracks': list(dict.fromkeys(tracks_downloaded + tracks_to_download))})
+
         self.set_indent_number(1)
         tracks_skipped = number_of_tracks - number_of_tracks_new
         if tracks_skipped > 0: self.print(f'Tracks skipped: {tracks_skipped!s}', drop_level=1)
         self.print(f'=== Artist {artist_name} downloaded ===', drop_level=1)
 
-    def download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist=None, extra_kwargs={}):
+    def download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist=None, extra_kwargs={}, track_info=None):
+        # Returns a TrackFailure if the track failed. track_info is only passed when retrying, to skip get_track_info
         quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
         codec_options = CodecOptions(
             spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
             proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
         )
-        track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **extra_kwargs)
+        # Everything needed to call download_track again for a retry, the cover and m3u playlist aren't kept
+        retry_context = {'album_location': album_location, 'main_artist': main_artist, 'track_index': track_index, 'number_of_tracks': number_of_tracks,
+                         'indent_level': indent_level, 'extra_kwargs': extra_kwargs, 'download_mode': self.download_mode.name, 'path': self.path}
+        track_span = perf.start('track', self.service_name)
+        if not track_info:
+            try:
+                with perf.span('metadata', self.service_name):
+                    track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **extra_kwargs)
+            except Exception as e:
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.set_indent_number(indent_level)
+                self.print(f'Warning: Track info failed: {e!s}')
+                return self._track_failed(track_id, 'metadata', e, retry_context, track_span)
         
         if main_artist.lower() not in [i.lower() for i in track_info.artists] and self.global_settings['advanced']['ignore_different_artists'] and self.download_mode is DownloadTypeEnum.artist:
            self.print('Track is not from the correct artist, skipping', drop_level=1)
+           track_span.finish()  # Skipped tracks still end their span, so every stage_start gets its stage_end
+           perf.count('tracks_skipped')
            return
 
         if not self.global_settings['formatting']['force_album_format']:
@@ -314,6 +438,7 @@ class Downloader:
 
         self.set_indent_number(indent_level)
         self.print(f'=== Downloading track {track_info.name} ({track_id}) ===', drop_level=1)
+        self.oprinter.event('track_start', track_id=track_id, name=track_info.name, service=self.service_name)
 
         if self.download_mode is not DownloadTypeEnum.album and track_info.album: self.print(f'Album: {track_info.album} ({track_info.album_id})')
         if self.download_mode is not DownloadTypeEnum.artist: self.print(f'Artists: {", ".join(track_info.artists)} ({track_info.artist_id})')
@@ -330,23 +455,23 @@ class Downloader:
         # Check if track_info returns error, display it and return this function to not download the track
         if track_info.error:
             self.print(track_info.error)
-            self.print(f'=== Track {track_id} failed ===', drop_level=1)
-            return
+            return self._track_failed(track_id, 'metadata', track_info.error, retry_context, track_span, transient=False)
 
         album_location = album_location.replace('\\', '/')
 
         # Ignores "single_full_path_format" and just downloads every track as an album
+        album_cover_future = None
         if self.global_settings['formatting']['force_album_format'] and self.download_mode in {
             DownloadTypeEnum.track, DownloadTypeEnum.playlist}:
             # Fetch every needed album_info tag and create an album_location
-            album_info: AlbumInfo = self.service.get_album_info(track_info.album_id)
+            album_info: AlbumInfo = self.call_module(self.service_name, 'get_album_info', track_info.album_id)
             # Save the playlist path to save all the albums in the playlist path
             path = self.path if album_location == '' else album_location
             album_location = self._create_album_location(path, track_info.album_id, album_info)
             album_location = album_location.replace('\\', '/')
 
             # Download booklet, animated album cover and album cover if present
-            self._download_album_files(album_location, album_info)
+            album_cover_future = self._download_album_files(album_location, album_info)
 
         if self.download_mode is DownloadTypeEnum.track and not self.global_settings['formatting']['force_album_format']:  # Python 3.10 can't become popular sooner, ugh
             track_location_name = self.path + self.global_settings['formatting']['single_full_path_format'].format(**track_tags)
@@ -371,26 +496,59 @@ class Downloader:
         check_codec = conversions[track_info.codec] if track_info.codec in conversions else track_info.codec
         check_location = f'{track_location_name}.{codec_data[check_codec].container.name}'
 
-        if os.path.isfile(check_location) and not self.global_settings['advanced']['ignore_existing_files']:
-            self.print('Track file already exists')
-
+        # The library index knows about files downloaded under other paths, formats or by a previous scan
+        existing_location = None
+        if not self.global_settings['advanced']['ignore_existing_files']:
+            if os.path.isfile(check_location):
+                existing_location = check_location
+                self.print('Track file already exists')
+            elif self.library and self._link_stored_track(track_id, track_info, check_codec, check_location):
+                existing_location = check_location
+            elif self.library:
+                existing_location = self.library.find(self.service_name, track_id, track_info.tags.isrc, codec=check_codec)
+                if existing_location: self.print(f'Track file already exists: {existing_location}')
+
+        if existing_location:
             # also make sure to add already existing tracks to the m3u playlist
             if m3u_playlist:
-                self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+                self._add_track_m3u_playlist(m3u_playlist, track_index, track_info, existing_location)
 
+            self.retry_queue.remove(self.service_name, track_id)  # In case an earlier run failed it
             self.print(f'=== Track {track_id} skipped ===', drop_level=1)
+            track_span.finish()
+            perf.count('tracks_skipped')
             return
 
         if track_info.description:
             with open(track_location_name + '.txt', 'w', encoding='utf-8') as f: f.write(track_info.description)
 
         # Begin process
-        print()
+        self.oprinter.blank()
         self.print("Downloading track file")
+        streamed_conversion, transfer, stage = False, None, 'download_url'
+        retry_context['track_info'] = track_info  # Download URLs expire, a retry only needs to fetch a new one
         try:
-            download_info: TrackDownloadInfo = self.service.get_track_download(**track_info.download_extra_kwargs)
-            download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=True, indent_level=self.oprinter.indent_number) \
-                if download_info.download_type is DownloadEnum.URL else shutil.move(download_info.temp_file_path, track_location)
+            with perf.span('download_url', self.service_name):
+                download_info: TrackDownloadInfo = self.service.get_track_download(**track_info.download_extra_kwargs)
+            stage = 'transfer'
+            stream_codec = self._get_streaming_conversion(codec, conversions) if not download_info.different_codec else None
+            with perf.span('transfer', self.service_name) as transfer_span:
+                if download_info.download_type is DownloadEnum.URL and stream_codec and \
+                        (transfer := self._download_converted(download_info, track_location_name, stream_codec)):
+                    codec, streamed_conversion = stream_codec, True
+                    container = codec_data[codec].container
+                    track_location = f'{track_location_name}.{container.name}'
+                elif download_info.download_type is DownloadEnum.URL:
+                    transfer = download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=self.oprinter.progress_bars,
+                                             indent_level=self.oprinter.indent_number, tag_padding=self._get_tag_padding(track_info, codec, conversions, cover_temp_location),
+                                             container_name=container.name)
+                elif download_info.download_type is DownloadEnum.MPD:
+                    transfer = download_segmented(download_info.file_url, track_location, manifest=download_info.manifest,
+                                                  headers=download_info.file_url_headers or {}, enable_progress_bar=self.oprinter.progress_bars,
+                                                  indent_level=self.oprinter.indent_number)
+                else:
+                    shutil.move(download_info.temp_file_path, track_location)
+                transfer_span.bytes = transfer.size if transfer else os.path.getsize(track_location)
 
             # check if get_track_download returns a different codec, for example ffmpeg failed
             if download_info.different_codec:
@@ -402,21 +560,22 @@ class Downloader:
                 track_location = f'{track_location_name}.{container.name}'
                 shutil.move(old_track_location, track_location)
         except KeyboardInterrupt:
+            if stage == 'transfer': self.print(f'Deleted partially downloaded file "{track_location}"')
             self.print('^C pressed, exiting')
             sys.exit(0)
-        except Exception:
+        except Exception as e:
             if self.global_settings['advanced']['debug_mode']: raise
-            self.print('Warning: Track download failed: ' + str(sys.exc_info()[1]))
-            self.print(f'=== Track {track_id} failed ===', drop_level=1)
-            return
+            self.print('Warning: Track download failed: ' + str(e))
+            return self._track_failed(track_id, stage, e, retry_context, track_span, transient=is_transient(e))
 
-        delete_cover = False
+        artwork_span = perf.start('artwork', self.third_party_modules[ModuleModes.covers] or self.service_name)
+        delete_cover, artwork_futures = False, [album_cover_future]
         if not cover_temp_location:
             cover_temp_location = create_temp_filename()
             delete_cover = True
             covers_module_name = self.third_party_modules[ModuleModes.covers]
             covers_module_name = covers_module_name if covers_module_name != self.service_name else None
-            if covers_module_name: print()
+            if covers_module_name: self.oprinter.blank()
             self.print('Downloading artwork' + ((' with ' + covers_module_name) if covers_module_name else ''))
             
             jpg_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=self.global_settings['covers']['main_resolution'], \
@@ -425,76 +584,120 @@ class Downloader:
                 resolution=self.global_settings['covers']['external_resolution'], \
                 compression=CoverCompressionEnum[self.global_settings['covers']['external_compression'].lower()])
             
-            if covers_module_name:
-                default_temp = download_to_temp(track_info.cover_url)
-                test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=get_image_resolution(default_temp), compression=CoverCompressionEnum.high)
-                cover_module = self.loaded_modules[covers_module_name]
+            default_temp = self._download_optional('cover', track_info.cover_url) if covers_module_name else None
+            if default_temp:
+                # Thumbnails rule out most candidates, so request them as small as the module allows
+                test_resolution = min(get_image_resolution(default_temp), self.global_settings['advanced']['cover_matching_resolution'])
+                test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=test_resolution, compression=CoverCompressionEnum.high)
+                # Close candidates are decided at full resolution, like before thumbnails were used
+                full_test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=get_image_resolution(default_temp), compression=CoverCompressionEnum.high)
                 rms_threshold = self.global_settings['advanced']['cover_variance_threshold']
+                cover_matcher = CoverMatcher(rms_threshold, workers=self.global_settings['advanced']['cover_matching_workers'])
 
-                results: list[SearchResult] = self.search_by_tags(covers_module_name, track_info)
+                try:
+                    results: list[SearchResult] = self.search_by_tags(covers_module_name, track_info, ModuleModes.covers)
+                except CircuitOpenError as e:
+                    self.print(f'Warning: {e!s}')
+                    results = []
+                except Exception as e:
+                    if self.global_settings['advanced']['debug_mode']: raise
+                    self.print(f'Warning: searching covers failed: {e!s}')
+                    results = []
                 self.print('Covers to test: ' + str(len(results)))
-                attempted_urls = []
-                for i, r in enumerate(results, start=1):
-                    test_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, test_cover_options, **r.extra_kwargs)
-                    if test_cover_info.url not in attempted_urls:
-                        attempted_urls.append(test_cover_info.url)
-                        test_temp = download_to_temp(test_cover_info.url)
-                        rms = compare_images(default_temp, test_temp)
-                        silentremove(test_temp)
-                        self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
-                        if rms < rms_threshold:
-                            self.print('Match found below threshold ' + str(rms_threshold))
-                            jpg_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, jpg_cover_options, **r.extra_kwargs)
-                            download_file(jpg_cover_info.url, cover_temp_location, artwork_settings=self._get_artwork_settings(covers_module_name))
-                            silentremove(default_temp)
-                            if self.global_settings['covers']['save_external']:
-                                ext_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, ext_cover_options, **r.extra_kwargs)
-                                download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(covers_module_name, is_external=True))
-                            break
-                else:
+
+                def get_cover(r, cover_options, quiet=False):
+                    # None if the cover can't be fetched, the fallback cover is used then
+                    try:
+                        return self.call_auxiliary(covers_module_name, ModuleModes.covers, 'get_track_cover', r.result_id, cover_options, **r.extra_kwargs)
+                    except CircuitOpenError as e:
+                        if not quiet: self.print(f'Warning: {e!s}')
+                    except Exception as e:
+                        if self.global_settings['advanced']['debug_mode']: raise
+                        if not quiet: self.print(f'Warning: fetching cover {r.result_id} failed: {e!s}')
+                    return None
+
+                # Candidates whose thumbnail can't be fetched are skipped by the matcher
+                get_test_cover_url = lambda r: getattr(get_cover(r, test_cover_options, quiet=True), 'url', None)
+                get_full_test_cover_url = lambda r: getattr(get_cover(r, full_test_cover_options, quiet=True), 'url', None)
+                matching_span = perf.start('cover_matching', covers_module_name)
+                jpg_cover_info = None
+                for i, r, rms in cover_matcher.match(default_temp, results, get_test_cover_url, get_full_test_cover_url):
+                    self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
+                    if rms < rms_threshold:
+                        self.print('Match found below threshold ' + str(rms_threshold))
+                        jpg_cover_info: CoverInfo = get_cover(r, jpg_cover_options)
+                        if not jpg_cover_info: break
+                        artwork_futures.append(self._download_artwork(jpg_cover_info.url, cover_temp_location, covers_module_name))
+                        silentremove(default_temp)
+                        ext_cover_info: CoverInfo = get_cover(r, ext_cover_options) if self.global_settings['covers']['save_external'] else None
+                        if ext_cover_info:
+                            artwork_futures.append(self._download_artwork(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', covers_module_name, is_external=True))
+                        break
+                if not jpg_cover_info:
                     self.print('Third-party module could not find cover, using fallback')
                     shutil.move(default_temp, cover_temp_location)
-            else:
-                download_file(track_info.cover_url, cover_temp_location, artwork_settings=self._get_artwork_settings())
+                matching_span.finish()
+            elif not covers_module_name:
+                ext_cover_info, main_variant, ext_variant = None, self._get_artwork_variant(cover_temp_location), None
                 if self.global_settings['covers']['save_external'] and ModuleModes.covers in self.module_settings[self.service_name].module_supported_modes:
                     ext_cover_info: CoverInfo = self.service.get_track_cover(track_id, ext_cover_options, **track_info.cover_extra_kwargs)
-                    download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(is_external=True))
+                    ext_cover_location = f'{track_location_name}.{ext_cover_info.file_type.name}'
+                    ext_variant = self._get_artwork_variant(ext_cover_location, is_external=True)
+
+                if main_variant and ext_variant and ext_cover_info.url == track_info.cover_url:
+                    # Both covers are resized from the same source, so it is only downloaded and decoded once.
+                    # An external cover that already exists is kept, as _download_artwork does
+                    if self._download_optional('cover', track_info.cover_url, cover_temp_location):
+                        variants = [main_variant] if os.path.isfile(ext_cover_location) else [ext_variant, main_variant]
+                        artwork_futures.append(self.artwork_processor.submit(cover_temp_location, variants))
+                else:
+                    artwork_futures.append(self._download_artwork(track_info.cover_url, cover_temp_location))
+                    if ext_cover_info:
+                        artwork_futures.append(self._download_artwork(ext_cover_info.url, ext_cover_location, is_external=True))
 
         if track_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated cover')
-            download_file(track_info.animated_cover_url, track_location_name + '_cover.mp4', enable_progress_bar=True)
+            self._download_optional('animated cover', track_info.animated_cover_url, track_location_name + '_cover.mp4', enable_progress_bar=self.oprinter.progress_bars)
+        self._finish_when_done(artwork_span, artwork_futures)
 
         # Get lyrics
         embedded_lyrics = ''
         if self.global_settings['lyrics']['embed_lyrics'] or self.global_settings['lyrics']['save_synced_lyrics']:
+            lyrics_span = perf.start('lyrics', self.third_party_modules[ModuleModes.lyrics] or self.service_name)
             lyrics_info = LyricsInfo()
-            if self.third_party_modules[ModuleModes.lyrics] and self.third_party_modules[ModuleModes.lyrics] != self.service_name:
-                lyrics_module_name = self.third_party_modules[ModuleModes.lyrics]
-                self.print('Retrieving lyrics with ' + lyrics_module_name)
-                lyrics_module = self.loaded_modules[lyrics_module_name]
-
-                if lyrics_module_name != self.service_name:
-                    results: list[SearchResult] = self.search_by_tags(lyrics_module_name, track_info)
-                    lyrics_track_id = results[0].result_id if len(results) else None
-                    extra_kwargs = results[0].extra_kwargs if len(results) else None
-                else:
-                    lyrics_track_id = track_id
-                    extra_kwargs = {}
+            try:
+                if self.third_party_modules[ModuleModes.lyrics] and self.third_party_modules[ModuleModes.lyrics] != self.service_name:
+                    lyrics_module_name = self.third_party_modules[ModuleModes.lyrics]
+                    self.print('Retrieving lyrics with ' + lyrics_module_name)
+
+                    if lyrics_module_name != self.service_name:
+                        results: list[SearchResult] = self.search_by_tags(lyrics_module_name, track_info, ModuleModes.lyrics)
+                        lyrics_track_id = results[0].result_id if len(results) else None
+                        extra_kwargs = results[0].extra_kwargs if len(results) else None
+                    else:
+                        lyrics_track_id = track_id
+                        extra_kwargs = {}
                 
-                if lyrics_track_id:
-                    lyrics_info: LyricsInfo = lyrics_module.get_track_lyrics(lyrics_track_id, **extra_kwargs)
+                    if lyrics_track_id:
+                        lyrics_info: LyricsInfo = self.call_auxiliary(lyrics_module_name, ModuleModes.lyrics, 'get_track_lyrics', lyrics_track_id, **extra_kwargs)
+                        # if lyrics_info.embedded or lyrics_info.synced:
+                        #     self.print('Lyrics retrieved')
+                        # else:
+                        #     self.print('Lyrics module could not find any lyrics.')
+                    else:
+                        self.print('Lyrics module could not find any lyrics.')
+                elif ModuleModes.lyrics in self.module_settings[self.service_name].module_supported_modes:
+                    lyrics_info: LyricsInfo = self.call_auxiliary(self.service_name, ModuleModes.lyrics, 'get_track_lyrics', track_id, **track_info.lyrics_extra_kwargs)
                     # if lyrics_info.embedded or lyrics_info.synced:
                     #     self.print('Lyrics retrieved')
                     # else:
-                    #     self.print('Lyrics module could not find any lyrics.')
-                else:
-                    self.print('Lyrics module could not find any lyrics.')
-            elif ModuleModes.lyrics in self.module_settings[self.service_name].module_supported_modes:
-                lyrics_info: LyricsInfo = self.service.get_track_lyrics(track_id, **track_info.lyrics_extra_kwargs)
-                # if lyrics_info.embedded or lyrics_info.synced:
-                #     self.print('Lyrics retrieved')
-                # else:
-                #     self.print('No lyrics available')
+                    #     self.print('No lyrics available')
+            except CircuitOpenError as e:
+                self.print(f'Warning: {e!s}')
+            except Exception as e:
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.print(f'Warning: retrieving lyrics failed: {e!s}')
+                lyrics_info = LyricsInfo()
 
             if lyrics_info.embedded and self.global_settings['lyrics']['embed_lyrics']:
                 embedded_lyrics = lyrics_info.embedded
@@ -507,41 +710,51 @@ class Downloader:
                 if not os.path.isfile(lrc_location):
                     with open(lrc_location, 'w', encoding='utf-8') as f:
                         f.write(lyrics_info.synced)
+            lyrics_span.finish()
 
         # Get credits
+        credits_span = perf.start('credits', self.third_party_modules[ModuleModes.credits] or self.service_name)
         credits_list = []
-        if self.third_party_modules[ModuleModes.credits] and self.third_party_modules[ModuleModes.credits] != self.service_name:
-            credits_module_name = self.third_party_modules[ModuleModes.credits]
-            self.print('Retrieving credits with ' + credits_module_name)
-            credits_module = self.loaded_modules[credits_module_name]
-
-            if credits_module_name != self.service_name:
-                results: list[SearchResult] = self.search_by_tags(credits_module_name, track_info)
-                credits_track_id = results[0].result_id if len(results) else None
-                extra_kwargs = results[0].extra_kwargs if len(results) else None
-            else:
-                credits_track_id = track_id
-                extra_kwargs = {}
+        try:
+            if self.third_party_modules[ModuleModes.credits] and self.third_party_modules[ModuleModes.credits] != self.service_name:
+                credits_module_name = self.third_party_modules[ModuleModes.credits]
+                self.print('Retrieving credits with ' + credits_module_name)
+
+                if credits_module_name != self.service_name:
+                    results: list[SearchResult] = self.search_by_tags(credits_module_name, track_info, ModuleModes.credits)
+                    credits_track_id = results[0].result_id if len(results) else None
+                    extra_kwargs = results[0].extra_kwargs if len(results) else None
+                else:
+                    credits_track_id = track_id
+                    extra_kwargs = {}
             
-            if credits_track_id:
-                credits_list = credits_module.get_track_credits(credits_track_id, **extra_kwargs)
+                if credits_track_id:
+                    credits_list = self.call_auxiliary(credits_module_name, ModuleModes.credits, 'get_track_credits', credits_track_id, **extra_kwargs)
+                    # if credits_list:
+                    #     self.print('Credits retrieved')
+                    # else:
+                    #     self.print('Credits module could not find any credits.')
+                # else:
+                #     self.print('Credits module could not find any credits.')
+            elif ModuleModes.credits in self.module_settings[self.service_name].module_supported_modes:
+                self.print('Retrieving credits')
+                credits_list = self.call_auxiliary(self.service_name, ModuleModes.credits, 'get_track_credits', track_id, **track_info.credits_extra_kwargs)
                 # if credits_list:
                 #     self.print('Credits retrieved')
                 # else:
-                #     self.print('Credits module could not find any credits.')
-            # else:
-            #     self.print('Credits module could not find any credits.')
-        elif ModuleModes.credits in self.module_settings[self.service_name].module_supported_modes:
-            self.print('Retrieving credits')
-            credits_list = self.service.get_track_credits(track_id, **track_info.credits_extra_kwargs)
-            # if credits_list:
-            #     self.print('Credits retrieved')
-            # else:
-            #     self.print('No credits available')
-        
+                #     self.print('No credits available')
+        except CircuitOpenError as e:
+            self.print(f'Warning: {e!s}')
+        except Exception as e:
+            if self.global_settings['advanced']['debug_mode']: raise
+            self.print(f'Warning: retrieving credits failed: {e!s}')
+            credits_list = []
+
+        credits_span.finish()
+
         # Do conversions
-        old_track_location, old_container = None, None
-        if codec in conversions:
+        old_track_location, old_container, old_codec = None, None, None
+        if codec in conversions and not streamed_conversion:
             old_codec_data = codec_data[codec]
             new_codec = conversions[codec]
             new_codec_data = codec_data[new_codec]
@@ -559,13 +772,8 @@ class Downloader:
                 elif not old_codec_data:
                     self.print('Warning: Undesirable lossy-to-lossy conversion')
 
-                try:
-                    conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
-                except:
-                    conversion_flags = {}
-                    self.print('Warning: conversion_flags setting is invalid, using defaults')
-                
-                conv_flags = conversion_flags[new_codec] if new_codec in conversion_flags else {}
+                conversion_span = perf.start('conversion')
+                conv_flags = self._get_conversion_flags(new_codec)
                 temp_track_location = f'{create_temp_filename()}.{new_codec_data.container.name}'
                 new_track_location = f'{track_location_name}.{new_codec_data.container.name}'
                 
@@ -608,38 +816,225 @@ class Downloader:
 
                 if self.global_settings['advanced']['conversion_keep_original']:
                     old_track_location = track_location
-                    old_container = container
+                    old_container, old_codec = container, codec
                 else:
                     silentremove(track_location)
 
-                container = new_codec_data.container    
+                container, codec = new_codec_data.container, new_codec
                 track_location = new_track_location
+                conversion_span.finish(size=os.path.getsize(track_location))
 
         # Add the playlist track to the m3u playlist
         if m3u_playlist:
-            self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+            self._add_track_m3u_playlist(m3u_playlist, track_index, track_info, track_location)
+
+        # Wait for the artwork worker to finish resizing before embedding the cover
+        artwork_sizes = self._wait_for_artwork(artwork_futures)
+        cover_size = artwork_sizes.get(cover_temp_location)
+
+        # Album tracks share one cover, so its embeddable payloads are only built once per album
+        embedded_cover = None
+        if self.global_settings['covers']['embed_cover'] and os.path.isfile(cover_temp_location):  # Not if the download failed
+            try:
+                embedded_cover = self.cover_cache.get(cover_temp_location, cover_size)
+            except Exception as e:
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.print(f'Warning: cover can not be embedded: {e!s}')
+        if embedded_cover and not embedded_cover.embeddable:
+            self.print(f'Cover file size is too large, only {(Picture._MAX_SIZE / 1024 ** 2):.2f}MB are allowed. Track will not have cover saved.')
 
         # Finally tag file
         self.print('Tagging file')
+        tagging_span = perf.start('tagging')
         try:
-            tag_file(track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                     track_info, credits_list, embedded_lyrics, container)
+            tag_file(track_location, embedded_cover, track_info, credits_list, embedded_lyrics, container)
             if old_track_location:
-                tag_file(old_track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                         track_info, credits_list, embedded_lyrics, old_container)
+                tag_file(old_track_location, embedded_cover, track_info, credits_list, embedded_lyrics, old_container)
+            tagging_span.finish()
         except TagSavingFailure:
+            tagging_span.finish(failed=True)
             self.print('Tagging failed, tags saved to text file')
+        if transfer_settings.integrity_sidecar:
+            write_integrity_sidecar(track_location, transfer)
+        if self.library:
+            self.library.record(track_location, self.service_name, track_id, codec, track_info)
+            if old_track_location: self.library.record(old_track_location, self.service_name, track_id, old_codec, track_info)
         if delete_cover:
             silentremove(cover_temp_location)
+        self.retry_queue.remove(self.service_name, track_id)  # In case an earlier run failed it
         
         self.print(f'=== Track {track_id} downloaded ===', drop_level=1)
-
-    def _get_artwork_settings(self, module_name = None, is_external = False):
+        track_span.finish(size=os.path.getsize(track_location))
+        perf.count('tracks_downloaded')
+
+    def _track_failed(self, track_id, stage, error, retry_context, track_span, transient=True) -> TrackFailure:
+        # error is the exception, or the error message a module put in the track info
+        error_class = type(error).__name__ if isinstance(error, Exception) else 'TrackInfoError'
+        self.oprinter.event('error', track_id=track_id, stage=stage, error=f'{error_class}: {error!s}')
+        failure = self.retry_queue.record(self.service_name, track_id, stage, error_class, str(error), retry_context, transient)
+        if failure.permanent:
+            self.failed_tracks.append(failure)
+        else:
+            self.print(f'Retrying in {beauty_format_seconds(failure.next_attempt - time.time())}')
+        self.print(f'=== Track {track_id} failed ===', drop_level=1)
+        track_span.finish(failed=True)
+        perf.count('tracks_failed')
+        return failure
+
+    def retry_failed_tracks(self, max_wait):
+        # Retries the failed tracks that are due, from this run or earlier ones, waiting at most max_wait seconds for the
+        # next one to become due. Tracks whose delay runs past that are left for the next run
+        deadline = time.time() + max_wait
+        service, service_name, download_mode, path = self.service, self.service_name, self.download_mode, self.path
+        while True:
+            failures = self.retry_queue.take_due()
+            if not failures:
+                next_due = self.retry_queue.next_due()
+                if next_due is None or next_due > deadline: break
+                time.sleep(max(next_due - time.time(), 0))
+                continue
+
+            for failure in failures:
+                if failure.service not in self.module_list:
+                    self.retry_queue.remove(failure.service, failure.track_id)
+                    continue
+                context = failure.context
+                self.service, self.service_name = self.load_module(failure.service), failure.service
+                self.download_mode, self.path = DownloadTypeEnum[context['download_mode']], context['path']
+                self.set_indent_number(1)
+                self.oprinter.blank()
+                self.print(f'Retrying track {failure.track_id}, attempt {failure.attempts + 1} ({failure.stage} failed with {failure.error_class})', drop_level=1)
+                progress.add_tracks(1)
+                if not self.download_track(failure.track_id, album_location=context['album_location'], main_artist=context['main_artist'],
+                                           track_index=context['track_index'], number_of_tracks=context['number_of_tracks'], indent_level=context['indent_level'],
+                                           extra_kwargs=context['extra_kwargs'], track_info=context.get('track_info')):
+                    self.retry_queue.remove(failure.service, failure.track_id)
+        self.service, self.service_name, self.download_mode, self.path = service, service_name, download_mode, path
+
+    def report_failed_tracks(self):
+        self.set_indent_number(1)
+        if self.failed_tracks:
+            self.oprinter.blank()
+            self.print(f'=== {len(self.failed_tracks)} tracks failed ===', drop_level=1)
+            for failure in self.failed_tracks:
+                self.print(f'{failure.service} {failure.track_id}: {failure.stage} failed after {failure.attempts} attempts, {failure.error_class}: {failure.error}')
+        pending = self.retry_queue.pending()
+        if pending: self.print(f'{pending} failed tracks will be retried on the next run', drop_level=1)
+        self.failed_tracks.clear()
+
+    def _link_stored_track(self, track_id, track_info: TrackInfo, codec: CodecEnum, location: str):
+        # The same track in the same codec already exists elsewhere (another playlist or album), so it's linked
+        # into place instead of being downloaded, tagged and converted again
+        link_mode = self.global_settings['library']['link_mode']
+        stored_location = self.library.find(self.service_name, track_id, codec=codec) if link_mode != 'none' else None
+        if not stored_location: return False
+
+        used_mode = link_or_copy(stored_location, location, link_mode)
+        if os.path.isfile(integrity_sidecar_location(stored_location)):
+            link_or_copy(integrity_sidecar_location(stored_location), integrity_sidecar_location(location), 'copy')
+        self.library.record(location, self.service_name, track_id, codec, track_info)
+        self.print(f'Track is stored at {stored_location}, created a {used_mode}' + (' of it' if used_mode == 'copy' else ' to it'))
+        return True
+
+    def _get_conversion_flags(self, new_codec: CodecEnum):
+        try:
+            conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
+        except:
+            conversion_flags = {}
+            self.print('Warning: conversion_flags setting is invalid, using defaults')
+        return conversion_flags[new_codec] if new_codec in conversion_flags else {}
+
+    def _get_streaming_conversion(self, codec: CodecEnum, conversions: dict):
+        # Only lossless sources in containers ffmpeg can decode without seeking are converted while downloading,
+        # everything else (and anything that needs a warning) goes through the file based conversion afterwards
+        if not self.global_settings['advanced']['streaming_conversions'] or codec not in conversions:
+            return None
+        if self.global_settings['advanced']['conversion_keep_original']:
+            return None
+        old_codec_data, new_codec_data = codec_data[codec], codec_data[conversions[codec]]
+        if old_codec_data.container not in streamable_containers or not old_codec_data.lossless:
+            return None
+        if old_codec_data.spatial or new_codec_data.spatial:
+            return None
+        return conversions[codec]
+
+    def _download_converted(self, download_info: TrackDownloadInfo, track_location_name: str, new_codec: CodecEnum):
+        new_codec_data = codec_data[new_codec]
+        self.print(f'Converting to {new_codec_data.pretty_name} while downloading')
+        try:
+            return download_file_converted(download_info.file_url, f'{track_location_name}.{new_codec_data.container.name}',
+                                           {'acodec': new_codec.name.lower(), **self._get_conversion_flags(new_codec)},
+                                           headers=download_info.file_url_headers, enable_progress_bar=self.oprinter.progress_bars, indent_level=self.oprinter.indent_number)
+        except Error as e:
+            logging.debug('Streaming conversion failed: ' + (e.stderr.decode('utf-8', 'ignore') if e.stderr else ''))
+            self.print('Warning: converting while downloading failed, converting after the download instead')
+            return None
+
+    def _get_tag_padding(self, track_info: TrackInfo, codec: CodecEnum, conversions: dict, cover_location: str):
+        # Space reserved in the downloaded file for the tags, so tagging doesn't rewrite the whole file
+        if codec in conversions and not self.global_settings['advanced']['conversion_keep_original']:
+            return 0  # The converted file is written by ffmpeg, padding in the original would be wasted
+
+        cover_size = 0
+        if self.global_settings['covers']['embed_cover']:
+            # Album covers are already known, otherwise assume a typical JPEG at the main resolution
+            cover_size = os.path.getsize(cover_location) if cover_location and os.path.isfile(cover_location) \
+                else self.global_settings['covers']['main_resolution'] ** 2 // 3
+        return estimate_tag_size(track_info, cover_size, codec_data[codec].container)
+
+    def _get_artwork_variant(self, location, module_name = None, is_external = False):
         if not module_name:
             module_name = self.service_name
-        return {
-            'should_resize': ModuleFlags.needs_cover_resize in self.module_settings[module_name].flags,
-            'resolution': self.global_settings['covers']['external_resolution'] if is_external else self.global_settings['covers']['main_resolution'],
-            'compression': self.global_settings['covers']['external_compression'] if is_external else self.global_settings['covers']['main_compression'],
-            'format': self.global_settings['covers']['external_format'] if is_external else 'jpg'
-        }
+        if ModuleFlags.needs_cover_resize not in self.module_settings[module_name].flags:
+            return None
+        return ArtworkVariant(
+            location = location,
+            resolution = self.global_settings['covers']['external_resolution'] if is_external else self.global_settings['covers']['main_resolution'],
+            compression = self.global_settings['covers']['external_compression'] if is_external else self.global_settings['covers']['main_compression'],
+            file_format = self.global_settings['covers']['external_format'] if is_external else 'jpg'
+        )
+
+    def _wait_for_artwork(self, futures) -> dict:
+        # Returns {location: (width, height)} of the resized covers, a failed resize only costs that cover
+        sizes = {}
+        for future in futures:
+            if not future: continue
+            try:
+                sizes.update(future.result())
+            except Exception as e:
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.print(f'Warning: resizing cover failed: {e!s}')
+        return sizes
+
+    @staticmethod
+    def _finish_when_done(span, futures):
+        # Resizes keep running while lyrics and credits are fetched, so the span ends when the last one does
+        futures = [future for future in futures if future]
+        if not futures: return span.finish()
+        remaining, lock = [len(futures)], Lock()
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            span.finish(failed=any(future.exception() for future in futures))
+        for future in futures: future.add_done_callback(done)
+
+    def _download_optional(self, description, url, location=None, **kwargs):
+        # Covers, booklets and animated covers only cost themselves when their download fails, never the track or album.
+        # Returns the location, a temporary file if none was given, or None if the download failed
+        try:
+            if not location: return download_to_temp(url, **kwargs)
+            download_file(url, location, **kwargs)
+            return location
+        except Exception as e:
+            if self.global_settings['advanced']['debug_mode']: raise
+            self.print(f'Warning: downloading the {description} failed: {e!s}')
+            return None
+
+    def _download_artwork(self, url, location, module_name = None, is_external = False):
+        # Returns a future for the resize job if the module needs its covers resized, otherwise None
+        if os.path.isfile(location):
+            return None
+        if not self._download_optional('external cover' if is_external else 'cover', url, location): return None
+        variant = self._get_artwork_variant(location, module_name, is_external)
+        return self.artwork_processor.submit(location, [variant]) if variant else None
@@ -0,0 +1,107 @@
+import os, pickle, sqlite3, time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock
+
+import requests
+
+
+# 403 and 410 are what most services answer once a signed download URL has expired
+transient_status_codes = {403, 408, 410, 425, 429, 500, 502, 503, 504}
+
+def is_transient(error: Exception):
+    # HTTP errors with any other status won't go away by trying again. Everything else (timeouts, dropped
+    # connections, truncated transfers, module errors) is assumed to be transient until it has failed max_attempts times
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in transient_status_codes
+    return True
+
+
+@dataclass
+class TrackFailure:
+    service: str
+    track_id: str
+    stage: str  # metadata, download_url or transfer
+    error_class: str
+    error: str
+    attempts: int
+    next_attempt: float
+    permanent: bool
+    context: dict = field(default_factory=dict)  # Arguments download_track is called with again, see Downloader.download_track
+
+
+class RetryQueue:
+    # Failed tracks with the stage they failed in, retried with an exponentially growing delay at the end of the
+    # run or on a later one. Failures after the metadata stage keep the track info, so only the download URL is
+    # fetched again. Tracks that failed max_attempts times, or with a permanent error, stay as permanent failures
+    def __init__(self, database_location, max_attempts=4, backoff=10, max_backoff=3600, claim_seconds=3600):
+        os.makedirs(os.path.dirname(os.path.abspath(database_location)), exist_ok=True)
+        self.connection = sqlite3.connect(database_location, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = Lock()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.claim_seconds = claim_seconds  # Taken tracks aren't handed out again for this long, unless they are recorded again first
+        with self._transaction() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS failures (service TEXT, track_id TEXT, stage TEXT, error_class TEXT,
+                error TEXT, attempts INTEGER, next_attempt REAL, permanent INTEGER, context BLOB, updated_at INTEGER,
+                PRIMARY KEY (service, track_id))''')
+
+    @contextmanager
+    def _transaction(self):
+        # Several processes (sharded workers) can share the database, BEGIN IMMEDIATE keeps them from taking the same track
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    @staticmethod
+    def _pickle_context(context):
+        # Module specific values in the track info may not be picklable, the track info is fetched again then
+        try:
+            return pickle.dumps(context)
+        except Exception:
+            return pickle.dumps({k: v for k, v in context.items() if k != 'track_info'})
+
+    def record(self, service, track_id, stage, error_class, error, context, transient=True) -> TrackFailure:
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute('SELECT attempts, permanent FROM failures WHERE service = ? AND track_id = ?', (service, str(track_id))).fetchone()
+            # A track that permanently failed in an earlier run gets all its attempts again when it's downloaded again
+            attempts = row[0] + 1 if row and not row[1] else 1
+            permanent = not transient or attempts >= self.max_attempts
+            next_attempt = now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            connection.execute('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (service, str(track_id), stage,
+                error_class, error, attempts, next_attempt, permanent, self._pickle_context(context), int(now)))
+        return TrackFailure(service, str(track_id), stage, error_class, error, attempts, next_attempt, permanent, context)
+
+    def take_due(self) -> list:
+        # Returns the failures whose delay has passed, claimed so other processes sharing the database skip them
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute('''SELECT service, track_id, stage, error_class, error, attempts, next_attempt, context FROM failures
+                WHERE NOT permanent AND next_attempt <= ? ORDER BY next_attempt''', (now,)).fetchall()
+            connection.executemany('UPDATE failures SET next_attempt = ? WHERE service = ? AND track_id = ?',
+                                   [(now + self.claim_seconds, row[0], row[1]) for row in rows])
+        return [TrackFailure(*row[:7], False, pickle.loads(row[7])) for row in rows]
+
+    def next_due(self):
+        # When the next failure can be retried, None if there is nothing left to retry
+        with self.lock:
+            return self.connection.execute('SELECT MIN(next_attempt) FROM failures WHERE NOT permanent').fetchone()[0]
+
+    def pending(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM failures WHERE NOT permanent').fetchone()[0]
+
+    def remove(self, service, track_id):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM failures WHERE service = ? AND track_id = ?', (service, str(track_id)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,100 @@
+import json, os, sqlite3, time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+
+from utils.models import DownloadTypeEnum, MediaIdentification
+
+
+@dataclass
+class Job:
+    id: int
+    service: str
+    media: MediaIdentification
+
+
+class JobQueue:
+    # Media waiting to be downloaded by worker processes. A worker claims a job with a lease that it keeps renewing
+    # while it works on it, if the worker dies or hangs the lease runs out and the job is handed to another worker.
+    # The database can be on shared storage, so workers on several hosts can pull from the same queue
+    def __init__(self, database_location, lease_seconds=300, max_attempts=3):
+        os.makedirs(os.path.dirname(os.path.abspath(database_location)), exist_ok=True)
+        # No WAL here: it needs shared memory between the processes, which workers on different hosts don't have.
+        # Transactions are started explicitly, and other workers' transactions are waited on instead of failing
+        self.connection = sqlite3.connect(database_location, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = Lock()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._transaction() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, service TEXT, media_type TEXT,
+                media_id TEXT, extra_kwargs TEXT, status TEXT, owner TEXT, lease_expires REAL, attempts INTEGER, error TEXT,
+                updated_at INTEGER, UNIQUE (service, media_type, media_id))''')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)')
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can never claim the same job
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def add(self, service, media: MediaIdentification):
+        # Media that is already queued is only queued again once it's done or has failed, not while it's leased
+        with self._transaction() as connection:
+            connection.execute('''INSERT INTO jobs (service, media_type, media_id, extra_kwargs, status, attempts, updated_at)
+                VALUES (?, ?, ?, ?, 'pending', 0, ?) ON CONFLICT (service, media_type, media_id) DO UPDATE SET
+                extra_kwargs = excluded.extra_kwargs, status = 'pending', attempts = 0, error = NULL, updated_at = excluded.updated_at
+                WHERE status IN ('done', 'failed')''',
+                (service, media.media_type.name, str(media.media_id), json.dumps(media.extra_kwargs or {}), int(time.time())))
+
+    def claim(self, owner):
+        # Returns the next pending job, or one whose lease expired, leased to owner. None if there is nothing to claim
+        now = time.time()
+        with self._transaction() as connection:
+            # Jobs whose worker died on every attempt are given up on, they're likely what kills the workers
+            connection.execute('''UPDATE jobs SET status = 'failed', error = COALESCE(error, 'Lease expired'), updated_at = ?
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?''', (int(now), now, self.max_attempts))
+            row = connection.execute('''SELECT id, service, media_type, media_id, extra_kwargs FROM jobs
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1''', (now,)).fetchone()
+            if not row: return None
+            connection.execute('''UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1,
+                updated_at = ? WHERE id = ?''', (owner, now + self.lease_seconds, int(now), row[0]))
+        job_id, service, media_type, media_id, extra_kwargs = row
+        return Job(job_id, service, MediaIdentification(DownloadTypeEnum[media_type], media_id, json.loads(extra_kwargs)))
+
+    def renew(self, job: Job, owner):
+        # Returns False if the lease was lost, because it expired and another worker took over the job
+        with self._transaction() as connection:
+            return connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+                                      (time.time() + self.lease_seconds, job.id, owner)).rowcount > 0
+
+    def complete(self, job: Job, owner):
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET status = 'done', error = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+                               (int(time.time()), job.id, owner))
+
+    def fail(self, job: Job, owner, error):
+        # The job goes back to the queue until it has been attempted max_attempts times
+        with self._transaction() as connection:
+            connection.execute('''UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ?,
+                updated_at = ? WHERE id = ? AND owner = ?''', (self.max_attempts, error, int(time.time()), job.id, owner))
+
+    def counts(self):
+        # {status: jobs}, for pending, leased, done and failed
+        with self.lock:
+            counts = dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+        return {status: counts.get(status, 0) for status in ('pending', 'leased', 'done', 'failed')}
+
+    def failed(self):
+        # [(service, media_type, media_id, error)]
+        with self.lock:
+            return self.connection.execute("SELECT service, media_type, media_id, error FROM jobs WHERE status = 'failed' ORDER BY id").fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,55 @@
+import json, os, sqlite3, time
+from threading import Lock
+
+
+class M3UPlaylist:
+    # Entries are collected by playlist position while the tracks download and written in one go at the end,
+    # instead of reopening the file for every track
+    def __init__(self, location, extended=True, absolute_paths=True):
+        self.location = location
+        self.extended = extended
+        self.absolute_paths = absolute_paths
+        self.entries = {}  # {position: (location, duration, title)}
+
+    def add(self, position, location, duration=None, title=''):
+        self.entries[position] = (os.path.abspath(location), duration, title)
+
+    def write(self):
+        lines = ['#EXTM3U\n\n'] if self.extended else []
+        for position in sorted(self.entries):
+            location, duration, title = self.entries[position]
+            # if no duration exists default to -1
+            if self.extended: lines.append(f'#EXTINF:{duration or -1}, {title}\n')
+            lines.append((location if self.absolute_paths else os.path.relpath(location, os.path.dirname(self.location))) + '\n')
+            # add an extra new line to the extended format
+            if self.extended: lines.append('\n')
+        with open(self.location, 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+
+
+class SyncStore:
+    # Last synced state of every playlist and artist: the module's snapshot id (if it has one) and the items
+    # that were downloaded, so a sync only has to process what was added or removed since
+    def __init__(self, database_location):
+        os.makedirs(os.path.dirname(os.path.abspath(database_location)), exist_ok=True)
+        self.connection = sqlite3.connect(database_location, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS sources (service TEXT, media_type TEXT, media_id TEXT,
+                snapshot_id TEXT, items TEXT, synced_at INTEGER, PRIMARY KEY (service, media_type, media_id))''')
+
+    def get(self, service, media_type, media_id):
+        # Returns (snapshot_id, items), or (None, None) for sources that were never synced
+        with self.lock:
+            row = self.connection.execute('SELECT snapshot_id, items FROM sources WHERE service = ? AND media_type = ? AND media_id = ?',
+                                          (service, media_type, str(media_id))).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, None)
+
+    def put(self, service, media_type, media_id, snapshot_id, items):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)',
+                                    (service, media_type, str(media_id), snapshot_id, json.dumps(items), int(time.time())))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
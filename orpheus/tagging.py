@@ -1,237 +1,379 @@
 import base64
+import hashlib
 import logging
-from dataclasses import asdict
+import os
+from collections import OrderedDict
+from threading import Lock
+from dataclasses import asdict, dataclass
+from types import FunctionType
 
-from PIL import Image
-from mutagen.easyid3 import EasyID3
-from mutagen.easymp4 import EasyMP4
 from mutagen.flac import FLAC, Picture
-from mutagen.id3 import PictureType, APIC, USLT, TDAT, COMM, TPUB
-from mutagen.mp3 import EasyMP3
-from mutagen.mp4 import MP4Cover
-from mutagen.mp4 import MP4Tags
+from mutagen.id3 import PictureType, APIC, USLT, TDAT, COMM, TPUB, TXXX, TIT2, TALB, TPE1, TPE2, TRCK, TPOS, TDRC, TCOP, TCON, TSRC, RVA2
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4, MP4Cover, MP4Tags
 from mutagen.oggopus import OggOpus
 from mutagen.oggvorbis import OggVorbis
 
 from utils.exceptions import *
 from utils.models import ContainerEnum, TrackInfo
+from utils.utils import read_image_size
 
 # Needed for Windows tagging support
 MP4Tags._padding = 0
 
 
-def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum):
-    if container == ContainerEnum.flac:
-        tagger = FLAC(file_path)
-    elif container == ContainerEnum.opus:
-        tagger = OggOpus(file_path)
-    elif container == ContainerEnum.ogg:
-        tagger = OggVorbis(file_path)
-    elif container == ContainerEnum.mp3:
-        tagger = EasyMP3(file_path)
-
-        if tagger.tags is None:
-            tagger.tags = EasyID3()  # Add EasyID3 tags if none are present
-
-        # Register encoded, rating, barcode, compatible_brands, major_brand and minor_version
-        tagger.tags.RegisterTextKey('encoded', 'TSSE')
-        tagger.tags.RegisterTXXXKey('compatible_brands', 'compatible_brands')
-        tagger.tags.RegisterTXXXKey('major_brand', 'major_brand')
-        tagger.tags.RegisterTXXXKey('minor_version', 'minor_version')
-        tagger.tags.RegisterTXXXKey('Rating', 'Rating')
-        tagger.tags.RegisterTXXXKey('upc', 'BARCODE')
-
-        tagger.tags.pop('encoded', None)
-    elif container == ContainerEnum.m4a:
-        tagger = EasyMP4(file_path)
-
-        # Register ISRC, lyrics, cover and explicit tags
-        tagger.RegisterTextKey('isrc', '----:com.apple.itunes:ISRC')
-        tagger.RegisterTextKey('upc', '----:com.apple.itunes:UPC')
-        tagger.RegisterTextKey('explicit', 'rtng') if track_info.explicit is not None else None
-        tagger.RegisterTextKey('covr', 'covr')
-        tagger.RegisterTextKey('lyrics', '\xa9lyr') if embedded_lyrics else None
-    else:
-        raise Exception('Unknown container for tagging')
-
-    # Remove all useless MPEG-DASH ffmpeg tags
-    if tagger.tags is not None:
-        if 'major_brand' in tagger.tags:
-            del tagger.tags['major_brand']
-        if 'minor_version' in tagger.tags:
-            del tagger.tags['minor_version']
-        if 'compatible_brands' in tagger.tags:
-            del tagger.tags['compatible_brands']
-        if 'encoder' in tagger.tags:
-            del tagger.tags['encoder']
-
-    tagger['title'] = track_info.name
-    if track_info.album: tagger['album'] = track_info.album
-    if track_info.tags.album_artist: tagger['albumartist'] = track_info.tags.album_artist
-
-    tagger['artist'] = track_info.artists
-
-    if container == ContainerEnum.m4a or container == ContainerEnum.mp3:
-        if track_info.tags.track_number and track_info.tags.total_tracks:
-            tagger['tracknumber'] = str(track_info.tags.track_number) + '/' + str(track_info.tags.total_tracks)
-        elif track_info.tags.track_number:
-            tagger['tracknumber'] = str(track_info.tags.track_number)
-        if track_info.tags.disc_number and track_info.tags.total_discs:
-            tagger['discnumber'] = str(track_info.tags.disc_number) + '/' + str(track_info.tags.total_discs)
-        elif track_info.tags.disc_number:
-            tagger['discnumber'] = str(track_info.tags.disc_number)
-    else:
-        if track_info.tags.track_number: tagger['tracknumber'] = str(track_info.tags.track_number)
-        if track_info.tags.disc_number: tagger['discnumber'] = str(track_info.tags.disc_number)
-        if track_info.tags.total_tracks: tagger['totaltracks'] = str(track_info.tags.total_tracks)
-        if track_info.tags.total_discs: tagger['totaldiscs'] = str(track_info.tags.total_discs)
-
-    if track_info.tags.release_date:
-        if container == ContainerEnum.mp3:
-            # Never access protected attributes, too bad! Only works on ID3v2.4, disabled for now!
-            # tagger.tags._EasyID3__id3._DictProxy__dict['TDRL'] = TDRL(encoding=3, text=track_info.tags.release_date)
-            # Use YYYY-MM-DD for consistency and convert it to DDMM
-            release_dd_mm = f'{track_info.tags.release_date[8:10]}{track_info.tags.release_date[5:7]}'
-            tagger.tags._EasyID3__id3._DictProxy__dict['TDAT'] = TDAT(encoding=3, text=release_dd_mm)
-            # Now add the year tag
-            tagger['date'] = str(track_info.release_year)
-        else:
-            tagger['date'] = track_info.tags.release_date
-    else:
-        tagger['date'] = str(track_info.release_year)
+class EmbeddedCover:
+    # Holds the cover bytes once and builds each container's picture payload only on first use
+    def __init__(self, image_path: str, image_size: tuple = None):
+        with open(image_path, 'rb') as c:
+            self.data = c.read()
+        self.image_path = image_path
+        self.image_size = image_size
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        self.embeddable = len(self.data) < Picture._MAX_SIZE
+        self.payloads = {}
 
-    if track_info.tags.copyright:tagger['copyright'] = track_info.tags.copyright
+    def payload(self, container: ContainerEnum):
+        if container not in self.payloads:
+            self.payloads[container] = self._create_payload(container)
+        return self.payloads[container]
 
-    if track_info.explicit is not None:
+    def _create_payload(self, container: ContainerEnum):
         if container == ContainerEnum.m4a:
-            tagger['explicit'] = b'\x01' if track_info.explicit else b'\x02'
+            return MP4Cover(self.data, imageformat=MP4Cover.FORMAT_JPEG)
         elif container == ContainerEnum.mp3:
-            tagger['Rating'] = 'Explicit' if track_info.explicit else 'Clean'
-        else:
-            tagger['Rating'] = 'Explicit' if track_info.explicit else 'Clean'
+            return APIC(
+                encoding=3,  # UTF-8
+                mime='image/jpeg',
+                type=3,  # album art
+                desc='Cover',  # name
+                data=self.data
+            )
+
+        picture = Picture()
+        picture.data = self.data
+        picture.mime = u'image/jpeg'
+        if container == ContainerEnum.flac:
+            picture.type = PictureType.COVER_FRONT
+            return picture
 
-    if track_info.tags.genres: tagger['genre'] = track_info.tags.genres
-    if track_info.tags.isrc: tagger['isrc'] = track_info.tags.isrc.encode() if container == ContainerEnum.m4a else track_info.tags.isrc
-    if track_info.tags.upc: tagger['UPC'] = track_info.tags.upc.encode() if container == ContainerEnum.m4a else track_info.tags.upc
+        # Only reads the image header if the size isn't already known from the artwork processor
+        width, height = self.image_size if self.image_size else read_image_size(self.image_path)
+        picture.type = 17
+        picture.desc = u'Cover Art'
+        picture.width = width
+        picture.height = height
+        picture.depth = 24
+        return base64.b64encode(picture.write()).decode('ascii')
 
-    # add the label tag
-    if track_info.tags.label:
-        if container in {ContainerEnum.flac, ContainerEnum.ogg}:
-            tagger['Label'] = track_info.tags.label
-        elif container == ContainerEnum.mp3:
-            tagger.tags._EasyID3__id3._DictProxy__dict['TPUB'] = TPUB(
-                encoding=3,
-                text=track_info.tags.label
-            )
-        elif container == ContainerEnum.m4a:
-            # only works with MP3TAG? https://docs.mp3tag.de/mapping/
-            tagger.RegisterTextKey('label', '\xa9pub')
-            tagger['label'] = track_info.tags.label
-
-    # add the description tag
-    if track_info.tags.description and container == ContainerEnum.m4a:
-        tagger.RegisterTextKey('desc', 'description')
-        tagger['description'] = track_info.tags.description
-
-    # add comment tag
-    if track_info.tags.comment:
-        if container == ContainerEnum.m4a:
-            tagger.RegisterTextKey('comment', '\xa9cmt')
-            tagger['comment'] = track_info.tags.comment
-        elif container == ContainerEnum.mp3:
-            tagger.tags._EasyID3__id3._DictProxy__dict['COMM'] = COMM(
-                encoding=3,
-                lang=u'eng',
-                desc=u'',
-                text=track_info.tags.description
-            )
 
-    # add all extra_kwargs key value pairs to the (FLAC, Vorbis) file
-    if container in {ContainerEnum.flac, ContainerEnum.ogg}:
-        for key, value in track_info.tags.extra_tags.items():
-            tagger[key] = value
-    elif container is ContainerEnum.m4a:
+class CoverPayloadCache:
+    # Per album cache of embedded covers, so every track of an album reuses the same bytes and encoded payloads
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.covers = OrderedDict()  # digest: EmbeddedCover
+        self.paths = {}  # image_path: (mtime, size, digest)
+        self.lock = Lock()
+
+    def get(self, image_path: str, image_size: tuple = None) -> EmbeddedCover:
+        with self.lock:
+            return self._get(image_path, image_size)
+
+    def _get(self, image_path: str, image_size: tuple = None) -> EmbeddedCover:
+        stat = os.stat(image_path)
+        cached = self.paths.get(image_path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size) and cached[2] in self.covers:
+            self.covers.move_to_end(cached[2])
+            return self.covers[cached[2]]
+
+        cover = EmbeddedCover(image_path, image_size)
+        # Identical covers downloaded to different temp files still share their payloads
+        cover = self.covers.get(cover.digest, cover)
+        self.covers[cover.digest] = cover
+        self.covers.move_to_end(cover.digest)
+        self.paths[image_path] = (stat.st_mtime_ns, stat.st_size, cover.digest)
+
+        while len(self.covers) > self.max_entries:
+            digest, _ = self.covers.popitem(last=False)
+            self.paths = {k: v for k, v in self.paths.items() if v[2] != digest}
+        return cover
+
+    def clear(self):
+        with self.lock:
+            self.covers.clear()
+            self.paths.clear()
+
+
+def _track_fields(track_info: TrackInfo, embedded_lyrics: str) -> dict:
+    # Container independent values, only fields that are set end up in here
+    tags = track_info.tags
+    fields = {
+        'title': track_info.name,
+        'album': track_info.album,
+        'albumartist': tags.album_artist,
+        'artist': track_info.artists,
+        'track': (tags.track_number, tags.total_tracks) if tags.track_number or tags.total_tracks else None,
+        'disc': (tags.disc_number, tags.total_discs) if tags.disc_number or tags.total_discs else None,
+        'date': (tags.release_date, track_info.release_year) if tags.release_date or track_info.release_year else None,
+        'copyright': tags.copyright,
+        'explicit': track_info.explicit,
+        'genre': tags.genres,
+        'isrc': tags.isrc,
+        'upc': tags.upc,
+        'label': tags.label,
+        'description': tags.description,
+        'comment': tags.comment,
+        'lyrics': embedded_lyrics,
+        'replaygain': (tags.replay_gain, tags.replay_peak) if tags.replay_gain and tags.replay_peak else None
+    }
+    return {k: v for k, v in fields.items() if v is not None and v != '' and v != []}
+
+
+# Vorbis comments (FLAC, Ogg Vorbis, Opus)
+
+def _vorbis(key, convert=str):
+    def write(tagger, value):
+        tagger.tags[key] = value if isinstance(value, list) else convert(value)
+    return write
+
+def _vorbis_numbers(number_key, total_key):
+    def write(tagger, value):
+        number, total = value
+        if number: tagger.tags[number_key] = str(number)
+        if total: tagger.tags[total_key] = str(total)
+    return write
+
+def _vorbis_date(tagger, value):
+    release_date, release_year = value
+    tagger.tags['date'] = release_date if release_date else str(release_year)
+
+def _vorbis_replaygain(tagger, value):
+    tagger.tags['REPLAYGAIN_TRACK_GAIN'] = str(value[0])
+    tagger.tags['REPLAYGAIN_TRACK_PEAK'] = str(value[1])
+
+def _vorbis_freeform(tagger, key, values):
+    try:
+        tagger.tags[key] = values
+    except ValueError:
+        pass  # Invalid Vorbis comment key
+
+def _vorbis_cover(tagger, payload):
+    if isinstance(payload, Picture):
+        tagger.add_picture(payload)
+    else:
+        tagger.tags['metadata_block_picture'] = [payload]
+
+
+# ID3 (MP3), frames are written directly instead of going through EasyID3
+
+def _id3_text(frame_class):
+    def write(tagger, value):
+        tagger.tags.add(frame_class(encoding=3, text=value if isinstance(value, list) else str(value)))
+    return write
+
+def _id3_txxx(desc, convert=str):
+    def write(tagger, value):
+        tagger.tags.add(TXXX(encoding=3, desc=desc, text=convert(value)))
+    return write
+
+def _id3_numbers(frame_class):
+    def write(tagger, value):
+        number, total = value
+        if number: tagger.tags.add(frame_class(encoding=3, text=f'{number!s}/{total!s}' if total else str(number)))
+    return write
+
+def _id3_date(tagger, value):
+    release_date, release_year = value
+    if release_date:
+        # Use YYYY-MM-DD for consistency and convert it to DDMM, TDRL only works on ID3v2.4
+        tagger.tags.add(TDAT(encoding=3, text=f'{release_date[8:10]}{release_date[5:7]}'))
+    tagger.tags.add(TDRC(encoding=3, text=str(release_year)))
+
+def _id3_replaygain(tagger, value):
+    # RVA2:track as EasyID3 always wrote it (update_to_v23 only removes a bare RVA2 key, so it's kept), plus the
+    # TXXX frames most ID3v2.3 readers look for instead
+    gain, peak = float(value[0]), float(value[1])
+    tagger.tags.add(RVA2(desc='track', channel=1, gain=gain, peak=peak if 0 <= peak < 2 else 0))
+    tagger.tags.add(TXXX(encoding=3, desc='REPLAYGAIN_TRACK_GAIN', text=str(value[0])))
+    tagger.tags.add(TXXX(encoding=3, desc='REPLAYGAIN_TRACK_PEAK', text=str(value[1])))
+
+def _id3_freeform(tagger, key, values):
+    tagger.tags.add(TXXX(encoding=3, desc=key, text=values))
+
+def _id3_cover(tagger, payload):
+    tagger.tags.add(payload)
+
+def _id3_update_to_v23(tagger):
+    # mutagen requires this before saving as ID3v2.3, it turns TDRC into TYER (next to TDAT) and drops v2.4 only frames
+    tagger.tags.update_to_v23()
+
+
+# MP4 atoms (M4A)
+
+def _mp4(atom, convert=None):
+    def write(tagger, value):
+        tagger.tags[atom] = convert(value) if convert else (value if isinstance(value, list) else [value])
+    return write
+
+def _mp4_numbers(atom):
+    def write(tagger, value):
+        number, total = value
+        if number: tagger.tags[atom] = [(number, total or 0)]
+    return write
+
+def _mp4_freeform(tagger, key, values):
+    tagger.tags['----:com.apple.itunes:' + key] = [str(v).encode() for v in values]
+
+def _mp4_cover(tagger, payload):
+    tagger.tags['covr'] = [payload]
+
+
+vorbis_field_writers = {
+    'title': _vorbis('title'),
+    'album': _vorbis('album'),
+    'albumartist': _vorbis('albumartist'),
+    'artist': _vorbis('artist'),
+    'track': _vorbis_numbers('tracknumber', 'totaltracks'),
+    'disc': _vorbis_numbers('discnumber', 'totaldiscs'),
+    'date': _vorbis_date,
+    'copyright': _vorbis('copyright'),
+    'explicit': _vorbis('Rating', lambda value: 'Explicit' if value else 'Clean'),
+    'genre': _vorbis('genre'),
+    'isrc': _vorbis('isrc'),
+    'upc': _vorbis('UPC'),
+    'label': _vorbis('Label'),
+    'lyrics': _vorbis('lyrics'),
+    'replaygain': _vorbis_replaygain
+}
+
+id3_field_writers = {
+    'title': _id3_text(TIT2),
+    'album': _id3_text(TALB),
+    'albumartist': _id3_text(TPE2),
+    'artist': _id3_text(TPE1),
+    'track': _id3_numbers(TRCK),
+    'disc': _id3_numbers(TPOS),
+    'date': _id3_date,
+    'copyright': _id3_text(TCOP),
+    'explicit': _id3_txxx('Rating', lambda value: 'Explicit' if value else 'Clean'),
+    'genre': _id3_text(TCON),
+    'isrc': _id3_text(TSRC),
+    'upc': _id3_txxx('BARCODE'),
+    'label': _id3_text(TPUB),
+    'comment': lambda tagger, value: tagger.tags.add(COMM(encoding=3, lang='eng', desc='', text=value)),
+    'lyrics': lambda tagger, value: tagger.tags.add(USLT(encoding=3, lang='eng', text=value)),  # don't assume eng?
+    'replaygain': _id3_replaygain
+}
+
+mp4_field_writers = {
+    'title': _mp4('\xa9nam'),
+    'album': _mp4('\xa9alb'),
+    'albumartist': _mp4('aART'),
+    'artist': _mp4('\xa9ART'),
+    'track': _mp4_numbers('trkn'),
+    'disc': _mp4_numbers('disk'),
+    'date': _mp4('\xa9day', lambda value: [value[0] if value[0] else str(value[1])]),
+    'copyright': _mp4('cprt'),
+    'explicit': _mp4('rtng', lambda value: [1 if value else 2]),
+    'genre': _mp4('\xa9gen'),
+    'isrc': _mp4('----:com.apple.itunes:ISRC', lambda value: [value.encode()]),
+    'upc': _mp4('----:com.apple.itunes:UPC', lambda value: [value.encode()]),
+    'label': _mp4('\xa9pub'),  # only works with MP3TAG? https://docs.mp3tag.de/mapping/
+    'description': _mp4('desc'),
+    'comment': _mp4('\xa9cmt'),
+    'lyrics': _mp4('\xa9lyr')
+}
+
+
+@dataclass(frozen=True)
+class ContainerTagger:
+    file_class: type
+    field_writers: dict
+    freeform_writer: FunctionType
+    cover_writer: FunctionType
+    extra_tags: bool  # Whether extra_tags from the module are written
+    removed_keys: tuple  # Useless MPEG-DASH ffmpeg tags
+    save_kwargs: dict
+    before_save: FunctionType = None
+
+
+# Compiled once at import, nothing is registered or mutated per file so tagging is thread-safe
+vorbis_removed_keys = ('major_brand', 'minor_version', 'compatible_brands', 'encoder')
+container_taggers = {
+    ContainerEnum.flac: ContainerTagger(FLAC, vorbis_field_writers, _vorbis_freeform, _vorbis_cover, True, vorbis_removed_keys, {}),
+    ContainerEnum.ogg: ContainerTagger(OggVorbis, vorbis_field_writers, _vorbis_freeform, _vorbis_cover, True, vorbis_removed_keys, {}),
+    ContainerEnum.opus: ContainerTagger(OggOpus, {k: v for k, v in vorbis_field_writers.items() if k != 'label'},
+                                        _vorbis_freeform, _vorbis_cover, False, vorbis_removed_keys, {}),
+    ContainerEnum.mp3: ContainerTagger(MP3, id3_field_writers, _id3_freeform, _id3_cover, False,
+                                       ('TSSE', 'TXXX:major_brand', 'TXXX:minor_version', 'TXXX:compatible_brands'),
+                                       {'v1': 2, 'v2_version': 3, 'v23_sep': None}, _id3_update_to_v23),
+    ContainerEnum.m4a: ContainerTagger(MP4, mp4_field_writers, _mp4_freeform, _mp4_cover, True, (), {})
+}
+
+
+# Rough sizes used to reserve tag space before lyrics and credits are known
+estimated_lyrics_size = 4096
+estimated_credits_size = 2048
+tag_size_headroom = 8192
+
+
+def estimate_tag_size(track_info: TrackInfo, cover_size: int = 0, container: ContainerEnum = None) -> int:
+    # Upper estimate of the tag size, used to reserve padding up front so saving doesn't need to rewrite the file
+    text_fields = [track_info.name, track_info.album, *track_info.artists, *(v for v in asdict(track_info.tags).values() if v)]
+    text_size = sum(len(str(v).encode()) + 32 for v in text_fields)  # Plus key/frame overhead per field
+    if container in {ContainerEnum.ogg, ContainerEnum.opus}:
+        cover_size = cover_size * 4 // 3  # base64 encoded picture block
+    return text_size + cover_size + estimated_lyrics_size + estimated_credits_size + tag_size_headroom
+
+
+def _keep_padding(info):
+    # mutagen's default would shrink the padding reserved during the download, which means a rewrite.
+    # Tags that fit into the existing padding are written in place, only a file that has to be
+    # rewritten anyway gets the default padding added again
+    return info.padding if info.padding >= 0 else info.get_default_padding()
+
+
+def tag_file(file_path: str, cover, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum, image_size: tuple = None):
+    # cover is either an image path or an EmbeddedCover from a CoverPayloadCache
+    if container not in container_taggers:
+        raise Exception('Unknown container for tagging')
+    container_tagger = container_taggers[container]
+
+    tagger = container_tagger.file_class(file_path)
+    if tagger.tags is None:
+        tagger.add_tags()
+
+    for key in container_tagger.removed_keys:
+        if key in tagger.tags:
+            del tagger.tags[key]
+
+    for field, value in _track_fields(track_info, embedded_lyrics).items():
+        if field in container_tagger.field_writers:
+            container_tagger.field_writers[field](tagger, value)
+
+    if container_tagger.extra_tags:
         for key, value in track_info.tags.extra_tags.items():
-            # Create a new freeform atom and set the extra_tags in bytes
-            tagger.RegisterTextKey(key, '----:com.apple.itunes:' + key)
-            tagger[key] = str(value).encode()
+            container_tagger.freeform_writer(tagger, key, value if isinstance(value, list) else [value])
 
     # Need to change to merge duplicate credits automatically, or switch to plain dicts instead of list[dataclass]
-    if credits_list:
-        if container == ContainerEnum.m4a:
-            for credit in credits_list:
-                # Create a new freeform atom and set the contributors in bytes
-                tagger.RegisterTextKey(credit.type, '----:com.apple.itunes:' + credit.type)
-                tagger[credit.type] = [con.encode() for con in credit.names]
-        elif container == ContainerEnum.mp3:
-            for credit in credits_list:
-                # Create a new user-defined text frame key
-                tagger.tags.RegisterTXXXKey(credit.type.upper(), credit.type)
-                tagger[credit.type] = credit.names
-        else:
-            for credit in credits_list:
-                try:
-                    tagger.tags[credit.type] = credit.names
-                except:
-                    pass
-
-    if embedded_lyrics:
-        if container == ContainerEnum.mp3:
-            # Never access protected attributes, too bad! I hope I never have to write ID3 code again
-            tagger.tags._EasyID3__id3._DictProxy__dict['USLT'] = USLT(
-                encoding=3,
-                lang=u'eng',  # don't assume?
-                text=embedded_lyrics
-            )
-        else:
-            tagger['lyrics'] = embedded_lyrics
-
-    if track_info.tags.replay_gain and track_info.tags.replay_peak and container != ContainerEnum.m4a:
-        tagger['REPLAYGAIN_TRACK_GAIN'] = str(track_info.tags.replay_gain)
-        tagger['REPLAYGAIN_TRACK_PEAK'] = str(track_info.tags.replay_peak)
+    for credit in credits_list or []:
+        container_tagger.freeform_writer(tagger, credit.type, credit.names)
 
     # only embed the cover when embed_cover is set to True
-    if image_path:
-        with open(image_path, 'rb') as c:
-            data = c.read()
-        picture = Picture()
-        picture.data = data
+    if cover:
+        if not isinstance(cover, EmbeddedCover):
+            cover = EmbeddedCover(cover, image_size)
 
         # Check if cover is smaller than 16MB
-        if len(picture.data) < picture._MAX_SIZE:
-            if container == ContainerEnum.flac:
-                picture.type = PictureType.COVER_FRONT
-                picture.mime = u'image/jpeg'
-                tagger.add_picture(picture)
-            elif container == ContainerEnum.m4a:
-                tagger['covr'] = [MP4Cover(data, imageformat=MP4Cover.FORMAT_JPEG)]
-            elif container == ContainerEnum.mp3:
-                # Never access protected attributes, too bad!
-                tagger.tags._EasyID3__id3._DictProxy__dict['APIC'] = APIC(
-                    encoding=3,  # UTF-8
-                    mime='image/jpeg',
-                    type=3,  # album art
-                    desc='Cover',  # name
-                    data=data
-                )
+        if cover.embeddable:
             # If you want to have a cover in only a few applications, then this technically works for Opus
-            elif container in {ContainerEnum.ogg, ContainerEnum.opus}:
-                im = Image.open(image_path)
-                width, height = im.size
-                picture.type = 17
-                picture.desc = u'Cover Art'
-                picture.mime = u'image/jpeg'
-                picture.width = width
-                picture.height = height
-                picture.depth = 24
-                encoded_data = base64.b64encode(picture.write())
-                tagger['metadata_block_picture'] = [encoded_data.decode('ascii')]
+            container_tagger.cover_writer(tagger, cover.payload(container))
         else:
-            print(f'\tCover file size is too large, only {(picture._MAX_SIZE / 1024 ** 2):.2f}MB are allowed. Track '
-                  f'will not have cover saved.')
+            logging.debug('Cover file size is too large, track will not have cover saved.')  # Reported by the downloader
 
     try:
-        tagger.save(file_path, v1=2, v2_version=3, v23_sep=None) if container == ContainerEnum.mp3 else tagger.save()
+        if container_tagger.before_save: container_tagger.before_save(tagger)
+        tagger.save(padding=_keep_padding, **container_tagger.save_kwargs)
     except:
         logging.debug('Tagging failed.')
         tag_text = '\n'.join((f'{k}: {v}' for k, v in asdict(track_info.tags).items() if v and k != 'credits' and k != 'lyrics'))
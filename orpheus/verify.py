@@ -0,0 +1,97 @@
+import json, os
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+from mutagen import File, MutagenError
+from mutagen.flac import FLAC
+
+from utils.models import ContainerEnum
+from utils.utils import hash_file, integrity_sidecar_location
+
+
+audio_extensions = {'.' + i.name for i in ContainerEnum}
+
+
+def _decode(file_location, output_format, **output_kwargs):
+    # Decodes the first audio stream completely, ffmpeg reports decoding errors on stderr even when it exits cleanly
+    stdout, stderr = ffmpeg.input(file_location).output('-', f=output_format, vn=None, **output_kwargs, loglevel='error') \
+        .run(capture_stdout=True, capture_stderr=True)
+    return stdout.decode('utf-8', 'ignore').strip(), stderr.decode('utf-8', 'ignore').strip()
+
+
+def check_file(file_location) -> list:
+    # Returns the problems found with one file, an empty list means it is fine. Errors are problems of that file
+    # only, they never abort checking the rest of the library
+    try:
+        return _check_file(file_location)
+    except Exception as e:
+        return [f'could not be checked: {type(e).__name__}: {e}']
+
+
+def _check_file(file_location) -> list:
+    problems = []
+
+    sidecar_location = integrity_sidecar_location(file_location)
+    if os.path.isfile(sidecar_location):
+        try:
+            with open(sidecar_location, encoding='utf-8') as f:
+                sidecar = json.load(f)
+            size, algorithm, digest = sidecar['size'], sidecar['algorithm'], sidecar['digest']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            problems.append(f'integrity sidecar could not be read: {type(e).__name__}: {e}')
+        else:
+            if os.path.getsize(file_location) != size:
+                problems.append(f'size is {os.path.getsize(file_location)}, {size} was recorded after downloading')
+            elif hash_file(file_location, algorithm) != digest:
+                problems.append(f'{algorithm} digest does not match the one recorded after downloading')
+
+    try:
+        audio = File(file_location)
+    except (MutagenError, OSError) as e:
+        return problems + [f'container could not be parsed: {e}']
+    if audio is None:
+        return problems + ['container could not be recognised']
+    if not audio.info.length:
+        problems.append('no audio duration in the container')
+
+    try:
+        if isinstance(audio, FLAC) and audio.info.md5_signature:
+            # STREAMINFO holds the MD5 of the decoded samples, signed and little-endian at the stream's bit depth
+            bits = audio.info.bits_per_sample
+            md5, errors = _decode(file_location, 'md5', acodec='pcm_s8' if bits == 8 else f'pcm_s{bits}le')
+            if md5.removeprefix('MD5=') != f'{audio.info.md5_signature:032x}':
+                problems.append('decoded audio does not match the STREAMINFO MD5')
+        else:
+            _, errors = _decode(file_location, 'null')
+        if errors:
+            problems.append('decoding errors: ' + errors.splitlines()[0])
+    except ffmpeg.Error as e:
+        problems.append('could not be decoded: ' + (e.stderr.decode('utf-8', 'ignore').strip().splitlines() or ['unknown error'])[-1])
+    except OSError as e:  # ffmpeg missing, or not allowed to run it
+        problems.append(f'could not be decoded: {type(e).__name__}: {e}')
+    return problems
+
+
+def find_audio_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, _, files in os.walk(path):
+            for file in sorted(files):
+                if os.path.splitext(file)[1].lower() in audio_extensions:
+                    yield os.path.join(root, file)
+
+
+def verify_library(paths, workers=None):
+    # Checks run in one process per core, only broken files are reported. Returns the number of broken files
+    files = list(find_audio_files(paths))
+    broken = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_location, problems in zip(files, executor.map(check_file, files, chunksize=4)):
+            if problems:
+                broken += 1
+                print(file_location)
+                for problem in problems: print('\t' + problem)
+    print(f'Checked {len(files)} files, {broken} broken')
+    return broken
@@ -0,0 +1,151 @@
+import hashlib, io, json, os, threading, time
+from http.client import HTTPMessage
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+from urllib3._collections import HTTPHeaderDict
+
+from utils.exceptions import CassetteMissError
+
+
+class ThrottledBody(io.RawIOBase):
+    # Hands out a recorded body no faster than it originally arrived
+    def __init__(self, body: bytes, seconds: float):
+        self.body = memoryview(body)
+        self.seconds = seconds
+        self.position = 0
+        self.start = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.start is None: self.start = time.perf_counter()
+        size = min(len(buffer), len(self.body) - self.position)
+        buffer[:size] = self.body[self.position:self.position + size]
+        self.position += size
+        if self.seconds and len(self.body):
+            delay = self.seconds * self.position / len(self.body) - (time.perf_counter() - self.start)
+            if delay > 0: time.sleep(delay)
+        return size
+
+
+class RecordedResponse:
+    # Stands in for http.client's response, requests reads the Set-Cookie headers from it
+    def __init__(self, headers):
+        self.msg = HTTPMessage()
+        for k, v in headers:
+            self.msg[k] = v
+
+    def isclosed(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class Cassette:
+    # Records every HTTP exchange made through requests' HTTPAdapter (so every session, shared or not) into a
+    # directory, or serves them back from it without touching the network. The directory holds index.jsonl, one
+    # exchange per line, and the bodies named by their SHA-256, so identical payloads are only stored once
+    def __init__(self, location, mode, timing_scale=1.0):
+        if mode not in {'record', 'replay'}: raise ValueError(f'Invalid cassette mode "{mode}", must be either "record" or "replay"')
+        self.location = location
+        self.mode = mode
+        self.timing_scale = timing_scale  # 1 replays the recorded timings, 0 replays as fast as possible
+        self.lock = threading.Lock()
+        self.original_send = None
+        self.exchanges, self.served = {}, {}  # {key: [exchange]}, {key: exchanges served}
+        self.index_location = os.path.join(location, 'index.jsonl')
+        self.bodies_location = os.path.join(location, 'bodies')
+
+        if mode == 'replay':
+            with open(self.index_location, encoding='utf-8') as f:
+                for line in f:
+                    exchange = json.loads(line)
+                    self.exchanges.setdefault(exchange['key'], []).append(exchange)
+                    self.exchanges.setdefault(exchange['path_key'], []).append(exchange)
+        else:
+            os.makedirs(self.bodies_location, exist_ok=True)
+            open(self.index_location, 'w').close()
+
+    @staticmethod
+    def _keys(request):
+        # Requests are matched exactly first, then by URL path alone, as signed query parameters and timestamps
+        # change on every run. Streamed uploads (files, generators) aren't matched on their body
+        body = request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+        body_hash = hashlib.sha256(body if isinstance(body, bytes) else b'').hexdigest()
+        url = urlsplit(request.url)
+        return f'{request.method} {request.url} {body_hash}', f'{request.method} {url.scheme}://{url.netloc}{url.path}'
+
+    def install(self):
+        cassette, self.original_send = self, HTTPAdapter.send
+
+        def send(adapter, request, *args, **kwargs):
+            if cassette.mode == 'replay': return cassette.replay(adapter, request)
+            return cassette.record(adapter, request, *args, **kwargs)
+
+        HTTPAdapter.send = send
+        return self
+
+    def uninstall(self):
+        if self.original_send: HTTPAdapter.send = self.original_send
+        self.original_send = None
+
+    @staticmethod
+    def _raw(status, reason, headers, body, seconds=0):
+        # The body is stored as it came over the wire (still compressed), urllib3 decodes it again when it is read
+        headers = HTTPHeaderDict([(k, v) for k, v in headers if k.lower() not in {'transfer-encoding', 'content-length'}])
+        headers['Content-Length'] = str(len(body))
+        raw = HTTPResponse(body=ThrottledBody(body, seconds), headers=headers, status=status, reason=reason, preload_content=False)
+        raw._original_response = RecordedResponse(headers.iteritems())
+        return raw
+
+    def record(self, adapter, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = self.original_send(adapter, request, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        headers = list(response.raw.headers.iteritems())
+        body = response.raw.read(decode_content=False)
+        transfer_seconds = time.perf_counter() - start - elapsed
+        response.raw.release_conn()
+
+        body_hash = hashlib.sha256(body).hexdigest()
+        body_location = os.path.join(self.bodies_location, body_hash)
+        key, path_key = self._keys(request)
+        exchange = {'key': key, 'path_key': path_key, 'status': response.status_code, 'reason': response.reason, 'headers': headers,
+                    'body': body_hash, 'elapsed': elapsed, 'transfer_seconds': transfer_seconds}
+        with self.lock:
+            if not os.path.isfile(body_location):
+                with open(body_location, 'wb') as f: f.write(body)
+            with open(self.index_location, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(exchange) + '\n')
+
+        # The caller gets the same response object, the body is read back from memory
+        response.raw = self._raw(response.status_code, response.reason, headers, body)
+        return response
+
+    def replay(self, adapter, request):
+        key, path_key = self._keys(request)
+        with self.lock:
+            key = key if key in self.exchanges else path_key
+            if key not in self.exchanges: raise CassetteMissError(f'No recorded response for {request.method} {request.url}')
+            # Repeated requests get the recorded responses in order, the last one is repeated once they run out
+            served = self.served.get(key, 0)
+            exchange = self.exchanges[key][min(served, len(self.exchanges[key]) - 1)]
+            self.served[key] = served + 1
+
+        if exchange['elapsed'] * self.timing_scale > 0: time.sleep(exchange['elapsed'] * self.timing_scale)
+        with open(os.path.join(self.bodies_location, exchange['body']), 'rb') as f:
+            body = f.read()
+        raw = self._raw(exchange['status'], exchange['reason'], exchange['headers'], body, exchange['transfer_seconds'] * self.timing_scale)
+        return adapter.build_response(request, raw)
+
+
+def use_cassette(record_location=None, replay_location=None, timing_scale=1.0):
+    # Installs a cassette for the --record/--replay command line options, returns None if neither was given
+    if record_location and replay_location: raise ValueError('Only one of record and replay can be used at a time')
+    if record_location: return Cassette(record_location, 'record').install()
+    if replay_location: return Cassette(replay_location, 'replay', timing_scale).install()
+    return None
@@ -0,0 +1,63 @@
+import time
+from threading import Lock
+
+from utils.metrics import circuit_open, circuit_skips_total
+
+
+class CircuitBreaker:
+    # Closed: calls go through. After failure_threshold failed (or slower than slow_seconds) calls in a row it opens
+    # and calls are skipped for cooldown seconds. Then one trial call is let through (half open), which closes it
+    # again if it works and opens it for another cooldown if it doesn't
+    def __init__(self, module, mode, failure_threshold=3, slow_seconds=15.0, cooldown=300.0):
+        self.module = module
+        self.mode = mode
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.lock = Lock()
+        self.failures = 0  # In a row
+        self.opened_at = None
+        self.trial = False  # Whether the trial call of a half open breaker is running
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None: return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                circuit_skips_total.inc(module=self.module, mode=self.mode)
+                return False
+            self.trial = True
+            return True
+
+    def record(self, seconds, failed=False) -> bool:
+        # Returns True if this call opened the breaker
+        failed = failed or (self.slow_seconds and seconds > self.slow_seconds)
+        with self.lock:
+            self.trial = False
+            if not failed:
+                self.failures, self.opened_at = 0, None
+                circuit_open.set(0, module=self.module, mode=self.mode)
+                return False
+            self.failures += 1
+            if self.opened_at is None and self.failures < self.failure_threshold: return False
+            opened, self.opened_at = self.opened_at is None, time.monotonic()
+            circuit_open.set(1, module=self.module, mode=self.mode)
+            return opened
+
+    def remaining(self):
+        # Seconds until the next trial call
+        with self.lock:
+            return max(self.cooldown - (time.monotonic() - self.opened_at), 0) if self.opened_at is not None else 0
+
+
+class CircuitBreakers:
+    # One breaker per module and mode, so lyrics failing on a module doesn't stop its covers or credits
+    def __init__(self, failure_threshold=3, slow_seconds=15.0, cooldown=300.0):
+        self.settings = (failure_threshold, slow_seconds, cooldown)
+        self.lock = Lock()
+        self.breakers = {}
+
+    def get(self, module, mode) -> CircuitBreaker:
+        with self.lock:
+            if (module, mode) not in self.breakers:
+                self.breakers[module, mode] = CircuitBreaker(module, mode, *self.settings)
+            return self.breakers[module, mode]
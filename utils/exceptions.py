@@ -30,4 +30,13 @@ class ModuleSettingsNotSet(Exception):
     pass # TODO: will either tell you to add settings for a specific module in simple sessions mode, or the command needed to set a setting in advanced sessions mode
 
 class TagSavingFailure(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class DownloadIntegrityError(Exception):
+    pass
+
+class CassetteMissError(Exception):
+    pass
+
+class CircuitOpenError(Exception):
+    pass
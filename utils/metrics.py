@@ -0,0 +1,183 @@
+import os, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Stage latencies range from milliseconds (tagging) to minutes (large transfers)
+default_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs: return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    metric_type = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # {label values: value}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames): raise ValueError(f'{self.name} takes the labels {", ".join(self.labelnames)}')
+        return tuple(str(labels[i]) for i in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for labelvalues, value in items:
+            lines += self._render_value(labelvalues, value)
+        return lines
+
+    def _render_value(self, labelvalues, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        # Counts the work inside the with block as in flight
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def _render_value(self, labelvalues, value):
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labelvalues, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=default_buckets) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def write_textfile(self, location):
+        # Written next to the target and renamed, so a collector never reads a half written file
+        temp_location = f'{location}.{os.getpid()}.tmp'
+        with open(temp_location, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(temp_location, location)
+
+    def serve(self, port, address='127.0.0.1'):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+
+metrics = MetricsRegistry()
+
+tracks_total = metrics.counter('orpheus_tracks_total', 'Tracks processed by outcome', ['outcome'])
+transfer_bytes_total = metrics.counter('orpheus_transfer_bytes_total', 'Bytes received by downloads')
+http_retries_total = metrics.counter('orpheus_http_retries_total', 'HTTP requests retried, by host and status code or error', ['host', 'reason'])
+http_rate_limited_total = metrics.counter('orpheus_http_rate_limited_total', 'HTTP 429 responses', ['host'])
+module_calls_total = metrics.counter('orpheus_module_calls_total', 'Calls made to modules', ['module', 'function'])
+stage_duration_seconds = metrics.histogram('orpheus_stage_duration_seconds', 'Time spent per track stage', ['stage', 'module'])
+stage_failures_total = metrics.counter('orpheus_stage_failures_total', 'Track stages that failed', ['stage', 'module'])
+in_flight = metrics.gauge('orpheus_in_flight', 'Work currently in progress', ['kind'])
+circuit_open = metrics.gauge('orpheus_circuit_open', 'Whether the lookups of a module are skipped, by module and mode', ['module', 'mode'])
+circuit_skips_total = metrics.counter('orpheus_circuit_skips_total', 'Lookups skipped because the module\'s circuit breaker was open', ['module', 'mode'])
+
+
+def observe_span(stage, module, seconds, size, failed):
+    # PerfRecorder listener, turns the timing spans into latency histograms
+    stage_duration_seconds.observe(seconds, stage=stage, module=module or '')
+    if failed: stage_failures_total.inc(stage=stage, module=module or '')
+
+def observe_count(name, amount):
+    if name.startswith('tracks_'): tracks_total.inc(amount, outcome=name[len('tracks_'):])
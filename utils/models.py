@@ -1,35 +1,65 @@
-import os
+import threading
 from dataclasses import dataclass, field
 from enum import Flag, auto
 from types import ClassMethodDescriptorType, FunctionType
 from typing import Optional
 
+from utils.output import PrettyBackend
+from utils.transport import HTTPTransport
 from utils.utils import read_temporary_setting, set_temporary_setting
 
 
 class Oprinter:  # Could change to inherit from print class instead, but this is fine
-    def __init__(self):
-        self.indent_number = 1
+    def __init__(self, backend=None):
+        self.backend = backend or PrettyBackend()
         self.printing_enabled = True
-        self.multiplier = 8
+        self.local = threading.local()  # Every download thread keeps its own indent level
+
+    def set_backend(self, backend):
+        old_backend, self.backend = self.backend, backend
+        if old_backend is not backend: old_backend.close()
+
+    @property
+    def level(self):
+        return getattr(self.local, 'level', 1)
+
+    @property
+    def multiplier(self):
+        return self.backend.multiplier
+
+    @property
+    def indent_number(self):
+        return self.level * self.backend.multiplier
+
+    @property
+    def progress_bars(self):
+        return self.backend.progress_bars
 
     def set_indent_number(self, number: int):
-        try:
-            size = os.get_terminal_size().columns
-            if 60 < size < 80:
-                self.multiplier = int((size - 60)/2.5)
-            elif size < 60:
-                self.multiplier = 0
-            else:
-                self.multiplier = 8
-        except:
-            self.multiplier = 8
-
-        self.indent_number = number * self.multiplier
+        self.local.level = number
 
     def oprint(self, inp: str, drop_level: int = 0):
         if self.printing_enabled:
-            print(' ' * (self.indent_number - drop_level * self.multiplier) + inp)
+            self.backend.message(inp, self.level - drop_level)
+
+    def blank(self):
+        if self.printing_enabled:
+            self.backend.blank()
+
+    def event(self, event: str, **fields):
+        # Structured events (errors, progress, stages) for backends like jsonl, the console only shows the messages
+        if self.backend.structured or event == 'error':
+            self.backend.event(event, fields)
+
+    def stage_started(self, stage, module):
+        if self.backend.structured: self.backend.event('stage_start', {'stage': stage, 'module': module})
+
+    def stage_finished(self, stage, module, seconds, size, failed):
+        if self.backend.structured:
+            self.backend.event('stage_end', {'stage': stage, 'module': module, 'seconds': round(seconds, 4), 'bytes': size, 'failed': failed})
+
+    def counted(self, name, amount):
+        if self.backend.structured: self.backend.event('count', {'name': name, 'amount': amount})
 
 
 class CodecEnum(Flag):
@@ -241,6 +271,7 @@ class ModuleController:
     get_current_timestamp: FunctionType
     printer_controller: Oprinter
     module_error: ClassMethodDescriptorType  # Will eventually be deprecated *sigh*
+    http_transport: HTTPTransport  # Use http_transport.create_session() to share Orpheus' connection pools
 
 
 @dataclass
@@ -310,6 +341,7 @@ class ArtistInfo:
     album_extra_kwargs: Optional[dict] = field(default_factory=dict)
     tracks: Optional[list] = field(default_factory=list)
     track_extra_kwargs: Optional[dict] = field(default_factory=dict)
+    snapshot_id: Optional[str] = None  # Changes whenever the albums or tracks change (etag, revision), used by sync mode
 
 
 @dataclass
@@ -326,6 +358,7 @@ class PlaylistInfo:
     animated_cover_url: Optional[str] = None
     description: Optional[str] = None
     track_extra_kwargs: Optional[dict] = field(default_factory=dict)
+    snapshot_id: Optional[str] = None  # Changes whenever the tracks change (etag, revision), used by sync mode
 
 
 @dataclass
@@ -358,5 +391,6 @@ class TrackDownloadInfo:
     download_type: DownloadEnum
     file_url: Optional[str] = None
     file_url_headers: Optional[dict] = None
+    manifest: Optional[str] = None  # HLS/DASH manifest for MPD, fetched from file_url if not given
     temp_file_path: Optional[str] = None
     different_codec: Optional[CodecEnum] = None
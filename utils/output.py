@@ -0,0 +1,121 @@
+import atexit, json, os, signal, sys, threading, time
+
+from utils.progress import progress
+
+
+def _indent_multiplier():
+    try:
+        size = os.get_terminal_size().columns
+    except OSError:
+        return 8
+    if 60 < size < 80:
+        return int((size - 60)/2.5)
+    return 0 if size < 60 else 8
+
+
+class PrettyBackend:
+    # The console output Orpheus always had: indented lines, with the progress lines below them
+    progress_bars = True
+    structured = False  # Whether stage and progress events are wanted, they are only built for backends that use them
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.multiplier = _indent_multiplier()
+        # The terminal width is only looked up again when the terminal is resized, not on every indent change
+        if hasattr(signal, 'SIGWINCH') and threading.current_thread() is threading.main_thread():
+            previous_handler = signal.getsignal(signal.SIGWINCH)
+            def resized(signum, frame):
+                self.multiplier = _indent_multiplier()
+                if callable(previous_handler): previous_handler(signum, frame)
+            signal.signal(signal.SIGWINCH, resized)
+
+    def message(self, text, level):
+        # One write per line under a lock, so lines from concurrent downloads never interleave
+        with self.lock:
+            progress.write_above(' ' * (level * self.multiplier) + text + '\n')
+
+    def blank(self):
+        with self.lock:
+            progress.write_above('\n')
+
+    def event(self, event, fields):
+        pass
+
+    def close(self):
+        sys.stdout.flush()
+
+
+class QuietBackend(PrettyBackend):
+    # Only errors, on stderr
+    progress_bars = False
+
+    def message(self, text, level):
+        pass
+
+    def blank(self):
+        pass
+
+    def event(self, event, fields):
+        if event == 'error':
+            with self.lock:
+                sys.stderr.write(f'Error: {fields.get("track_id", "")} {fields.get("error", "")}\n')
+
+
+class JsonLinesBackend:
+    # One JSON object per line for every message and event, for headless runs that log to a file. Lines are
+    # buffered and written at most every flush_interval seconds (or every flush_lines lines) instead of per line
+    progress_bars = False
+    structured = True
+    multiplier = 0
+
+    def __init__(self, location='', flush_interval=1.0, flush_lines=256):
+        self.file = open(location, 'a', encoding='utf-8') if location else sys.stdout
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.closed = threading.Event()
+        threading.Thread(target=self._flush_periodically, name='JsonLinesBackend', daemon=True).start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffer: return
+        self.file.write('\n'.join(self.buffer) + '\n')
+        self.file.flush()
+        self.buffer.clear()
+
+    def _emit(self, record):
+        record = {'time': round(time.time(), 3), 'thread': threading.current_thread().name, **record}
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_lines: self._flush()
+
+    def message(self, text, level):
+        self._emit({'event': 'message', 'level': level, 'text': text})
+
+    def blank(self):
+        pass
+
+    def event(self, event, fields):
+        self._emit({'event': event, **fields})
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self._flush()
+            if self.file is not sys.stdout: self.file.close()
+            self.file = sys.stdout  # Anything emitted after closing still goes somewhere
+
+
+output_backends = {'pretty': PrettyBackend, 'quiet': QuietBackend, 'jsonl': JsonLinesBackend}
+
+def create_output_backend(output_format, output_file=''):
+    if output_format not in output_backends:
+        raise ValueError(f'Invalid output format "{output_format}", must be one of {", ".join(output_backends)}')
+    return JsonLinesBackend(output_file) if output_format == 'jsonl' else output_backends[output_format]()
@@ -0,0 +1,108 @@
+import json, math, time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values: return 0
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+class Span:
+    def __init__(self, recorder, stage, module=None):
+        self.recorder = recorder
+        self.stage = stage
+        self.module = module
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self.finished = False
+
+    def finish(self, failed=False, size=None):
+        # Only the first call counts, so early returns can finish a span without checking whether it already was
+        if self.finished: return
+        self.finished = True
+        if size is not None: self.bytes = size
+        self.recorder.add(self.stage, self.module, time.perf_counter() - self.start, self.bytes, failed)
+
+
+class PerfRecorder:
+    # Collects how long every stage of every track took, summarised at the end of a run
+    def __init__(self):
+        self.lock = Lock()
+        self.start_listeners = []  # Called with (stage, module) for every started span
+        self.listeners = []  # Called with (stage, module, seconds, size, failed) for every finished span
+        self.count_listeners = []  # Called with (name, amount) for every count
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = []  # (stage, module, seconds, bytes, failed)
+            self.counts = Counter()
+            self.started = time.perf_counter()
+
+    def start(self, stage, module=None) -> Span:
+        for listener in self.start_listeners: listener(stage, module)
+        return Span(self, stage, module)
+
+    @contextmanager
+    def span(self, stage, module=None):
+        span = self.start(stage, module)
+        try:
+            yield span
+        except BaseException:
+            span.finish(failed=True)
+            raise
+        span.finish()
+
+    def add(self, stage, module, seconds, size=0, failed=False):
+        with self.lock:
+            self.spans.append((stage, module, seconds, size, failed))
+        for listener in self.listeners: listener(stage, module, seconds, size, failed)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+        for listener in self.count_listeners: listener(name, amount)
+
+    def summary(self) -> dict:
+        with self.lock:
+            spans, counts, wall_time = list(self.spans), dict(self.counts), time.perf_counter() - self.started
+
+        stages = {}
+        for stage, module, seconds, size, failed in spans:
+            data = stages.setdefault(stage, {'durations': [], 'failures': 0, 'bytes': 0, 'modules': Counter()})
+            data['durations'].append(seconds)
+            data['failures'] += failed
+            data['bytes'] += size
+            if module: data['modules'][module] += 1
+
+        summary = {'wall_time': wall_time, 'counts': counts, 'stages': {}}
+        for stage, data in stages.items():
+            durations = sorted(data['durations'])
+            total = sum(durations)
+            summary['stages'][stage] = {
+                'count': len(durations), 'failures': data['failures'], 'total': total,
+                'p50': percentile(durations, 0.5), 'p95': percentile(durations, 0.95), 'max': durations[-1],
+                'bytes': data['bytes'], 'throughput': data['bytes'] / total if total and data['bytes'] else None,  # Bytes per second
+                'modules': dict(data['modules'])
+            }
+        return summary
+
+    def report(self) -> str:
+        summary = self.summary()
+        lines = [f'{"Stage":<14}{"Count":>7}{"Failed":>8}{"p50":>10}{"p95":>10}{"Total":>10}{"MB/s":>9}']
+        for stage, data in summary['stages'].items():
+            throughput = f'{data["throughput"] / 1024**2:.1f}' if data['throughput'] else '-'
+            lines.append(f'{stage:<14}{data["count"]:>7}{data["failures"]:>8}{data["p50"]:>9.2f}s{data["p95"]:>9.2f}s{data["total"]:>9.1f}s{throughput:>9}')
+        counts = ', '.join(f'{v} {k.replace("_", " ")}' for k, v in sorted(summary['counts'].items()))
+        lines.append(f'Wall time: {summary["wall_time"]:.1f}s' + (f', {counts}' if counts else ''))
+        return '\n'.join(lines)
+
+    def write_json(self, location):
+        with open(location, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=4)
+
+
+perf = PerfRecorder()
@@ -0,0 +1,173 @@
+import os, sys, threading, time
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB': break
+        size /= 1024
+    return f'{size:.1f} {unit}' if unit != 'B' else f'{size:.0f} B'
+
+
+def _format_seconds(seconds):
+    if seconds is None: return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    return f'{minutes // 60}:{minutes % 60:02d}:{seconds:02d}' if minutes >= 60 else f'{minutes:02d}:{seconds:02d}'
+
+
+def _bar(fraction, width):
+    filled = int(max(min(fraction, 1), 0) * width)
+    return '█' * filled + '░' * (width - filled)
+
+
+class Transfer:
+    # Handle for one running transfer. update() only adds to counters, drawing happens on the manager's thread
+    def __init__(self, manager, name, total=None, parts=None):
+        self.manager = manager
+        self.name = name
+        self.total = total  # Bytes, if known
+        self.parts = parts  # Segments, for segmented downloads
+        self.done = 0
+        self.parts_done = 0
+
+    def update(self, size, parts=0):
+        self.done += size
+        self.parts_done += parts
+        with self.manager.lock:  # Transfers update from their own threads
+            self.manager.bytes_done += size
+
+    def close(self):
+        self.manager._remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProgressManager:
+    # One aggregate line (tracks, bytes, speed, ETA) plus a line for each of at most max_lines running transfers,
+    # redrawn in place by a background thread at most every refresh seconds. Transfers only bump counters, so the
+    # cost doesn't depend on how many chunks arrive. Nothing is drawn when stderr isn't a terminal
+    def __init__(self, max_lines=4, refresh=0.2, stream=None):
+        self.max_lines = max_lines
+        self.refresh = refresh
+        self.stream = stream
+        self.lock = threading.RLock()
+        self.transfers = []
+        self.thread = None
+        self.drawn = 0  # Lines currently on screen
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.tracks_total = self.tracks_done = self.bytes_done = 0
+            self.started = time.monotonic()
+            self.speed, self.last_sample = 0.0, (self.started, 0)
+
+    @property
+    def output(self):
+        return self.stream or sys.stderr
+
+    def enabled(self):
+        try:
+            return self.output.isatty()
+        except (AttributeError, ValueError):
+            return False
+
+    def add_tracks(self, count):
+        with self.lock:
+            self.tracks_total += count
+
+    def track_finished(self, count=1):
+        with self.lock:
+            self.tracks_done += count
+
+    def transfer(self, name, total=None, parts=None) -> Transfer:
+        transfer = Transfer(self, name, total, parts)
+        with self.lock:
+            self.transfers.append(transfer)
+            if self.thread is None and self.enabled():
+                self.thread = threading.Thread(target=self._draw_periodically, name='ProgressManager', daemon=True)
+                self.thread.start()
+        return transfer
+
+    def _remove(self, transfer):
+        with self.lock:
+            if transfer in self.transfers: self.transfers.remove(transfer)
+
+    def _draw_periodically(self):
+        while True:
+            time.sleep(self.refresh)
+            with self.lock:
+                if self.drawn or self.transfers: self._draw()
+
+    def _lines(self, width):
+        now = time.monotonic()
+        # Speed is smoothed over the last few redraws, so one slow chunk doesn't make it jump around
+        last_time, last_bytes = self.last_sample
+        if now - last_time > 0:
+            self.speed = 0.7 * self.speed + 0.3 * (self.bytes_done - last_bytes) / (now - last_time)
+            self.last_sample = (now, self.bytes_done)
+
+        eta = None
+        if self.tracks_total and self.tracks_done:
+            eta = (now - self.started) / self.tracks_done * max(self.tracks_total - self.tracks_done, 0)
+        elif self.speed > 0 and any(t.total for t in self.transfers):
+            eta = sum(max(t.total - t.done, 0) for t in self.transfers if t.total) / self.speed
+
+        tracks = f'{self.tracks_done}/{self.tracks_total} tracks' if self.tracks_total else f'{self.tracks_done} tracks'
+        summary = f'{_format_bytes(self.bytes_done)}  {_format_bytes(self.speed)}/s  ETA {_format_seconds(eta)}'
+        bar_width = max(width - len(tracks) - len(summary) - 4, 0)
+        lines = [f'{tracks} {_bar(self.tracks_done / self.tracks_total, bar_width) if self.tracks_total else " " * bar_width}  {summary}']
+
+        for transfer in self.transfers[:self.max_lines]:
+            if transfer.parts:
+                status, fraction = f'{transfer.parts_done}/{transfer.parts} segments {_format_bytes(transfer.done)}', transfer.parts_done / transfer.parts
+            elif transfer.total:
+                status, fraction = f'{_format_bytes(transfer.done)}/{_format_bytes(transfer.total)}', transfer.done / transfer.total
+            else:
+                status, fraction = _format_bytes(transfer.done), 0
+            name = transfer.name[:max(width // 3, 10)]
+            lines.append(f'  {name} {_bar(fraction, max(width - len(name) - len(status) - 5, 0))} {status}')
+        if len(self.transfers) > self.max_lines:
+            lines.append(f'  and {len(self.transfers) - self.max_lines} more')
+        return [line[:width] for line in lines]
+
+    def _clear(self):
+        # Moves to the first drawn line and erases everything below it
+        return f'\x1b[{self.drawn}F\x1b[J' if self.drawn else ''
+
+    def _draw(self):
+        try:
+            width = os.get_terminal_size(self.output.fileno()).columns - 1
+        except (OSError, ValueError, AttributeError):
+            width = 79
+        lines = self._lines(width)
+        self.output.write(self._clear() + ''.join(line + '\n' for line in lines))
+        self.output.flush()
+        self.drawn = len(lines)
+
+    def write_above(self, text):
+        # Console output goes above the progress lines instead of being overwritten by the next redraw
+        with self.lock:
+            if not self.drawn: return sys.stdout.write(text)
+            self.output.write(self._clear())
+            self.output.flush()
+            self.drawn = 0
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            self._draw()
+
+    def close(self):
+        # Removes the progress lines and starts counting from zero again, at the end of a run
+        with self.lock:
+            if self.drawn:
+                self.output.write(self._clear())
+                self.output.flush()
+                self.drawn = 0
+            self.transfers.clear()
+        self.reset()
+
+
+progress = ProgressManager()
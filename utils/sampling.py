@@ -0,0 +1,66 @@
+import os, sys, threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    # Records the stack of every thread at a fixed interval from a background thread. Unlike cProfile nothing is
+    # hooked into every call, and time spent waiting on the network shows up too. The output is in the collapsed
+    # stack format read by flamegraph.pl, inferno and speedscope
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.thread_names = {}
+        self.frame_names = {}  # {code object: name}, so every function's path is only made relative once
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        name = self.frame_names.get(code)
+        if name is None:
+            name = self.frame_names[code] = f'{code.co_name} ({os.path.relpath(code.co_filename)}:{code.co_firstlineno})'
+        return name
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if any(i not in self.thread_names for i in frames):
+                self.thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id == own_id: continue
+                stack = []
+                while frame:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(self.thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample, name='SamplingProfiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread: self.thread.join()
+        self.thread = None
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def write(self, location):
+        with open(location, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+    def top(self, limit=15):
+        # Functions by the share of samples they were on a stack in, their own time and time in what they called
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            for frame in set(stack.split(';')[1:]):
+                inclusive[frame] += count
+        total = sum(self.stacks.values()) or 1
+        return [(frame, count / total) for frame, count in inclusive.most_common(limit)]
@@ -0,0 +1,263 @@
+import hashlib, math, os, re, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urljoin
+
+import ffmpeg, m3u8
+from Cryptodome.Cipher import AES
+from defusedxml import ElementTree
+
+from utils.exceptions import DownloadIntegrityError
+from utils.metrics import in_flight, transfer_bytes_total
+from utils.progress import progress
+from utils.utils import TransferDigest, r_session, silentremove, transfer_settings
+
+
+@dataclass
+class Segment:
+    url: str
+    byte_range: Optional[tuple] = None  # (offset, length)
+    key_url: Optional[str] = None  # AES-128 key, HLS only
+    iv: Optional[bytes] = None
+
+
+# HLS
+
+def _hls_byte_range(byterange: str, previous_end: dict, url: str):
+    # "length[@offset]", without an offset the range continues where the previous one of the same URL ended
+    length, _, offset = byterange.partition('@')
+    offset = int(offset) if offset else previous_end.get(url, 0)
+    previous_end[url] = offset + int(length)
+    return offset, int(length)
+
+
+def parse_hls(manifest: str, manifest_url: str, headers: dict = None) -> list:
+    playlist = m3u8.loads(manifest, uri=manifest_url)
+    if playlist.is_variant:
+        # Master playlist, pick the best variant and load its media playlist
+        variant = max(playlist.playlists, key=lambda p: p.stream_info.bandwidth or 0)
+        r = r_session.get(variant.absolute_uri, headers=headers, verify=False)
+        r.raise_for_status()
+        return parse_hls(r.text, variant.absolute_uri, headers)
+
+    segments, previous_end, init_url = [], {}, None
+    for sequence, segment in enumerate(playlist.segments, start=playlist.media_sequence or 0):
+        init_section = segment.init_section
+        if init_section and init_section.absolute_uri != init_url:
+            init_url = init_section.absolute_uri
+            byte_range = _hls_byte_range(init_section.byterange, previous_end, init_url) if init_section.byterange else None
+            segments.append(Segment(init_url, byte_range))
+
+        key_url, iv = None, None
+        if segment.key and segment.key.method == 'AES-128':
+            key_url = segment.key.absolute_uri
+            # Without an explicit IV the media sequence number is used as the IV
+            iv = bytes.fromhex(segment.key.iv[2:].zfill(32)) if segment.key.iv else sequence.to_bytes(16, 'big')
+        elif segment.key and segment.key.method not in {None, 'NONE'}:
+            raise Exception(f'Unsupported HLS encryption method {segment.key.method}')
+
+        byte_range = _hls_byte_range(segment.byterange, previous_end, segment.absolute_uri) if segment.byterange else None
+        segments.append(Segment(segment.absolute_uri, byte_range, key_url, iv))
+    return segments
+
+
+# DASH
+
+dash_namespace = {'mpd': 'urn:mpeg:dash:schema:mpd:2011'}
+
+
+def _iso_duration(duration: str) -> float:
+    match = re.fullmatch(r'P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?', duration or '')
+    if not match: return 0
+    days, hours, minutes, seconds = (float(i) if i else 0 for i in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _base_url(url: str, element) -> str:
+    base = element.find('mpd:BaseURL', dash_namespace)
+    return urljoin(url, base.text.strip()) if base is not None and base.text else url
+
+
+def _fill_template(template: str, representation, number=None, time_=None) -> str:
+    values = {'RepresentationID': representation.get('id'), 'Bandwidth': representation.get('bandwidth'), 'Number': number, 'Time': time_}
+    def replace(match):
+        if match.group(0) == '$$': return '$'
+        name, width = match.group(1), match.group(2)
+        return f'{int(values[name]):0{width}d}' if width else str(values[name])
+    return re.sub(r'\$\$|\$(RepresentationID|Number|Bandwidth|Time)(?:%0(\d+)d)?\$', replace, template)
+
+
+def _dash_range(range_: str):
+    start, end = (int(i) for i in range_.split('-'))
+    return start, end - start + 1
+
+
+def parse_dash(manifest: str, manifest_url: str) -> list:
+    mpd = ElementTree.fromstring(manifest)
+    period = mpd.find('mpd:Period', dash_namespace)
+    period_duration = _iso_duration(period.get('duration') or mpd.get('mediaPresentationDuration'))
+
+    adaptation_sets = period.findall('mpd:AdaptationSet', dash_namespace)
+    is_audio = lambda a: 'audio' in (a.get('mimeType') or a.get('contentType') or '') or \
+        any('audio' in (r.get('mimeType') or '') for r in a.findall('mpd:Representation', dash_namespace))
+    adaptation_set = next((a for a in adaptation_sets if is_audio(a)), adaptation_sets[0])
+    representation = max(adaptation_set.findall('mpd:Representation', dash_namespace), key=lambda r: int(r.get('bandwidth') or 0))
+
+    url = manifest_url
+    for element in (mpd, period, adaptation_set, representation):
+        url = _base_url(url, element)
+
+    # The representation's segment information overrides the adaptation set's
+    template = representation.find('mpd:SegmentTemplate', dash_namespace)
+    if template is None: template = adaptation_set.find('mpd:SegmentTemplate', dash_namespace)
+    segment_list = representation.find('mpd:SegmentList', dash_namespace)
+    if segment_list is None: segment_list = adaptation_set.find('mpd:SegmentList', dash_namespace)
+
+    segments = []
+    if template is not None:
+        if template.get('initialization'):
+            segments.append(Segment(urljoin(url, _fill_template(template.get('initialization'), representation))))
+        number = int(template.get('startNumber') or 1)
+        media = template.get('media')
+        timeline = template.find('mpd:SegmentTimeline', dash_namespace)
+        if timeline is not None:
+            time_ = 0
+            for s in timeline.findall('mpd:S', dash_namespace):
+                time_ = int(s.get('t')) if s.get('t') else time_
+                for _ in range(int(s.get('r') or 0) + 1):
+                    segments.append(Segment(urljoin(url, _fill_template(media, representation, number, time_))))
+                    time_ += int(s.get('d'))
+                    number += 1
+        else:
+            if not template.get('duration'):
+                raise Exception('DASH SegmentTemplate has neither a SegmentTimeline nor a duration')
+            if not period_duration:
+                raise Exception('DASH manifest has no period or presentation duration, the number of segments is unknown')
+            segment_duration = int(template.get('duration')) / int(template.get('timescale') or 1)
+            for i in range(math.ceil(period_duration / segment_duration)):
+                segments.append(Segment(urljoin(url, _fill_template(media, representation, number + i))))
+    elif segment_list is not None:
+        initialization = segment_list.find('mpd:Initialization', dash_namespace)
+        if initialization is not None:
+            segments.append(Segment(urljoin(url, initialization.get('sourceURL') or ''),
+                                    _dash_range(initialization.get('range')) if initialization.get('range') else None))
+        for segment_url in segment_list.findall('mpd:SegmentURL', dash_namespace):
+            segments.append(Segment(urljoin(url, segment_url.get('media') or ''),
+                                    _dash_range(segment_url.get('mediaRange')) if segment_url.get('mediaRange') else None))
+    else:
+        segments.append(Segment(url))  # SegmentBase or a plain BaseURL, the whole file is one segment
+    return segments
+
+
+# Downloading
+
+def parse_manifest(manifest: str, manifest_url: str, headers: dict = None) -> list:
+    if manifest.lstrip().startswith('#EXTM3U'):
+        return parse_hls(manifest, manifest_url, headers)
+    return parse_dash(manifest, manifest_url)
+
+
+class SegmentedDownloader:
+    def __init__(self, headers: dict = None, workers: int = None, retries: int = None):
+        self.headers = headers or {}
+        self.workers = workers or transfer_settings.segment_workers
+        self.retries = retries if retries is not None else transfer_settings.segment_retries
+        self.keys = {}
+
+    def _get(self, url, byte_range=None) -> bytes:
+        headers = dict(self.headers)
+        if byte_range: headers['Range'] = f'bytes={byte_range[0]}-{byte_range[0] + byte_range[1] - 1}'
+        for attempt in range(self.retries + 1):
+            try:
+                r = r_session.get(url, headers=headers, verify=False)
+                r.raise_for_status()
+                expected = byte_range[1] if byte_range else r.headers.get('content-length')
+                if expected is not None and 'content-encoding' not in r.headers and len(r.content) != int(expected):
+                    raise DownloadIntegrityError(f'Received {len(r.content)} of {expected} bytes from {url}')
+                return r.content
+            except Exception:
+                # The session already retries status codes, this covers connections dropped mid-body
+                if attempt == self.retries: raise
+                time.sleep(0.5 * 2 ** attempt)
+
+    def _fetch(self, segment: Segment) -> bytes:
+        data = self._get(segment.url, segment.byte_range)
+        if segment.key_url:
+            data = AES.new(self.keys[segment.key_url], AES.MODE_CBC, segment.iv).decrypt(data)
+            data = data[:-data[-1]] if data and 0 < data[-1] <= 16 else data  # PKCS7 padding
+        return data
+
+    def download(self, segments: list, file_location: str, enable_progress_bar=False, indent_level=0) -> TransferDigest:
+        for key_url in {s.key_url for s in segments if s.key_url}:
+            self.keys[key_url] = self._get(key_url)
+
+        transfer_progress = progress.transfer(os.path.basename(file_location), parts=len(segments)) if enable_progress_bar else None
+        # At most a bounded window of segments is held in memory, they are written in order as soon as they arrive
+        window = deque()
+        hasher, size = hashlib.new(transfer_settings.hash_algorithm), 0
+        def write(f, data):
+            nonlocal size
+            f.write(data)
+            hasher.update(data)
+            size += len(data)
+            transfer_bytes_total.inc(len(data))
+            if transfer_progress: transfer_progress.update(len(data), parts=1)
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            with open(file_location, 'wb') as f:
+                for segment in segments:
+                    window.append(executor.submit(self._fetch, segment))
+                    if len(window) >= self.workers * 2:
+                        write(f, window.popleft().result())
+                while window:
+                    write(f, window.popleft().result())
+        except BaseException:
+            # Queued segments are dropped and segments still retrying are not waited for, they only write to memory
+            executor.shutdown(wait=False, cancel_futures=True)
+            silentremove(file_location)
+            raise
+        finally:
+            if transfer_progress: transfer_progress.close()
+        executor.shutdown()
+        return TransferDigest(hasher.name, hasher.hexdigest(), size)
+
+
+def _is_mpeg_ts(file_location) -> bool:
+    # Transport stream packets are 188 bytes long and each one starts with the 0x47 sync byte
+    with open(file_location, 'rb') as f:
+        head = f.read(188 * 3)
+    return bool(head) and all(head[i] == 0x47 for i in range(0, len(head), 188))
+
+
+def _remux(file_location):
+    # The container is taken from the extension, the streams are copied as they are
+    temp_location = f'{os.path.splitext(file_location)[0]}.remux{os.path.splitext(file_location)[1]}'
+    try:
+        ffmpeg.input(file_location, f='mpegts', hide_banner=None).output(temp_location, c='copy', loglevel='error') \
+            .run(capture_stdout=True, capture_stderr=True, overwrite_output=True)
+    except BaseException:
+        silentremove(temp_location)
+        raise
+    os.replace(temp_location, file_location)
+
+
+def download_segmented(manifest_url, file_location, manifest: str = None, headers={}, enable_progress_bar=False, indent_level=0):
+    if manifest is None:
+        r = r_session.get(manifest_url, headers=headers, verify=False)
+        r.raise_for_status()
+        manifest = r.text
+    segments = parse_manifest(manifest, manifest_url, headers)
+    with in_flight.track(kind='transfer'):
+        transfer = SegmentedDownloader(headers).download(segments, file_location, enable_progress_bar, indent_level)
+    # HLS segments are often MPEG-TS, concatenated they are a transport stream and not the track's container.
+    # The transfer digest stays the one of the received bytes, like for converted files
+    if not file_location.endswith('.ts') and _is_mpeg_ts(file_location):
+        try:
+            _remux(file_location)
+        except BaseException:
+            silentremove(file_location)
+            raise
+    return transfer
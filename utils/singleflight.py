@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from threading import Event, Lock
+
+
+class _Call:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+        self.users = 0
+        self.finished = False
+
+
+class SingleFlight:
+    # Coalesces concurrent calls with the same key into one, every caller gets the leader's result (or exception).
+    # Nothing is cached, a call made after the flight finished starts a new one
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def _join(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            call.users += 1
+        return call, leader
+
+    def _run(self, key, call, leader, function, args, kwargs):
+        if leader:
+            try:
+                call.result = function(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                    call.finished = True
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _leave(self, call, cleanup):
+        with self.lock:
+            call.users -= 1
+            last = call.finished and call.users == 0
+        if last and cleanup and call.error is None:
+            cleanup(call.result)
+
+    def do(self, key, function, *args, **kwargs):
+        call, leader = self._join(key)
+        try:
+            return self._run(key, call, leader, function, args, kwargs)
+        finally:
+            self._leave(call, None)
+
+    @contextmanager
+    def shared(self, key, function, *args, cleanup=None, **kwargs):
+        # Like do, but cleanup(result) runs once the last caller sharing the result has left the with block
+        call, leader = self._join(key)
+        try:
+            yield self._run(key, call, leader, function, args, kwargs)
+        finally:
+            self._leave(call, cleanup)
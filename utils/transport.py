@@ -0,0 +1,101 @@
+import socket
+import weakref
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+from utils.metrics import http_rate_limited_total, http_retries_total
+
+
+class HTTPTransport:
+    # Connection pools shared by every session Orpheus and its modules create, sessions still keep their own
+    # headers and cookies but reuse the same kept-alive connections
+    def __init__(self, pool_connections=10, pool_maxsize=32, host_pool_sizes=None, retries=10, retry_backoff=0.4,
+                 retry_statuses=(429, 500, 502, 503, 504), keep_alive=True):
+        self.sessions = weakref.WeakSet()
+        self.lock = Lock()
+        self.adapters = {}
+        self.configure(pool_connections, pool_maxsize, host_pool_sizes, retries, retry_backoff, retry_statuses, keep_alive)
+
+    def configure(self, pool_connections=10, pool_maxsize=32, host_pool_sizes=None, retries=10, retry_backoff=0.4,
+                  retry_statuses=(429, 500, 502, 503, 504), keep_alive=True):
+        retry = CountingRetry(total=retries, backoff_factor=retry_backoff, status_forcelist=list(retry_statuses))
+        socket_options = HTTPConnection.default_socket_options + ([(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] if keep_alive else [])
+
+        create_adapter = lambda maxsize: KeepAliveAdapter(pool_connections=pool_connections, pool_maxsize=maxsize,
+                                                          max_retries=retry, socket_options=socket_options)
+        adapters = {'http://': create_adapter(pool_maxsize), 'https://': create_adapter(pool_maxsize)}
+        # Hosts can get bigger (or smaller) pools than the default, e.g. a CDN serving many parallel transfers
+        for host, maxsize in (host_pool_sizes or {}).items():
+            adapters[f'https://{host}/'] = create_adapter(maxsize)
+            adapters[f'http://{host}/'] = create_adapter(maxsize)
+
+        with self.lock:
+            old_adapters, self.adapters, self.keep_alive = self.adapters, adapters, keep_alive
+            for session in self.sessions:
+                self._mount(session)
+        for adapter in old_adapters.values(): adapter.close()
+
+    def _mount(self, session: requests.Session):
+        for prefix, adapter in self.adapters.items():
+            session.mount(prefix, adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+
+    def mount(self, session: requests.Session):
+        with self.lock:
+            self._mount(session)
+            self.sessions.add(session)
+        return session
+
+    def create_session(self) -> requests.Session:
+        return self.mount(requests.Session())
+
+    def stats(self) -> dict:
+        # {host: (pool hits, pool misses)}, a miss is a request that needed a new connection
+        stats = {}
+        with self.lock:
+            adapters = list(self.adapters.values())
+        for adapter in adapters:
+            for host, requests_made, connections_made in adapter.pool_counts():
+                hits, misses = stats.get(host, (0, 0))
+                stats[host] = (hits + max(requests_made - connections_made, 0), misses + connections_made)
+        return stats
+
+
+class CountingRetry(Retry):
+    # Feeds every retry (and every 429 among them) into the metrics registry
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        host = _pool.host if _pool is not None else ''
+        reason = str(response.status) if response is not None else type(error).__name__
+        http_retries_total.inc(host=host, reason=reason)
+        if response is not None and response.status == 429: http_rate_limited_total.inc(host=host)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def pool_counts(self):
+        pools = self.poolmanager.pools
+        with pools.lock:
+            pool_list = [pools[key] for key in pools.keys()]
+        return [(pool.host, pool.num_requests, pool.num_connections) for pool in pool_list]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['socket_options'] = self.socket_options
+        return state
+
+
+http_transport = HTTPTransport()
@@ -1,10 +1,20 @@
-import pickle, requests, errno, hashlib, math, os, re, operator
-from tqdm import tqdm
+import pickle, errno, hashlib, json, math, os, re, operator, shutil, threading
+import ffmpeg
 from PIL import Image, ImageChops
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from dataclasses import dataclass
 from functools import reduce
 
+try:
+    import fcntl
+except ImportError:  # Windows, reflinks are not available there
+    fcntl = None
+
+from utils.exceptions import DownloadIntegrityError
+from utils.metrics import in_flight, transfer_bytes_total
+from utils.progress import progress
+from utils.singleflight import SingleFlight
+from utils.transport import http_transport
+
 
 def hash_string(input_str: str, hash_type: str = 'MD5'):
     if hash_type == 'MD5':
@@ -13,11 +23,8 @@ def hash_string(input_str: str, hash_type: str = 'MD5'):
         raise Exception('Invalid hash type selected')
 
 def create_requests_session():
-    session_ = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.4, status_forcelist=[429, 500, 502, 503, 504])
-    session_.mount('http://', HTTPAdapter(max_retries=retries))
-    session_.mount('https://', HTTPAdapter(max_retries=retries))
-    return session_
+    # Sessions share the connection pools and retry policy of the global transport
+    return http_transport.create_session()
 
 sanitise_name = lambda name : re.sub(r'[:]', ' - ', re.sub(r'[\\/*?"<>|$]', '', re.sub(r'[ \t]+$', '', str(name).rstrip()))) if name else ''
 
@@ -40,53 +47,230 @@ def fix_byte_limit(path: str, byte_limit=250):
 
 r_session = create_requests_session()
 
-def download_file(url, file_location, headers={}, enable_progress_bar=False, indent_level=0, artwork_settings=None):
-    if os.path.isfile(file_location):
-        return None
 
-    r = r_session.get(url, stream=True, headers=headers, verify=False)
+class TagPaddingWriter:
+    # Reserves space for tags while a FLAC or MP3 stream is being written, so tagging afterwards can happen in place
+    # FLAC gets an extra PADDING metadata block, MP3 gets an ID3v2.3 tag that only contains padding, or the padding of
+    # the ID3 tag it starts with is grown
+    flac_max_block_size = 2**24 - 1
+
+    def __init__(self, f, container_name: str, padding: int):
+        self.f = f
+        self.container_name = container_name
+        self.padding = min(padding, self.flac_max_block_size)
+        self.buffer = bytearray()
+        self.done = padding <= 0 or container_name not in {'flac', 'mp3'}
+
+    def write(self, data):
+        if self.done:
+            return self.f.write(data)
+        self.buffer += data
+        if self.container_name == 'flac':
+            self._insert_flac_padding()
+        elif len(self.buffer) >= 3:
+            if self.buffer[:3] != b'ID3':
+                # ID3v2.3 header, the tag size is a 28-bit syncsafe integer
+                self.f.write(b'ID3\x03\x00\x00' + self._syncsafe(self.padding) + bytes(self.padding))
+                self.flush()
+            else:
+                self._grow_id3_padding()
+        return len(data)
+
+    @staticmethod
+    def _syncsafe(value):
+        return bytes((value >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+    def _grow_id3_padding(self):
+        # An existing ID3 tag gets zeros appended up to the requested padding, which is where mutagen looks for it
+        if len(self.buffer) < 10: return
+        flags = self.buffer[5]
+        size = sum((b & 0x7f) << shift for b, shift in zip(self.buffer[6:10], (21, 14, 7, 0)))
+        # Extended headers record their own padding size and footers can't be combined with padding, leave those alone
+        if flags & 0x50 or self.buffer[3] not in {3, 4}: return self.flush()
+        if len(self.buffer) < 10 + size: return
+
+        existing = size - len(self.buffer[10:10 + size].rstrip(b'\x00'))
+        added = min(max(self.padding - existing, 0), 2**28 - 1 - size)
+        self.buffer[6:10] = self._syncsafe(size + added)
+        self.buffer[10 + size:10 + size] = bytes(added)
+        self.flush()
+
+    def _insert_flac_padding(self):
+        if len(self.buffer) >= 4 and self.buffer[:4] != b'fLaC':
+            return self.flush()
+
+        offset = 4
+        while len(self.buffer) >= offset + 4:
+            header, length = self.buffer[offset], int.from_bytes(self.buffer[offset + 1:offset + 4], 'big')
+            end = offset + 4 + length
+            if header & 0x80:  # Last metadata block, the padding block is inserted directly after it
+                if len(self.buffer) < end: return
+                self.buffer[offset] = header & 0x7f
+                self.buffer[end:end] = bytes([0x81]) + self.padding.to_bytes(3, 'big') + bytes(self.padding)
+                return self.flush()
+            offset = end
+
+    def flush(self):
+        self.done = True
+        if self.buffer:
+            self.f.write(self.buffer)
+            self.buffer = bytearray()
+
 
+@dataclass
+class TransferSettings:
+    buffer_size: int = 1024 * 1024  # Bytes read from the socket per call into one reusable buffer
+    preallocate: bool = True  # Reserve the whole file up front from content-length to avoid fragmentation
+    fsync: str = 'never'  # "never" or "file", whether every downloaded file is flushed to disk before continuing
+    segment_workers: int = 8  # Segments of an HLS/DASH stream fetched concurrently
+    segment_retries: int = 5  # Attempts per segment on top of the session's own retries
+    hash_algorithm: str = 'sha256'  # Any hashlib algorithm, the received bytes are hashed while they are written
+    integrity_sidecar: bool = True  # Write a "<file>.integrity.json" next to every downloaded track
+    temp_folder: str = 'temp'  # Worker processes of a sharded run each get their own, see orpheus_core_worker
+
+transfer_settings = TransferSettings()
+
+def set_transfer_settings(**kwargs):
+    for k, v in kwargs.items():
+        if not hasattr(transfer_settings, k): raise Exception(f'Invalid transfer setting "{k}"')
+        setattr(transfer_settings, k, v)
+
+
+@dataclass
+class TransferDigest:
+    algorithm: str
+    digest: str
+    size: int
+
+
+def _write_response(r, f, enable_progress_bar=False, indent_level=0, progress_name='') -> TransferDigest:
     total = None
     if 'content-length' in r.headers:
         total = int(r.headers['content-length'])
 
+    # Shown by the shared progress display, which redraws on its own thread instead of on every chunk
+    transfer_progress = progress.transfer(progress_name or os.path.basename(r.url.split('?')[0]), total) if enable_progress_bar else None
+
+    # One buffer per transfer, filled straight from the socket instead of allocating a new bytes object per KiB
+    buffer = bytearray(transfer_settings.buffer_size)
+    view = memoryview(buffer)
+    hasher = hashlib.new(transfer_settings.hash_algorithm)
+    received = 0
+    r.raw.decode_content = True
     try:
-        with open(file_location, 'wb') as f:
-            if enable_progress_bar and total:
+        while True:
+            size = r.raw.readinto(buffer)
+            if not size: break
+            f.write(view[:size])
+            hasher.update(view[:size])
+            received += size
+            if transfer_progress: transfer_progress.update(size)
+    finally:
+        view.release()
+        if transfer_progress: transfer_progress.close()
+
+    transfer_bytes_total.inc(received)
+    # content-length counts the encoded body, so it can only be compared when the body was not compressed
+    if total is not None and r.headers.get('content-encoding', 'identity') == 'identity' and received != total:
+        raise DownloadIntegrityError(f'Received {received} of {total} bytes from {r.url}')
+    return TransferDigest(hasher.name, hasher.hexdigest(), received)
+
+
+download_flights = SingleFlight()
+
+def download_file(url, file_location, headers={}, enable_progress_bar=False, indent_level=0, tag_padding=0, container_name=''):
+    # Concurrent downloads to the same location share one transfer instead of racing on the same file
+    with in_flight.track(kind='transfer'):
+        return download_flights.do(('file', file_location), _download_file, url, file_location, headers, enable_progress_bar,
+                                   indent_level, tag_padding, container_name)
+
+def _download_file(url, file_location, headers, enable_progress_bar, indent_level, tag_padding, container_name):
+    if os.path.isfile(file_location):
+        return None
+
+    r = r_session.get(url, stream=True, headers=headers, verify=False)
+    if not r.ok:  # An expired URL would otherwise leave its error page behind as the file
+        r.close()
+        r.raise_for_status()
+
+    try:
+        with open(file_location, 'wb') as file:
+            total = int(r.headers['content-length']) if 'content-length' in r.headers else 0
+            if transfer_settings.preallocate and total and hasattr(os, 'posix_fallocate'):
                 try:
-                    columns = os.get_terminal_size().columns
-                    if os.name == 'nt':
-                        bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, ncols=(columns-indent_level), bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                    else:
-                        raise
-                except:
-                    bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                # bar.set_description(' '*indent_level)
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        bar.update(len(chunk))
-                bar.close()
-            else:
-                [f.write(chunk) for chunk in r.iter_content(chunk_size=1024) if chunk]
-        if artwork_settings and artwork_settings.get('should_resize', False):
-            new_resolution = artwork_settings.get('resolution', 1400)
-            new_format = artwork_settings.get('format', 'jpeg')
-            if new_format == 'jpg': new_format = 'jpeg'
-            new_compression = artwork_settings.get('compression', 'low')
-            if new_compression == 'low':
-                new_compression = 90
-            elif new_compression == 'high':
-                new_compression = 70
-            if new_format == 'png': new_compression = None
-            with Image.open(file_location) as im:
-                im = im.resize((new_resolution, new_resolution), Image.Resampling.BICUBIC)
-                im.save(file_location, new_format, quality=new_compression)
-    except KeyboardInterrupt:
-        if os.path.isfile(file_location):
-            print(f'\tDeleting partially downloaded file "{str(file_location)}"')
-            silentremove(file_location)
-        raise KeyboardInterrupt
+                    os.posix_fallocate(file.fileno(), 0, total + max(tag_padding, 0))
+                except OSError:
+                    pass  # Not supported by every filesystem
+
+            f = TagPaddingWriter(file, container_name, tag_padding)
+            transfer = _write_response(r, f, enable_progress_bar, indent_level, os.path.basename(file_location))
+            f.flush()
+            file.truncate()  # Drops any preallocated space that was not written to
+
+            if transfer_settings.fsync == 'file':
+                file.flush()
+                os.fsync(file.fileno())
+        return transfer
+    except BaseException:
+        # A partial file would be taken for a finished download when the track is retried, callers report it on ^C
+        silentremove(file_location)
+        raise
+
+
+def download_file_converted(url, file_location, output_kwargs: dict, headers={}, enable_progress_bar=False, indent_level=0):
+    # Pipes the response body straight into ffmpeg, so only the converted file is ever written to disk.
+    # Only for formats that can be decoded without seeking, raises ffmpeg.Error with the captured stderr on failure
+    r = r_session.get(url, stream=True, headers=headers, verify=False)
+    if not r.ok:
+        r.close()
+        r.raise_for_status()
+
+    process = ffmpeg.input('pipe:', hide_banner=None).output(file_location, **output_kwargs, loglevel='error') \
+        .overwrite_output().run_async(pipe_stdin=True, pipe_stderr=True)
+    # Drained on a separate thread so ffmpeg can never block on a full stderr pipe while we write to stdin
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    transfer = None
+    try:
+        try:
+            transfer = _write_response(r, process.stdin, enable_progress_bar, indent_level, os.path.basename(file_location))
+        except BrokenPipeError:
+            pass  # ffmpeg exited early, the error is in stderr
+        finally:
+            process.stdin.close()
+        return_code = process.wait()
+        stderr_reader.join()
+    except BaseException:
+        process.kill()
+        silentremove(file_location)
+        raise
+
+    if return_code:
+        silentremove(file_location)
+        raise ffmpeg.Error('ffmpeg', None, stderr[0] if stderr else b'')
+    return transfer
+
+
+def hash_file(file_location, algorithm=None):
+    hasher = hashlib.new(algorithm or transfer_settings.hash_algorithm)
+    with open(file_location, 'rb') as f:
+        for chunk in iter(lambda: f.read(transfer_settings.buffer_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+integrity_sidecar_location = lambda file_location: file_location + '.integrity.json'
+
+def write_integrity_sidecar(file_location, transfer: TransferDigest = None):
+    # The transfer digest covers the bytes as received, the file digest the finished (tagged, converted) file,
+    # so "verify" can tell a file that changed on disk from one that arrived broken
+    algorithm = transfer.algorithm if transfer else transfer_settings.hash_algorithm
+    sidecar = {'algorithm': algorithm, 'digest': hash_file(file_location, algorithm), 'size': os.path.getsize(file_location)}
+    if transfer:
+        sidecar.update(transfer_digest=transfer.digest, transfer_size=transfer.size)
+    with open(integrity_sidecar_location(file_location), 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, indent=4)
 
 # root mean square code by Charlie Clark: https://code.activestate.com/recipes/577630-comparing-two-images/
 def compare_images(image_1, image_2):
@@ -94,8 +278,12 @@ def compare_images(image_1, image_2):
         h = ImageChops.difference(im1, im2).convert('L').histogram()
         return math.sqrt(reduce(operator.add, map(lambda h, i: h*(i**2), h, range(256))) / (float(im1.size[0]) * im1.size[1]))
 
-# TODO: check if not closing the files causes issues, and see if there's a way to use the context manager with lambda expressions
-get_image_resolution = lambda image_location : Image.open(image_location).size[0]
+def read_image_size(image_location):
+    # Only the image header is parsed here, the pixel data is never decoded
+    with Image.open(image_location) as im:
+        return im.size
+
+get_image_resolution = lambda image_location : read_image_size(image_location)[0]
 
 def silentremove(filename):
     try:
@@ -146,14 +334,47 @@ def set_temporary_setting(settings_location, module, root_setting, setting=None,
         session[root_setting] = value
     pickle.dump(temporary_settings, open(settings_location, 'wb'))
 
-create_temp_filename = lambda : f'temp/{os.urandom(16).hex()}'
+create_temp_filename = lambda : f'{transfer_settings.temp_folder}/{os.urandom(16).hex()}'
 
 def save_to_temp(input: bytes):
     location = create_temp_filename()
     open(location, 'wb').write(input)
     return location
 
-def download_to_temp(url, headers={}, extension='', enable_progress_bar=False, indent_level=0):
+FICLONE = 0x40049409  # Linux ioctl sharing the extents of a file, supported by btrfs, XFS, bcachefs and others
+
+def reflink(source, destination):
+    if not fcntl: raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        silentremove(destination)
+        raise
+
+def link_or_copy(source, destination, mode='hardlink'):
+    # Tries the requested kind of link, then the other one, and only copies if neither works (e.g. across filesystems).
+    # Returns how the destination was created
+    link_functions = {'hardlink': os.link, 'reflink': reflink}
+    for link_mode in sorted(link_functions, key=lambda i: i != mode) if mode in link_functions else []:
+        try:
+            link_functions[link_mode](source, destination)
+            return link_mode
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+def _download_to_shared_temp(url, headers, extension, enable_progress_bar, indent_level):
     location = create_temp_filename() + (('.' + extension) if extension else '')
     download_file(url, location, headers=headers, enable_progress_bar=enable_progress_bar, indent_level=indent_level)
     return location
+
+def download_to_temp(url, headers={}, extension='', enable_progress_bar=False, indent_level=0):
+    location = create_temp_filename() + (('.' + extension) if extension else '')
+    # Identical concurrent fetches (like the same cover for every track of an album) share one transfer,
+    # every caller still gets its own file as callers delete theirs when done
+    with download_flights.shared(('temp', url, extension), _download_to_shared_temp, url, headers, extension,
+                                 enable_progress_bar, indent_level, cleanup=silentremove) as shared_location:
+        link_or_copy(shared_location, location)
+    return location